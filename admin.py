@@ -0,0 +1,95 @@
+import hmac
+from functools import wraps
+
+from flask import Blueprint, Response, abort, current_app, jsonify, render_template, request
+
+from profiling import cpu_profile
+from slow_queries import aggregate, read_records
+
+# ----------------------------------------------------------------------------#
+# Admin pages.
+# ----------------------------------------------------------------------------#
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+def has_admin_token():
+    # Admin pages are off unless a token is configured; it can be passed as
+    # ?token= or in the X-Admin-Token header.
+    expected = current_app.config['ADMIN_TOKEN']
+    supplied = request.headers.get('X-Admin-Token') or request.args.get('token', '')
+    return bool(expected) and hmac.compare_digest(expected, supplied)
+
+
+def admin_required(view):
+    # The same check for admin actions outside the blueprint.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not has_admin_token():
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@admin.before_request
+def require_admin_token():
+    if not has_admin_token():
+        abort(404)
+
+
+@admin.route('/slow-queries')
+def slow_queries():
+    records = read_records(current_app.config['SLOW_QUERY_LOG_FILE'],
+                           request.args.get('limit', 5000, type=int))
+    groups = aggregate(records)
+    return render_template('pages/slow_queries.html', groups=groups, total=len(records),
+                           threshold=current_app.config['SLOW_QUERY_THRESHOLD_MS'])
+
+
+@admin.route('/search-cache')
+def search_cache_stats():
+    return jsonify(current_app.extensions['search_cache'].stats())
+
+
+@admin.route('/feed-cache')
+def feed_cache_stats():
+    return jsonify(current_app.extensions['feed_cache'].stats())
+
+
+@admin.route('/statement-cache')
+def statement_cache_stats():
+    stats = current_app.extensions.get('statement_cache')
+    if stats is None:
+        abort(404)
+    engines = current_app.extensions['sqlalchemy'].engines
+    if request.args.get('reset'):
+        stats.reset()
+    return jsonify(stats.stats(engines.items()))
+
+
+@admin.route('/memory')
+def memory_profile():
+    profiler = current_app.extensions.get('memory_profiler')
+    if profiler is None:
+        abort(404)
+    report = profiler.report(request.args.get('sort', 'peak_max_kb'), request.args.get('limit', 20, type=int))
+    if request.args.get('reset'):
+        profiler.reset()
+    return jsonify(report)
+
+
+@admin.route('/cpu-profile')
+def cpu_profile_stacks():
+    # Blocks for the length of the profile; the result is collapsed stacks
+    # for flamegraph.pl or speedscope.
+    config = current_app.config
+    seconds = min(request.args.get('seconds', 10, type=float), config['PROFILE_CPU_MAX_SECONDS'])
+    interval = max(request.args.get('interval', config['PROFILE_CPU_INTERVAL'], type=float), 0.001)
+    result = cpu_profile(seconds, interval, idle=bool(request.args.get('idle')))
+    if result is None:
+        return Response('A profile is already running.\n', 409, mimetype='text/plain')
+    stacks, rounds = result
+    lines = ['{} {}'.format(stack, count) for stack, count in stacks.most_common()]
+    response = Response('\n'.join(lines) + '\n', mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(rounds)
+    return response
@@ -0,0 +1,439 @@
+import base64
+import binascii
+import heapq
+from types import SimpleNamespace
+
+import orjson
+from flask import Blueprint, Response, current_app, request, url_for
+
+from archive import all_shows
+from models import db, Venue, Artist, Show
+from geo import geocode_venue
+from matching import split_genres
+from tasks import enqueue_profile_jobs
+from read_model import log_change
+from sharding import scatter, shard_names, using_shard
+from venue_shards import venue_shard
+from tours import parse_items, book_tour, record_tour
+from updates import (
+    ARTIST_FIELDS,
+    VENUE_FIELDS,
+    LOCATION_FIELDS,
+    NotFound,
+    VersionConflict,
+    apply_patch,
+    check_attribute,
+    normalize
+)
+
+# ----------------------------------------------------------------------------#
+# JSON API (v1).
+# ----------------------------------------------------------------------------#
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+RESOURCES = {
+    'venues': {
+        'model': Venue,
+        'fields': ('name', 'genres', 'address', 'city', 'state', 'phone', 'website_link',
+                   'facebook_link', 'seeking_talent', 'seeking_description', 'image_link',
+                   'latitude', 'longitude', 'version'),
+        'includes': {'shows': ('shows', 'venue_id')},
+    },
+    'artists': {
+        'model': Artist,
+        'fields': ('name', 'genres', 'city', 'state', 'phone', 'website_link', 'facebook_link',
+                   'seeking_venue', 'seeking_description', 'image_link', 'version'),
+        'includes': {'shows': ('shows', 'artist_id')},
+    },
+    'shows': {
+        'model': Show,
+        'fields': ('artist_id', 'venue_id', 'start_time'),
+        'includes': {'artist': ('artists', 'artist_id'), 'venue': ('venues', 'venue_id')},
+    },
+}
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return json_response({"errors": [{"status": error.status, "detail": error.message}]}, error.status)
+
+
+@api.errorhandler(404)
+def api_not_found(error):
+    return json_response({"errors": [{"status": 404, "detail": "Not found"}]}, 404)
+
+
+def json_response(payload, status=200):
+    return Response(orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS), status=status,
+                    mimetype='application/json')
+
+
+# Query parameters
+# ----------------------------------------------------------------
+
+def sparse_fields(resource_type, primary):
+    # `fields[venues]=name,city` works for any type; a bare `fields=` only
+    # applies to the primary resource.
+    allowed = RESOURCES[resource_type]['fields']
+    raw = request.args.get('fields[{}]'.format(resource_type))
+    if raw is None and primary:
+        raw = request.args.get('fields')
+    if raw is None:
+        return allowed
+    wanted = tuple(f for f in raw.split(',') if f)
+    unknown = [f for f in wanted if f not in allowed]
+    if unknown:
+        raise ApiError(400, 'Unknown field(s) for {}: {}'.format(resource_type, ', '.join(unknown)))
+    return wanted
+
+
+def includes(resource_type):
+    raw = request.args.get('include')
+    if not raw:
+        return ()
+    wanted = tuple(i for i in raw.split(',') if i)
+    unknown = [i for i in wanted if i not in RESOURCES[resource_type]['includes']]
+    if unknown:
+        raise ApiError(400, 'Cannot include {} on {}'.format(', '.join(unknown), resource_type))
+    return wanted
+
+
+def encode_cursor(last_id, position=0):
+    raw = '{}.{}'.format(last_id, position)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    # (last id, shard position). Cursors from before sharding hold only the
+    # id and continue after it on every shard.
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+        last_id, _, position = raw.partition('.')
+        return int(last_id), int(position) if position else len(shard_names())
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise ApiError(400, 'Invalid cursor')
+
+
+def page_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    return max(1, min(limit, MAX_LIMIT))
+
+
+# Loading and serialization
+# ----------------------------------------------------------------
+
+def load_columns(resource_type, fields, extra=()):
+    model = RESOURCES[resource_type]['model']
+    names = ('id',) + tuple(f for f in fields + tuple(extra) if f != 'id')
+    names = tuple(dict.fromkeys(names))
+    return model, names, db.select(*[getattr(model, n) for n in names])
+
+
+def resource_shards(resource_type):
+    # Venues and shows live on every shard; artists only on the default
+    # database, the shards just keep copies.
+    return [None] if resource_type == 'artists' else shard_names()
+
+
+def gather(statement_for, shards, key):
+    # statement_for(position) gives each shard's statement; the rows come
+    # back as (position, row), merged across shards by key(position, row).
+    engines = current_app.extensions['sqlalchemy'].engines
+    positions = {engines[shard]: position for position, shard in enumerate(shards)}
+
+    def run(conn):
+        position = positions[conn.engine]
+        return [(position, row) for row in conn.execute(statement_for(position)).all()]
+
+    results = scatter(run, shards)
+    return list(heapq.merge(*[rows for _, rows in results], key=lambda item: key(*item)))
+
+
+def serialize(resource_type, names, row, fields):
+    values = dict(zip(names, row))
+    attributes = {}
+    for f in fields:
+        value = values[f]
+        if f == 'genres':
+            value = sorted(split_genres(value))
+        attributes[f] = value
+    return {"type": resource_type, "id": values['id'], "attributes": attributes}, values
+
+
+def foreign_keys(resource_type, include_names):
+    # to-one includes need the foreign key column loaded on the primary rows
+    relations = RESOURCES[resource_type]['includes']
+    return tuple(relations[n][1] for n in include_names if relations[n][0] != 'shows')
+
+
+def fetch_included(resource_type, primary_rows, include_names):
+    # One batched IN query per relationship and shard, whatever the page
+    # size. Returns the included resources and each primary row's
+    # relationships, in the order of primary_rows.
+    included = []
+    relationships = [{} for _ in primary_rows]
+    for name in include_names:
+        related_type, key = RESOURCES[resource_type]['includes'][name]
+        fields = sparse_fields(related_type, primary=False)
+        shards = resource_shards(related_type)
+        if related_type == 'shows':
+            # to-many: shows pointing back at the primary rows, archived
+            # ones included; the archive keeps the shows' ids.
+            index = {row['id']: i for i, row in enumerate(primary_rows)}
+            _, names, _ = load_columns('shows', fields, extra=(key, 'start_time'))
+            both = all_shows(*names)
+            query = db.select(*[both.c[n] for n in names]).where(both.c[key].in_(list(index))) \
+                .order_by(both.c.start_time)
+            start = names.index('start_time')
+            rows = gather(lambda position: query, shards, lambda position, row: row[start]) if index else []
+            for primary in relationships:
+                primary[name] = {"data": []}
+            for _, row in rows:
+                resource, values = serialize('shows', names, row, fields)
+                relationships[index[values[key]]][name]["data"].append({"type": 'shows', "id": values['id']})
+                included.append(resource)
+        else:
+            # to-one: the primary rows hold the foreign key
+            ids = sorted({row[key] for row in primary_rows})
+            model, names, query = load_columns(related_type, fields)
+            query = query.where(model.id.in_(ids)).order_by(model.id)
+            rows = gather(lambda position: query, shards, lambda position, row: row[0]) if ids else []
+            for _, row in rows:
+                resource, _ = serialize(related_type, names, row, fields)
+                included.append(resource)
+            for i, row in enumerate(primary_rows):
+                relationships[i][name] = {"data": {"type": related_type, "id": row[key]}}
+    return included, relationships
+
+
+def render_collection(resource_type):
+    fields = sparse_fields(resource_type, primary=True)
+    include_names = includes(resource_type)
+    limit = page_limit()
+    model, names, query = load_columns(resource_type, fields, extra=foreign_keys(resource_type, include_names))
+    query = query.order_by(model.id).limit(limit + 1)
+    cursor = request.args.get('cursor')
+    if cursor:
+        last_id, last_position = decode_cursor(cursor)
+
+        def statement_for(position):
+            # Show ids are per shard and can repeat: rows are ordered by
+            # (id, shard), and a later shard may still have last_id itself.
+            if position > last_position:
+                return query.where(model.id >= last_id)
+            return query.where(model.id > last_id)
+    else:
+        def statement_for(position):
+            return query
+    rows = gather(statement_for, resource_shards(resource_type), lambda position, row: (row[0], position))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    data = []
+    raw = []
+    for _, row in rows:
+        resource, values = serialize(resource_type, names, row, fields)
+        data.append(resource)
+        raw.append(values)
+    payload = {"data": data}
+    if include_names:
+        included, relationships = fetch_included(resource_type, raw, include_names)
+        for resource, relationship in zip(data, relationships):
+            resource["relationships"] = relationship
+        payload["included"] = included
+    links = {"self": request.full_path.rstrip('?')}
+    if has_more:
+        args = request.args.to_dict()
+        args['cursor'] = encode_cursor(raw[-1]['id'], rows[-1][0])
+        links["next"] = url_for(request.endpoint, **args)
+    payload["links"] = links
+    return json_response(payload)
+
+
+def render_single(resource_type, entity_id):
+    fields = sparse_fields(resource_type, primary=True)
+    include_names = includes(resource_type)
+    extra = foreign_keys(resource_type, include_names)
+    if 'version' in RESOURCES[resource_type]['fields']:
+        extra += ('version',)
+    model, names, query = load_columns(resource_type, fields, extra=extra)
+    # On the shard the caller selected.
+    row = db.session.execute(query.where(model.id == entity_id)).first()
+    if row is None:
+        raise ApiError(404, '{} {} not found'.format(resource_type, entity_id))
+    resource, values = serialize(resource_type, names, row, fields)
+    payload = {"data": resource}
+    if include_names:
+        included, relationships = fetch_included(resource_type, [values], include_names)
+        resource["relationships"] = relationships[0]
+        payload["included"] = included
+    response = json_response(payload)
+    if 'version' in values:
+        response.set_etag(str(values['version']))
+    return response
+
+
+def patch_single(resource_type, entity_id):
+    # Partial update: only the attributes in the body are written, guarded by
+    # the version from If-Match (or "version" in the body).
+    model = RESOURCES[resource_type]['model']
+    writable = VENUE_FIELDS if model is Venue else ARTIST_FIELDS
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ApiError(400, 'Expected a JSON object')
+    data = body.get('data', body)
+    if not isinstance(data, dict):
+        raise ApiError(400, 'data must be an object')
+    attributes = data.get('attributes', {})
+    if not isinstance(attributes, dict):
+        raise ApiError(400, 'attributes must be an object')
+    unknown = [k for k in attributes if k not in writable]
+    if unknown:
+        raise ApiError(400, 'Cannot update {}: {}'.format(resource_type, ', '.join(unknown)))
+    try:
+        for field, value in attributes.items():
+            check_attribute(field, value)
+    except ValueError as e:
+        raise ApiError(400, str(e))
+
+    version = data.get('version')
+    if request.if_match and not request.if_match.star_tag:
+        tags = list(request.if_match)
+        version = tags[0] if tags else version
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        raise ApiError(428, 'A version is required (If-Match header or "version")')
+
+    changes = {k: normalize(k, v) for k, v in attributes.items()}
+    app = current_app._get_current_object()
+    if model is Venue and any(f in changes for f in LOCATION_FIELDS):
+        current = model.query.with_entities(*[getattr(model, f) for f in LOCATION_FIELDS]).filter(
+            model.id == entity_id).first()
+        if current is None:
+            raise ApiError(404, '{} {} not found'.format(resource_type, entity_id))
+        location = SimpleNamespace(**dict(zip(LOCATION_FIELDS, current)))
+        for f in LOCATION_FIELDS:
+            if f in changes:
+                setattr(location, f, changes[f])
+        geocode_venue(app.extensions['geocoder'], location)
+        changes.update(latitude=location.latitude, longitude=location.longitude, geohash=location.geohash)
+    try:
+        apply_patch(model, entity_id, version, changes)
+        if changes:
+            log_change(resource_type[:-1], entity_id)
+        db.session.commit()
+    except NotFound:
+        raise ApiError(404, '{} {} not found'.format(resource_type, entity_id))
+    except VersionConflict as e:
+        response = json_response({"errors": [{
+            "status": 409,
+            "detail": 'Version {} is stale'.format(version),
+            "meta": {"current_version": e.current_version}
+        }]}, 409)
+        response.set_etag(str(e.current_version))
+        return response
+
+    if changes:
+        entity = db.session.get(model, entity_id)
+        if model is Venue:
+            app.extensions['matcher'].update_venue(entity)
+        else:
+            app.extensions['matcher'].update_artist(entity)
+        app.extensions['search_cache'].invalidate(resource_type, entity.id, entity.name)
+        app.extensions['feed_cache'].invalidate(resource_type[:-1], entity.id)
+        enqueue_profile_jobs(resource_type[:-1], entity)
+    return render_single(resource_type, entity_id)
+
+
+# Routes
+# ----------------------------------------------------------------
+
+@api.route('/venues')
+def list_venues():
+    return render_collection('venues')
+
+
+@api.route('/venues/<int:venue_id>')
+def get_venue(venue_id):
+    with using_shard(venue_shard(venue_id)):
+        return render_single('venues', venue_id)
+
+
+@api.route('/venues/<int:venue_id>', methods=['PATCH'])
+def patch_venue(venue_id):
+    with using_shard(venue_shard(venue_id)):
+        return patch_single('venues', venue_id)
+
+
+@api.route('/artists')
+def list_artists():
+    return render_collection('artists')
+
+
+@api.route('/artists/<int:artist_id>')
+def get_artist(artist_id):
+    return render_single('artists', artist_id)
+
+
+@api.route('/artists/<int:artist_id>', methods=['PATCH'])
+def patch_artist(artist_id):
+    return patch_single('artists', artist_id)
+
+
+@api.route('/artists/<int:artist_id>/tour', methods=['POST'])
+def book_artist_tour(artist_id):
+    # All or nothing: 201 when every show was created, otherwise 422 with
+    # the problems of each row.
+    body = request.get_json(silent=True)
+    items = body.get('shows') if isinstance(body, dict) else None
+    limit = current_app.config['TOUR_MAX_SHOWS']
+    if not isinstance(items, list) or not 0 < len(items) <= limit:
+        raise ApiError(400, 'Expected "shows": a list of 1 to {} objects'.format(limit))
+    rows = parse_items(items)
+    try:
+        created = book_tour(artist_id, rows)
+    except ValueError as e:
+        db.session.rollback()
+        raise ApiError(404, str(e))
+    if not created:
+        errors = [{"status": 422, "detail": error, "source": {"pointer": '/shows/{}'.format(row["line"] - 1)}}
+                  for row in rows for error in row["errors"]]
+        return json_response({"errors": errors}, 422)
+    record_tour(artist_id, rows)
+    return json_response({"meta": {"created": created}}, 201)
+
+
+@api.route('/shows')
+def list_shows():
+    return render_collection('shows')
+
+
+@api.route('/shows/<int:show_id>')
+def get_show(show_id):
+    # Show ids are only unique within a shard: ?venue_id= names the shard,
+    # otherwise every shard is asked and an id found on several is a 409.
+    venue_id = request.args.get('venue_id', type=int)
+    if venue_id is not None:
+        shards = [venue_shard(venue_id)]
+    else:
+        found = scatter(lambda conn: conn.execute(
+            db.select(Show.venue_id).where(Show.id == show_id)).scalar())
+        shards = [shard for shard, found_venue in found if found_venue is not None]
+        if len(shards) > 1:
+            raise ApiError(409, 'Show id {} exists on several shards; add ?venue_id='.format(show_id))
+    with using_shard(shards[0] if shards else None):
+        return render_single('shows', show_id)
@@ -5,6 +5,7 @@
 import json
 import datetime
 import sys
+from types import SimpleNamespace
 import dateutil.parser
 import babel
 from flask import (
@@ -15,15 +16,25 @@ from flask import (
     flash,
     redirect,
     url_for,
-    abort
+    abort,
+    send_file,
+    make_response
 )
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 import logging
-from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
+from template_cache import init_template_cache
+from structured_logging import init_logging, init_request_logging
+from capture import init_capture
+from slow_queries import init_slow_query_log
+from profiling import init_profiling
+from sharding import ShardSession, using_shard, shard_names, scatter
+from ratelimit import init_rate_limiter, rate_limited
+from singleflight import SingleFlight
+from search_cache import SearchCache, normalize_term
 
 # ----------------------------------------------------------------------------#
 # App Config.
@@ -32,13 +43,103 @@ from forms import *
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+app.config.from_envvar('FYYUR_SETTINGS', silent=True)
+db = SQLAlchemy(app, session_options={'class_': ShardSession})
+init_template_cache(app)
 
 # ----------------------------------------------------------------------------#
 # Models.
 # ----------------------------------------------------------------------------#
 
 from models import Venue, Artist, Show
+from geo import Geocoder, geocode_venue, covering_cells, haversine_km
+from matching import MatchEngine, split_genres
+from jobs import jobs_cli
+from tasks import broken_links, enqueue_profile_jobs
+from thumbnails import cache_from_config, url_digest, FORMATS, FetchError
+
+from api import api
+from bulk_delete import delete_cli, delete_ids, parse_ids
+from admin import admin, admin_required
+from tours import parse_lines, book_tour, record_tour
+from prerender import prerender_command
+from read_model import init_read_model, log_change
+from events import init_events, publish
+from feeds import init_feeds
+from trending import init_view_counter, trending_cli, trending_lists
+import queries
+from queries import init_statement_stats, queries_cli
+from archive import shows_cli, upcoming_shows as upcoming_shows_for, past_shows_page, archived_shows_page, hot_shows
+from venue_shards import (
+    shards_cli,
+    venue_shard,
+    allocate_venue_id,
+    place_venue,
+    release_venue_id,
+    copy_artist,
+    venue_summaries,
+    recent_venues,
+    artist_upcoming_counts
+)
+from updates import (
+    ARTIST_FIELDS,
+    VENUE_FIELDS,
+    LOCATION_FIELDS,
+    NotFound,
+    VersionConflict,
+    apply_patch,
+    changed_values,
+    dump_original,
+    entity_values,
+    form_values,
+    load_original
+)
+
+app.cli.add_command(jobs_cli)
+app.cli.add_command(delete_cli)
+app.cli.add_command(shows_cli)
+app.cli.add_command(shards_cli)
+app.cli.add_command(prerender_command)
+app.cli.add_command(trending_cli)
+app.cli.add_command(queries_cli)
+app.register_blueprint(api)
+app.register_blueprint(admin)
+
+geocoder = Geocoder(app.config['GEOCODE_LOOKUP_FILE'])
+thumbnail_cache = cache_from_config(app.config)
+matcher = MatchEngine(
+    top_k=app.config['MATCH_TOP_K'],
+    activity_days=app.config['MATCH_ACTIVITY_DAYS'],
+    cache_ttl=app.config['MATCH_CACHE_TTL'],
+    index_ttl=app.config['MATCH_INDEX_TTL']
+)
+app.extensions['geocoder'] = geocoder
+app.extensions['matcher'] = matcher
+# Identical searches running at the same time share one query.
+searches = SingleFlight()
+search_cache = SearchCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])
+app.extensions['search_cache'] = search_cache
+feed_cache = init_feeds(app)
+view_counter = init_view_counter(app)
+# Listings and searches are served from memory when enabled.
+read_model = init_read_model(app)
+
+
+def cached_search(kind, raw_term, search):
+    # Cached on the normalized term; concurrent misses for the same term
+    # share one query.
+    term = normalize_term(raw_term)
+    result, generation = search_cache.get(kind, term)
+    if result is None:
+        result = searches.do((kind, term), lambda: search(term))
+        search_cache.put(kind, term, result, [row["id"] for row in result["data"]], generation)
+    return result
+
+
+def count_view(kind, entity_id):
+    # Snapshot renders are not visitors.
+    if view_counter is not None and 'X-Prerender' not in request.headers:
+        view_counter.record(kind, entity_id)
 
 
 # ----------------------------------------------------------------------------#
@@ -57,15 +158,32 @@ def format_datetime(value, format='medium'):
 app.jinja_env.filters['datetime'] = format_datetime
 
 
+def thumbnail_url(image_link, kind, entity_id, size='md'):
+    # The url carries a digest of the source link, so a changed image gets
+    # a new url and the old one can be cached forever.
+    if not image_link:
+        return image_link
+    return url_for('thumbnail', kind=kind, entity_id=entity_id, size=size, v=url_digest(image_link)[:10])
+
+
+app.jinja_env.filters['thumbnail'] = thumbnail_url
+
+
 # ----------------------------------------------------------------------------#
 # Controllers.
 # ----------------------------------------------------------------------------#
 
 @app.route('/')
 def index():
-    venue_all = Venue.query.order_by(Venue.id.desc()).limit(10).all()
-    artist_all = Artist.query.order_by(Artist.id.desc()).limit(10).all()
-    return render_template('pages/home.html', venues=venue_all, artists=artist_all)
+    if read_model is not None:
+        venue_all = read_model.recent_venues(10)
+        artist_all = read_model.recent_artists(10)
+    else:
+        venue_all = recent_venues(10)
+        artist_all = Artist.query.order_by(Artist.id.desc()).limit(10).all()
+    trending = trending_lists(app.config['TRENDING_HOME_SIZE'])
+    return render_template('pages/home.html', venues=venue_all, artists=artist_all,
+                           trending_venues=trending['venue'], trending_artists=trending['artist'])
 
 
 #  Venues
@@ -73,73 +191,114 @@ def index():
 
 @app.route('/venues')
 def venues():
-    data = []
-    venue_all = Venue.query.with_entities(Venue.city, Venue.state).distinct(Venue.city, Venue.state)
-    current_time = datetime.now()
-    for venue in venue_all:
-        venues_in_city = Venue.query.with_entities(Venue.id, Venue.name).filter_by(city=venue[0]).filter_by(
-            state=venue[1])
-        v_dic = []
-        for v in venues_in_city:
-            sc = Show.query.join(Venue).filter(Show.venue_id == v.id).filter(Show.start_time > datetime.now()).count()
-            v_dic.append({
-                "id": v.id,
-                "name": v.name,
-                "num_upcoming_shows": sc
-            })
-        data.append({"city": venue[0], "state": venue[1], "venues": v_dic})
+    if read_model is not None:
+        data = [{"city": city, "state": state, "venues": vs} for city, state, vs in read_model.areas()]
+        return render_template('pages/venues.html', areas=data)
+    # Gathered from every shard at once, then grouped by area here.
+    areas = {}
+    for v in venue_summaries(datetime.now()):
+        area = areas.setdefault((v.state, v.city), {"city": v.city, "state": v.state, "venues": []})
+        area["venues"].append({
+            "id": v.id,
+            "name": v.name,
+            "version": v.version,
+            "num_upcoming_shows": v.num_upcoming_shows
+        })
+    data = [areas[key] for key in sorted(areas)]
     return render_template('pages/venues.html', areas=data);
 
 
 @app.route('/venues/search', methods=['POST'])
+@rate_limited('search')
 def search_venues():
-    key = request.form.get('search_term', '')
+    response = cached_search('venues', request.form.get('search_term', ''), venue_search_results)
+    return render_template('pages/search_venues.html', results=response,
+                           search_term=request.form.get('search_term', ''))
 
-    query = Venue.query.filter(Venue.name.ilike("%" + key + "%")).all()
-    count = Venue.query.filter(Venue.name.ilike("%" + key + "%")).count()
-    current_time = datetime.now()
+
+def venue_search_results(key):
+    if read_model is not None:
+        vs = read_model.search_venues(key)
+        return {"count": len(vs), "data": vs}
+    query = venue_summaries(datetime.now(), search=key)
     vs = []
     for v in query:
         vs.append({
             "id": v.id,
             "name": v.name,
-            "num_upcoming_shows": Show.query.join(Venue).filter_by(venue_id=v.id).filter(
-                Show.start_time > current_time).count()
+            "version": v.version,
+            "num_upcoming_shows": v.num_upcoming_shows
         })
+    return {
+        "count": len(vs),
+        "data": vs
+    }
+
+
+@app.route('/venues/nearby')
+def nearby_venues():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    radius = request.args.get('radius', app.config['NEARBY_DEFAULT_RADIUS_KM'], type=float)
+    if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        abort(400)
+    radius = min(max(radius, 0), app.config['NEARBY_MAX_RADIUS_KM'])
+
+    # Only venues in the grid cells around the point are candidates; exact
+    # distances are computed for those alone.
+    cells = covering_cells(lat, lon, radius)
+    query = db.select(
+        Venue.id, Venue.name, Venue.city, Venue.state, Venue.latitude, Venue.longitude
+    ).where(Venue.geohash.isnot(None)).where(
+        db.or_(*[Venue.geohash.startswith(cell) for cell in cells])
+    )
+    candidates = [row for _, rows in scatter(lambda conn: conn.execute(query).all()) for row in rows]
+    vs = []
+    for v in candidates:
+        distance = haversine_km(lat, lon, v.latitude, v.longitude)
+        if distance <= radius:
+            vs.append({
+                "id": v.id,
+                "name": v.name,
+                "city": v.city,
+                "state": v.state,
+                "distance_km": round(distance, 2)
+            })
+    vs.sort(key=lambda v: v["distance_km"])
 
     response = {
-        "count": count,
+        "count": len(vs),
         "data": vs
     }
-    return render_template('pages/search_venues.html', results=response,
-                           search_term=request.form.get('search_term', ''))
+    return render_template('pages/nearby_venues.html', results=response, lat=lat, lon=lon, radius=radius)
 
 
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
-    venue = Venue.query.filter_by(id=venue_id).first()
+    with using_shard(venue_shard(venue_id)):
+        venue = queries.venue_by_id(venue_id)
     if venue is None:
         abort(404)
-    all_shows = venue.shows
+    count_view('venue', venue_id)
     current_time = datetime.now()
-    past_shows = []
+    page = max(request.args.get('past_page', 1, type=int), 1)
     upcoming_shows = []
-    for show in all_shows:
-        query = Show.query.join(Artist).with_entities(
-            Show.artist_id,
-            Artist.name,
-            Artist.image_link,
-            Show.start_time).filter(Show.venue_id == venue_id).first()
-        arr = {
-            "artist_id": query[0],
-            "artist_name": query[1],
-            "artist_image_link": query[2],
-            "start_time": format_datetime(str(query[3]))
-        }
-        if show.start_time > current_time:
-            upcoming_shows.append(arr)
-        else:
-            past_shows.append(arr)
+    for artist_id, artist_name, artist_image_link, start_time in upcoming_shows_for('venue', venue_id, current_time):
+        upcoming_shows.append({
+            "artist_id": artist_id,
+            "artist_name": artist_name,
+            "artist_image_link": artist_image_link,
+            "start_time": format_datetime(str(start_time))
+        })
+    past_rows, past_count = past_shows_page('venue', venue_id, current_time, page, app.config['PAST_SHOWS_PER_PAGE'])
+    past_shows = []
+    for artist_id, artist_name, artist_image_link, start_time in past_rows:
+        past_shows.append({
+            "artist_id": artist_id,
+            "artist_name": artist_name,
+            "artist_image_link": artist_image_link,
+            "start_time": format_datetime(str(start_time))
+        })
     data = {
         "id": venue.id,
         "name": venue.name,
@@ -155,8 +314,12 @@ def show_venue(venue_id):
         "image_link": venue.image_link,
         "past_shows": past_shows,
         "upcoming_shows": upcoming_shows,
-        "past_shows_count": len(past_shows),
-        "upcoming_shows_count": len(upcoming_shows)
+        "past_shows_count": past_count,
+        "upcoming_shows_count": len(upcoming_shows),
+        "past_page": page,
+        "past_pages": max(-(-past_count // app.config['PAST_SHOWS_PER_PAGE']), 1),
+        "recommended_artists": matcher.artists_for_venue(venue.id),
+        "broken_links": broken_links('venue', venue)
     }
     return render_template('pages/show_venue.html', venue=data)
 
@@ -192,8 +355,23 @@ def create_venue_submission():
             seeking_description=request.form.get('seeking_description', ''),
         )
         form.populate_obj(venue)
-        db.session.add(venue)
-        db.session.commit()
+        geocode_venue(geocoder, venue)
+        venue_id, shard = allocate_venue_id(venue.state)
+        venue.id = venue_id
+        with using_shard(shard):
+            try:
+                db.session.add(venue)
+                log_change('venue', venue_id)
+                db.session.commit()
+            except Exception:
+                release_venue_id(venue_id)
+                raise
+            place_venue(venue_id, shard)
+            matcher.update_venue(venue)
+            search_cache.invalidate('venues', venue.id, venue.name)
+            feed_cache.invalidate('venue', venue.id, sitemap=True)
+            enqueue_profile_jobs('venue', venue)
+            publish('venue', id=venue.id, name=venue.name, city=venue.city, state=venue.state)
     except ValueError as e:
         print(e)
         db.session.rollback()
@@ -207,17 +385,31 @@ def create_venue_submission():
     return render_template('pages/home.html')
 
 
-@app.route('/venues/<venue_id>/delete', methods=['GET'])
+@app.route('/venues/<int:venue_id>/delete', methods=['GET'])
+def delete_venue_page(venue_id):
+    # Detail pages are prerendered, so the CSRF-bound form lives here
+    # rather than on them.
+    with using_shard(venue_shard(venue_id)):
+        name = queries.venue_name(venue_id)
+    if name is None:
+        abort(404)
+    return render_template('pages/confirm_delete.html', form=DeleteForm(), kind='venue', name=name,
+                           url='/venues/{}'.format(venue_id))
+
+
+@app.route('/venues/<int:venue_id>/delete', methods=['POST'])
 def delete_venue(venue_id):
     error = False
-    name = venue_id
+    if not DeleteForm().validate_on_submit():
+        abort(400)
+    with using_shard(venue_shard(venue_id)):
+        name = queries.venue_name(venue_id)
+    if name is None:
+        abort(404)
     try:
-        venue = Venue.query.filter_by(id=venue_id).first()
-        if venue is None:
-            abort(404)
-        name = venue.name
-        db.session.delete(venue)
-        db.session.commit()
+        # Shows go with the venue through ON DELETE CASCADE; nothing is
+        # loaded into the session.
+        delete_ids('venue', [venue_id])
     except:
         db.session.rollback()
         error = True
@@ -228,12 +420,35 @@ def delete_venue(venue_id):
         flash('An error occurred. Venue ' + name + ' could not be deleted.')
     else:
         flash('Venue ' + name + ' was successfully deleted!')
+    return redirect(url_for('index'))
 
-    # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
 
-    # BONUS CHALLENGE: Implement a button to delete a Venue on a Venue Page, have it so that
-    # clicking that button delete it from the db then redirect the user to the homepage
-    return redirect(url_for('index'))
+@app.route('/venues/delete', methods=['POST'])
+@admin_required
+def bulk_delete_venues():
+    return bulk_delete('venue', 'venues')
+
+
+def bulk_delete(kind, listing):
+    error = False
+    deleted = shows = 0
+    try:
+        ids = parse_ids(request.form.getlist('ids'))
+        deleted, shows = delete_ids(kind, ids, app.config['BULK_DELETE_BATCH_SIZE'])
+    except ValueError:
+        db.session.rollback()
+        error = True
+    except:
+        db.session.rollback()
+        error = True
+        print(sys.exc_info())
+    finally:
+        db.session.close()
+    if error:
+        flash('An error occurred. The selected {}s could not be deleted.'.format(kind))
+    else:
+        flash('Deleted {} {}s and {} shows.'.format(deleted, kind, shows))
+    return redirect(url_for(listing))
 
 
 #  Artists
@@ -241,64 +456,70 @@ def delete_venue(venue_id):
 @app.route('/artists')
 def artists():
     data = []
-    artist_all = Artist.query.all()
+    artist_all = read_model.all_artists() if read_model is not None else Artist.query.all()
     for artist in artist_all:
         data.append({
             "id": artist.id,
-            "name": artist.name
+            "name": artist.name,
+            "version": artist.version
         })
     return render_template('pages/artists.html', artists=data)
 
 
 @app.route('/artists/search', methods=['POST'])
+@rate_limited('search')
 def search_artists():
-    keyword = request.form.get('search_term', '')
+    response = cached_search('artists', request.form.get('search_term', ''), artist_search_results)
+    return render_template('pages/search_artists.html', results=response,
+                           search_term=request.form.get('search_term', ''))
 
-    query = Artist.query.filter(Artist.name.ilike("%" + keyword + "%")).all()
-    count = Artist.query.filter(Artist.name.ilike("%" + keyword + "%")).count()
-    current_time = datetime.now()
+
+def artist_search_results(keyword):
+    if read_model is not None:
+        arts = read_model.search_artists(keyword)
+        return {"count": len(arts), "data": arts}
+    query = queries.search_artists(keyword)
+    # Upcoming counts for all matches in one grouped query per shard.
+    upcoming = artist_upcoming_counts([a.id for a in query], datetime.now())
     arts = []
     for a in query:
         arts.append({
             "id": a.id,
             "name": a.name,
-            "num_upcoming_shows": Show.query.filter_by(artist_id=a.id).filter(Show.start_time > current_time).count()
+            "version": a.version,
+            "num_upcoming_shows": upcoming[a.id]
         })
-
-    response = {
-        "count": count,
+    return {
+        "count": len(arts),
         "data": arts
     }
-    return render_template('pages/search_artists.html', results=response,
-                           search_term=request.form.get('search_term', ''))
 
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
-    artist = Artist.query.filter_by(id=artist_id).first()
+    artist = queries.artist_by_id(artist_id)
     if artist is None:
         abort(404)
-    all_shows = artist.shows
+    count_view('artist', artist_id)
     current_time = datetime.now()
-    past_shows = []
+    page = max(request.args.get('past_page', 1, type=int), 1)
     upcoming_shows = []
-    for show in all_shows:
-        query = Show.query.join(Venue).with_entities(
-            Show.artist_id,
-            Venue.name,
-            Venue.image_link,
-            Show.start_time
-        ).filter(Show.artist_id == artist_id).first()
-        arr = {
-            "venue_id": query[0],
-            "venue_name": query[1],
-            "venue_image_link": query[2],
-            "start_time": format_datetime(str(query[3]))
-        }
-        if show.start_time > current_time:
-            upcoming_shows.append(arr)
-        else:
-            past_shows.append(arr)
+    for venue_id, venue_name, venue_image_link, start_time in upcoming_shows_for('artist', artist_id, current_time):
+        upcoming_shows.append({
+            "venue_id": venue_id,
+            "venue_name": venue_name,
+            "venue_image_link": venue_image_link,
+            "start_time": format_datetime(str(start_time))
+        })
+    past_rows, past_count = past_shows_page('artist', artist_id, current_time, page, app.config['PAST_SHOWS_PER_PAGE'])
+    past_shows = []
+    for venue_id, venue_name, venue_image_link, start_time in past_rows:
+        past_shows.append({
+            "venue_id": venue_id,
+            "venue_name": venue_name,
+            "venue_image_link": venue_image_link,
+            "start_time": format_datetime(str(start_time))
+        })
     data = {
         "id": artist.id,
         "name": artist.name,
@@ -313,19 +534,67 @@ def show_artist(artist_id):
         "image_link": artist.image_link,
         "past_shows": past_shows,
         "upcoming_shows": upcoming_shows,
-        "past_shows_count": len(past_shows),
+        "past_shows_count": past_count,
         "upcoming_shows_count": len(upcoming_shows),
+        "past_page": page,
+        "past_pages": max(-(-past_count // app.config['PAST_SHOWS_PER_PAGE']), 1),
+        "recommended_venues": matcher.venues_for_artist(artist.id),
+        "broken_links": broken_links('artist', artist)
     }
     return render_template('pages/show_artist.html', artist=data)
 
 
+@app.route('/artists/<int:artist_id>/delete', methods=['GET'])
+def delete_artist_page(artist_id):
+    name = queries.artist_name(artist_id)
+    if name is None:
+        abort(404)
+    return render_template('pages/confirm_delete.html', form=DeleteForm(), kind='artist', name=name,
+                           url='/artists/{}'.format(artist_id))
+
+
+@app.route('/artists/<int:artist_id>/delete', methods=['POST'])
+def delete_artist(artist_id):
+    error = False
+    if not DeleteForm().validate_on_submit():
+        abort(400)
+    name = queries.artist_name(artist_id)
+    if name is None:
+        abort(404)
+    try:
+        delete_ids('artist', [artist_id])
+    except:
+        db.session.rollback()
+        error = True
+        print(sys.exc_info())
+    finally:
+        db.session.close()
+    if error:
+        flash('An error occurred. Artist ' + name + ' could not be deleted.')
+    else:
+        flash('Artist ' + name + ' was successfully deleted!')
+    return redirect(url_for('index'))
+
+
+@app.route('/artists/delete', methods=['POST'])
+@admin_required
+def bulk_delete_artists():
+    return bulk_delete('artist', 'artists')
+
+
 #  Update
 #  ----------------------------------------------------------------
 @app.route('/artists/<artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
-    data = Artist.query.filter_by(id=artist_id).first()
+    data = queries.artist_by_id(artist_id)
     if data is None:
         abort(404)
+    return edit_artist_page(data)
+
+
+def edit_artist_page(data, form=None):
+    # form is given after a version conflict: it keeps what was submitted,
+    # while version and original move on to the row as it is now.
     artist = {
         "id": data.id,
         "name": data.name,
@@ -337,41 +606,51 @@ def edit_artist(artist_id):
         "facebook_link": data.facebook_link,
         "seeking_venue": data.seeking_venue,
         "seeking_description": data.seeking_description,
-        "image_link": data.image_link
+        "image_link": data.image_link,
+        "version": data.version,
+        "original": dump_original(entity_values(data, ARTIST_FIELDS))
     }
-    form = ArtistForm()
-    form.name.data = data.name
-    form.genres.data = data.genres
-    form.city.data = data.city
-    form.state.data = data.state
-    form.phone.data = data.phone
-    form.website_link.data = data.website_link
-    form.facebook_link.data = data.facebook_link
-    form.seeking_venue.data = data.seeking_venue
-    form.seeking_description.data = data.seeking_description
-    form.image_link.data = data.image_link
+    if form is None:
+        form = ArtistForm()
+        form.name.data = data.name
+        form.genres.data = sorted(split_genres(data.genres))
+        form.city.data = data.city
+        form.state.data = data.state
+        form.phone.data = data.phone
+        form.website_link.data = data.website_link
+        form.facebook_link.data = data.facebook_link
+        form.seeking_venue.data = data.seeking_venue
+        form.seeking_description.data = data.seeking_description
+        form.image_link.data = data.image_link
     return render_template('forms/edit_artist.html', form=form, artist=artist)
 
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
 def edit_artist_submission(artist_id):
     error = False
-    seeking_venue = False
-    if request.form.get('seeking_venue', 'n') == 'y':
-        seeking_venue = True
+    # Only columns that differ from what the form was rendered with are
+    # written, in one UPDATE guarded by the version the form was read at.
+    submitted = form_values(request.form, ARTIST_FIELDS)
+    changes = changed_values(submitted, load_original(request.form.get('original')))
     try:
-        artist = Artist.query.filter_by(id=artist_id).first()
-        artist.name = request.form.get('name', '')
-        artist.genres = request.form.get('genres', '')
-        artist.city = request.form.get('city', '')
-        artist.state = request.form.get('state', '')
-        artist.phone = request.form.get('phone', '')
-        artist.website_link = request.form.get('website_link', '')
-        artist.facebook_link = request.form.get('facebook_link', '')
-        artist.seeking_venue = seeking_venue
-        artist.seeking_description = request.form.get('seeking_description', '')
-        artist.image_link = request.form.get('image_link', '')
+        apply_patch(Artist, artist_id, request.form.get('version', 0, type=int), changes)
+        if changes:
+            log_change('artist', artist_id)
         db.session.commit()
+        if changes:
+            artist = SimpleNamespace(id=artist_id, **submitted)
+            matcher.update_artist(artist)
+            search_cache.invalidate('artists', artist.id, artist.name)
+            feed_cache.invalidate('artist', artist.id)
+            enqueue_profile_jobs('artist', artist)
+    except NotFound:
+        abort(404)
+    except VersionConflict:
+        flash('Artist ' + request.form['name'] + ' was changed by someone else. Review the latest version and try again.')
+        data = queries.artist_by_id(artist_id)
+        if data is None:
+            abort(404)
+        return edit_artist_page(data, ArtistForm(request.form)), 409
     except:
         db.session.rollback()
         error = True
@@ -388,10 +667,15 @@ def edit_artist_submission(artist_id):
 
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
-    form = VenueForm()
-    data = Venue.query.filter_by(id=venue_id).first()
+    with using_shard(venue_shard(venue_id)):
+        data = queries.venue_by_id(venue_id)
     if data is None:
         abort(404)
+    return edit_venue_page(data)
+
+
+def edit_venue_page(data, form=None):
+    # As edit_artist_page.
     venue = {
         "id": data.id,
         "name": data.name,
@@ -404,42 +688,57 @@ def edit_venue(venue_id):
         "facebook_link": data.facebook_link,
         "seeking_talent": data.seeking_talent,
         "seeking_description": data.seeking_description,
-        "image_link": data.image_link
+        "image_link": data.image_link,
+        "version": data.version,
+        "original": dump_original(entity_values(data, VENUE_FIELDS))
     }
-    form.name.data = data.name
-    form.genres.data = data.genres
-    form.address.data = data.address
-    form.city.data = data.city
-    form.state.data = data.state
-    form.phone.data = data.phone
-    form.website_link.data = data.website_link
-    form.facebook_link.data = data.facebook_link
-    form.seeking_talent.data = data.seeking_talent
-    form.seeking_description.data = data.seeking_description
-    form.image_link.data = data.image_link
+    if form is None:
+        form = VenueForm()
+        form.name.data = data.name
+        form.genres.data = sorted(split_genres(data.genres))
+        form.address.data = data.address
+        form.city.data = data.city
+        form.state.data = data.state
+        form.phone.data = data.phone
+        form.website_link.data = data.website_link
+        form.facebook_link.data = data.facebook_link
+        form.seeking_talent.data = data.seeking_talent
+        form.seeking_description.data = data.seeking_description
+        form.image_link.data = data.image_link
     return render_template('forms/edit_venue.html', form=form, venue=venue)
 
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
 def edit_venue_submission(venue_id):
     error = False
-    seeking_talent = False
-    if request.form.get('seeking_talent', 'n') == 'y':
-        seeking_talent = True
+    submitted = form_values(request.form, VENUE_FIELDS)
+    changes = changed_values(submitted, load_original(request.form.get('original')))
+    venue = SimpleNamespace(id=venue_id, **submitted)
+    if any(field in changes for field in LOCATION_FIELDS):
+        geocode_venue(geocoder, venue)
+        changes.update(latitude=venue.latitude, longitude=venue.longitude, geohash=venue.geohash)
     try:
-        venue = Venue.query.filter_by(id=venue_id).first()
-        venue.name = request.form.get('name', '')
-        venue.genres = request.form.get('genres', '')
-        venue.address = request.form.get('address', '')
-        venue.city = request.form.get('city', '')
-        venue.state = request.form.get('state', '')
-        venue.phone = request.form.get('phone', '')
-        venue.website_link = request.form.get('website_link', '')
-        venue.facebook_link = request.form.get('facebook_link', '')
-        venue.seeking_talent = seeking_talent
-        venue.seeking_description = request.form.get('seeking_description', '')
-        venue.image_link = request.form.get('image_link', '')
-        db.session.commit()
+        # A venue stays on the shard it was created on; the directory, not
+        # its state, says where it is.
+        with using_shard(venue_shard(venue_id)):
+            apply_patch(Venue, venue_id, request.form.get('version', 0, type=int), changes)
+            if changes:
+                log_change('venue', venue_id)
+            db.session.commit()
+        if changes:
+            matcher.update_venue(venue)
+            search_cache.invalidate('venues', venue.id, venue.name)
+            feed_cache.invalidate('venue', venue.id)
+            enqueue_profile_jobs('venue', venue)
+    except NotFound:
+        abort(404)
+    except VersionConflict:
+        flash('Venue ' + request.form['name'] + ' was changed by someone else. Review the latest version and try again.')
+        with using_shard(venue_shard(venue_id)):
+            data = queries.venue_by_id(venue_id)
+        if data is None:
+            abort(404)
+        return edit_venue_page(data, VenueForm(request.form)), 409
     except:
         db.session.rollback()
         error = True
@@ -485,7 +784,14 @@ def create_artist_submission():
         )
         form.populate_obj(artist)
         db.session.add(artist)
+        db.session.flush()
+        log_change('artist', artist.id)
         db.session.commit()
+        matcher.update_artist(artist)
+        search_cache.invalidate('artists', artist.id, artist.name)
+        feed_cache.invalidate('artist', artist.id, sitemap=True)
+        enqueue_profile_jobs('artist', artist)
+        publish('artist', id=artist.id, name=artist.name, city=artist.city, state=artist.state)
     except ValueError as e:
         print(e)
         db.session.rollback()
@@ -504,20 +810,44 @@ def create_artist_submission():
 
 @app.route('/shows')
 def shows():
-    show_all = Show.query.order_by(Show.start_time.asc()).all()
     data = []
-    for show in show_all:
+    for row in hot_shows():
         data.append({
-            "venue_id": show.venue_id,
-            "venue_name": show.venue.name,
-            "artist_id": show.artist_id,
-            "artist_name": show.artist.name,
-            "artist_image_link": show.artist.image_link,
-            "start_time": format_datetime(str(show.start_time))
+            "id": row[0],
+            "venue_id": row[2],
+            "venue_name": row[3],
+            "venue_version": row[4],
+            "artist_id": row[5],
+            "artist_name": row[6],
+            "artist_image_link": row[7],
+            "artist_version": row[8],
+            "start_time": format_datetime(str(row[1]))
         })
     return render_template('pages/shows.html', shows=data)
 
 
+@app.route('/shows/archive')
+def archived_shows():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = app.config['ARCHIVED_SHOWS_PER_PAGE']
+    rows, total = archived_shows_page(page, per_page)
+    data = []
+    for row in rows:
+        data.append({
+            "id": row[0],
+            "venue_id": row[2],
+            "venue_name": row[3],
+            "venue_version": row[4],
+            "artist_id": row[5],
+            "artist_name": row[6],
+            "artist_image_link": row[7],
+            "artist_version": row[8],
+            "start_time": format_datetime(str(row[1]))
+        })
+    return render_template('pages/shows.html', shows=data, archive=True, page=page,
+                           pages=max(-(-total // per_page), 1))
+
+
 @app.route('/shows/create')
 def create_shows():
     # renders form. do not touch.
@@ -530,14 +860,30 @@ def create_show_submission():
     form = ShowForm(request.form)
     error = False
     try:
-        show = Show(start_time=request.form.get('start_time', datetime.now()))
-        artist = Artist.query.filter_by(id=request.form.get('artist_id', '')).first()
-        venue = Venue.query.filter_by(id=request.form.get('venue_id', '')).first()
-        show.artist = artist
-        show.venue = venue
-        form.populate_obj(show)
-        db.session.add(show)
-        db.session.commit()
+        # The show is stored on the venue's shard, next to a copy of the
+        # artist; both writes commit in the same shard transaction.
+        shard = venue_shard(request.form.get('venue_id', type=int))
+        copy_artist(request.form.get('artist_id', type=int), shard)
+        with using_shard(shard):
+            show = Show(start_time=request.form.get('start_time', datetime.now()))
+            artist = queries.artist_by_id(request.form.get('artist_id', type=int))
+            venue = queries.venue_by_id(request.form.get('venue_id', type=int))
+            show.artist = artist
+            show.venue = venue
+            form.populate_obj(show)
+            db.session.add(show)
+            db.session.flush()
+            log_change('venue', show.venue_id)
+            log_change('artist', show.artist_id)
+            db.session.commit()
+            matcher.record_show(show.artist_id, show.venue_id)
+            # Only the upcoming show counts of these two entities changed.
+            search_cache.invalidate('venues', show.venue_id)
+            search_cache.invalidate('artists', show.artist_id)
+            feed_cache.invalidate('venue', show.venue_id)
+            feed_cache.invalidate('artist', show.artist_id)
+            publish('show', id=show.id, venue_id=show.venue_id, artist_id=show.artist_id,
+                    venue_name=venue.name, artist_name=artist.name, start_time=show.start_time)
     except ValueError as e:
         print(e)
         db.session.rollback()
@@ -551,31 +897,116 @@ def create_show_submission():
     return render_template('pages/home.html')
 
 
+@app.route('/shows/tour', methods=['GET'])
+def create_tour_form():
+    form = TourForm()
+    return render_template('forms/new_tour.html', form=form, rows=[])
+
+
+@app.route('/shows/tour', methods=['POST'])
+def create_tour_submission():
+    form = TourForm(request.form)
+    artist_id = request.form.get('artist_id', type=int)
+    rows = parse_lines(request.form.get('shows', ''))
+    error = None
+    created = 0
+    try:
+        if artist_id is None:
+            raise ValueError('An artist ID is required.')
+        if not rows or len(rows) > app.config['TOUR_MAX_SHOWS']:
+            raise ValueError('A tour needs between 1 and {} shows.'.format(app.config['TOUR_MAX_SHOWS']))
+        created = book_tour(artist_id, rows)
+    except ValueError as e:
+        db.session.rollback()
+        error = str(e)
+    finally:
+        db.session.close()
+    if not created:
+        flash(error or 'The tour was not booked. Fix the marked lines and try again.')
+        return render_template('forms/new_tour.html', form=form, rows=rows), 400
+    record_tour(artist_id, rows)
+    flash('Booked {} shows.'.format(created))
+    return redirect(url_for('show_artist', artist_id=artist_id))
+
+
+#  Images
+#  ----------------------------------------------------------------
+
+@app.route('/images/<kind>/<int:entity_id>/<size>')
+def thumbnail(kind, entity_id, size):
+    model = {'venue': Venue, 'artist': Artist}.get(kind)
+    if model is None or size not in app.config['THUMBNAIL_SIZES']:
+        abort(404)
+    with using_shard(venue_shard(entity_id) if kind == 'venue' else None):
+        image_link = model.query.with_entities(model.image_link).filter_by(id=entity_id).scalar()
+    if not image_link:
+        abort(404)
+    fmt = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    try:
+        path = thumbnail_cache.get(image_link, size, fmt)
+    except FetchError as e:
+        app.logger.warning('Thumbnail for %s failed: %s', image_link, e)
+        return redirect(image_link)
+    versioned = request.args.get('v') == url_digest(image_link)[:10]
+    response = send_file(path, mimetype=FORMATS[fmt][1], conditional=True,
+                         max_age=app.config['THUMBNAIL_MAX_AGE'] if versioned else 300)
+    response.vary.add('Accept')
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+@app.cli.command('geocode')
+def geocode_command():
+    # Fill in coordinates for every venue from the local lookup file.
+    found = total = 0
+    for shard in shard_names():
+        with using_shard(shard):
+            venue_all = Venue.query.all()
+            for venue in venue_all:
+                if geocode_venue(geocoder, venue):
+                    found += 1
+            db.session.commit()
+            total += len(venue_all)
+    print('Geocoded {} of {} venues.'.format(found, total))
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+@app.errorhandler(429)
+def rate_limited_error(error):
+    response = make_response(render_template('errors/429.html'), 429)
+    response.retry_after = error.retry_after
+    return response
+
+
 @app.errorhandler(500)
 def server_error(error):
     return render_template('errors/500.html'), 500
 
 
+init_request_logging(app)
+init_capture(app)
+init_slow_query_log(app)
+init_statement_stats(app)
+init_profiling(app)
+init_rate_limiter(app)
+init_events(app)
 if not app.debug:
-    file_handler = FileHandler('error.log')
-    file_handler.setFormatter(
-        Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
-    )
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+    # File I/O happens on the listener thread, never on a request thread.
+    init_logging(app)
     app.logger.info('errors')
 
 # ----------------------------------------------------------------------------#
 # Launch.
 # ----------------------------------------------------------------------------#
 
-db.create_all()
+with app.app_context():
+    db.create_all()
 
 # Default port:
 if __name__ == '__main__':
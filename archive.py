@@ -0,0 +1,194 @@
+import heapq
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Venue, Artist, Show, ShowArchive
+from sharding import scatter, shard_names, using_shard
+from queries import UPCOMING_SHOWS
+from venue_shards import venue_shard
+
+# ----------------------------------------------------------------------------#
+# Show archival.
+# ----------------------------------------------------------------------------#
+#
+# `shows` only holds upcoming and recently finished shows; anything older
+# than SHOW_ARCHIVE_AFTER_DAYS is moved to `shows_archive`. Upcoming-show
+# queries therefore only read the small hot table, while past-show history
+# is a paginated UNION ALL over both.
+
+COUNTERPART = {
+    'venue': (Show.venue_id, ShowArchive.venue_id, Artist, 'artist_id'),
+    'artist': (Show.artist_id, ShowArchive.artist_id, Venue, 'venue_id'),
+}
+
+
+def all_shows(*names):
+    # Current and archived shows as one subquery on the current shard (the
+    # archive keeps the shows' ids). Filters on it reach both tables.
+    names = names or ('id', 'artist_id', 'venue_id', 'start_time')
+    return db.union_all(
+        db.select(*[getattr(Show, n) for n in names]),
+        db.select(*[getattr(ShowArchive, n) for n in names])
+    ).subquery('shows_all')
+
+
+def archive_partitioned():
+    # Only a partitioned shows_archive can take yearly partitions. One made
+    # by an older create_all is a plain table: the job still archives into
+    # it, but warns so it can be converted.
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return False
+    partitioned = db.session.execute(db.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('shows_archive'))"
+    )).scalar()
+    if not partitioned:
+        current_app.logger.warning('shows_archive on %s is not partitioned; no yearly partitions created',
+                                   bind.url.render_as_string(hide_password=True))
+    return partitioned
+
+
+def ensure_partitions(years):
+    for year in sorted(years):
+        db.session.execute(db.text(
+            "CREATE TABLE IF NOT EXISTS shows_archive_{year} PARTITION OF shows_archive "
+            "FOR VALUES FROM ('{year}-01-01') TO ('{next}-01-01')".format(year=year, next=year + 1)
+        ))
+
+
+def archive_shows(cutoff, batch_size):
+    # Oldest first, one short transaction per batch, one shard at a time.
+    moved = 0
+    for shard in shard_names():
+        with using_shard(shard):
+            moved += archive_shard(cutoff, batch_size)
+    return moved
+
+
+def archive_shard(cutoff, batch_size):
+    moved = 0
+    partitioned = archive_partitioned()
+    while True:
+        batch = db.session.execute(
+            db.select(Show.id, Show.start_time).where(Show.start_time < cutoff)
+            .order_by(Show.start_time).limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        ids = [row.id for row in batch]
+        if partitioned:
+            ensure_partitions({row.start_time.year for row in batch})
+        db.session.execute(db.insert(ShowArchive).from_select(
+            ['id', 'start_time', 'artist_id', 'venue_id', 'archived_at'],
+            db.select(Show.id, Show.start_time, Show.artist_id, Show.venue_id,
+                      db.literal(datetime.now(), db.DateTime)).where(Show.id.in_(ids))
+        ))
+        db.session.execute(
+            db.delete(Show).where(Show.id.in_(ids)).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        moved += len(ids)
+    return moved
+
+
+def archive_cutoff():
+    return datetime.now() - timedelta(days=current_app.config['SHOW_ARCHIVE_AFTER_DAYS'])
+
+
+def shards_for(kind, entity_id):
+    # A venue's shows are all on its shard; an artist's can be on any.
+    return [venue_shard(entity_id)] if kind == 'venue' else shard_names()
+
+
+def gather_page(queries, shards, key, page, per_page):
+    # queries(limit, offset) -> (count statement, rows statement). With one
+    # shard the page is cut by the database; with several, each shard
+    # returns its first page * per_page rows, newest first, and they are
+    # merged here.
+    offset = (page - 1) * per_page
+    if len(shards) == 1:
+        count_query, rows_query = queries(per_page, offset)
+    else:
+        count_query, rows_query = queries(offset + per_page, 0)
+    results = scatter(lambda conn: (conn.execute(count_query).scalar(), conn.execute(rows_query).all()), shards)
+    total = sum(count for _, (count, _) in results)
+    if len(shards) == 1:
+        return results[0][1][1], total
+    merged = heapq.merge(*[rows for _, (_, rows) in results], key=key, reverse=True)
+    return list(merged)[offset:offset + per_page], total
+
+
+def upcoming_shows(kind, entity_id, now):
+    params = {"entity_id": entity_id, "now": now}
+    results = scatter(lambda conn: conn.execute(UPCOMING_SHOWS[kind], params).all(), shards_for(kind, entity_id))
+    return list(heapq.merge(*[rows for _, rows in results], key=lambda row: row.start_time))
+
+
+def past_shows_page(kind, entity_id, now, page, per_page):
+    # Returns (rows, total) for one page of past shows, newest first.
+    hot_fk, cold_fk, other, other_fk = COUNTERPART[kind]
+    history = db.union_all(
+        db.select(getattr(Show, other_fk).label('other_id'), Show.start_time)
+        .where(hot_fk == entity_id).where(Show.start_time <= now),
+        db.select(getattr(ShowArchive, other_fk).label('other_id'), ShowArchive.start_time)
+        .where(cold_fk == entity_id)
+    ).subquery()
+
+    def queries(limit, offset):
+        return (
+            db.select(db.func.count()).select_from(history),
+            db.select(history.c.other_id, other.name, other.image_link, history.c.start_time)
+            .join(other, other.id == history.c.other_id)
+            .order_by(history.c.start_time.desc())
+            .limit(limit).offset(offset)
+        )
+
+    return gather_page(queries, shards_for(kind, entity_id), lambda row: row.start_time, page, per_page)
+
+
+def hot_shows():
+    # Everything still in `shows`, soonest first.
+    query = db.select(Show.id, Show.start_time, Show.venue_id, Venue.name, Venue.version,
+                      Show.artist_id, Artist.name, Artist.image_link, Artist.version) \
+        .join(Venue, Venue.id == Show.venue_id) \
+        .join(Artist, Artist.id == Show.artist_id) \
+        .order_by(Show.start_time)
+    results = scatter(lambda conn: conn.execute(query).all())
+    return list(heapq.merge(*[rows for _, rows in results], key=lambda row: row.start_time))
+
+
+def archived_shows_page(page, per_page):
+    def queries(limit, offset):
+        return (
+            db.select(db.func.count()).select_from(ShowArchive),
+            db.select(ShowArchive.id, ShowArchive.start_time, ShowArchive.venue_id, Venue.name,
+                      Venue.version, ShowArchive.artist_id, Artist.name, Artist.image_link, Artist.version)
+            .join(Venue, Venue.id == ShowArchive.venue_id)
+            .join(Artist, Artist.id == ShowArchive.artist_id)
+            .order_by(ShowArchive.start_time.desc())
+            .limit(limit).offset(offset)
+        )
+
+    return gather_page(queries, shard_names(), lambda row: row.start_time, page, per_page)
+
+
+# ----------------------------------------------------------------------------#
+# CLI.
+# ----------------------------------------------------------------------------#
+
+shows_cli = AppGroup('shows', help='Maintain the show archive.')
+
+
+@shows_cli.command('archive')
+@click.option('--schedule', is_flag=True, help='Queue the recurring archive job instead of running now.')
+def archive_command(schedule):
+    if schedule:
+        from tasks import schedule_archive
+        job = schedule_archive(delay=0)
+        click.echo('Queued archive job {}'.format(job.id))
+        return
+    moved = archive_shows(archive_cutoff(), current_app.config['SHOW_ARCHIVE_BATCH_SIZE'])
+    click.echo('Archived {} shows.'.format(moved))
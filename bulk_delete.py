@@ -0,0 +1,189 @@
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Venue, Artist, Show, ShowArchive, VenueShard
+from read_model import log_change
+from sharding import shard_names, using_shard
+from venue_shards import venue_shards
+
+# ----------------------------------------------------------------------------#
+# Set-based deletes.
+# ----------------------------------------------------------------------------#
+
+DEFAULT_BATCH_SIZE = 500
+
+MODELS = {
+    'venue': (Venue, Show.venue_id, ShowArchive.venue_id),
+    'artist': (Artist, Show.artist_id, ShowArchive.artist_id),
+}
+
+# The other side of each kind's shows, whose upcoming counts change too.
+COUNTERPARTS = {
+    'venue': ('artist', Show.artist_id),
+    'artist': ('venue', Show.venue_id),
+}
+
+
+def chunks(ids, size):
+    ids = sorted(set(ids))
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def delete_batch(kind, ids):
+    # Venue batches go to the shards that hold them. Artists can have
+    # copies on every shard, so their batches fan out; only the default
+    # database's artist rows are counted.
+    if kind == 'venue':
+        placement = venue_shards(ids).items()
+    else:
+        placement = [(shard, ids) for shard in shard_names()]
+    entities = shows = 0
+    for shard, shard_ids in placement:
+        with using_shard(shard):
+            deleted, show_count = delete_rows(kind, shard_ids)
+        if kind == 'venue' or shard is None:
+            entities += deleted
+        shows += show_count
+    if kind == 'venue':
+        db.session.execute(db.delete(VenueShard).where(VenueShard.id.in_(ids)))
+        db.session.commit()
+    return entities, shows
+
+
+def delete_rows(kind, ids):
+    # Three statements per shard. The show deletes is what ON DELETE CASCADE
+    # would do anyway; issuing it keeps this correct on databases that have
+    # not run the cascade migration yet.
+    model, show_fk, archive_fk = MODELS[kind]
+    other_kind, other_fk = COUNTERPARTS[kind]
+    others = db.session.execute(
+        db.select(other_fk).where(show_fk.in_(ids)).where(Show.start_time > datetime.now()).distinct()
+    ).scalars().all()
+    shows = db.session.execute(
+        db.delete(Show).where(show_fk.in_(ids)).execution_options(synchronize_session=False)
+    ).rowcount
+    shows += db.session.execute(
+        db.delete(ShowArchive).where(archive_fk.in_(ids)).execution_options(synchronize_session=False)
+    ).rowcount
+    entities = db.session.execute(
+        db.delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False)
+    ).rowcount
+    for entity_id in ids:
+        log_change(kind, entity_id, 'delete')
+    for entity_id in others:
+        log_change(other_kind, entity_id)
+    db.session.commit()
+    return entities, shows
+
+
+def delete_ids(kind, ids, batch_size=DEFAULT_BATCH_SIZE, pause=0.0):
+    # Each batch is its own short transaction so locks are released between
+    # batches instead of being held for the whole run.
+    deleted = 0
+    shows = 0
+    for batch in chunks(ids, batch_size):
+        entities, show_count = delete_batch(kind, batch)
+        deleted += entities
+        shows += show_count
+        forget(kind, batch)
+        if pause:
+            time.sleep(pause)
+    return deleted, shows
+
+
+def delete_where(kind, criteria, batch_size=DEFAULT_BATCH_SIZE, pause=0.0):
+    # Walk the matching ids in primary key order, one batch at a time.
+    # Venues are matched on every shard, artists on the default database.
+    model = MODELS[kind][0]
+    deleted = 0
+    shows = 0
+    for shard in shard_names() if kind == 'venue' else [None]:
+        last_id = 0
+        while True:
+            query = db.select(model.id).where(model.id > last_id).order_by(model.id).limit(batch_size)
+            for column, value in criteria.items():
+                query = query.where(getattr(model, column) == value)
+            with using_shard(shard):
+                batch = db.session.execute(query).scalars().all()
+            if not batch:
+                break
+            last_id = batch[-1]
+            entities, show_count = delete_batch(kind, batch)
+            deleted += entities
+            shows += show_count
+            forget(kind, batch)
+            if pause:
+                time.sleep(pause)
+    return deleted, shows
+
+
+def forget(kind, ids):
+    matcher = current_app.extensions.get('matcher')
+    if matcher is not None:
+        for entity_id in ids:
+            matcher.remove(kind, entity_id)
+    search_cache = current_app.extensions.get('search_cache')
+    if search_cache is not None:
+        for entity_id in ids:
+            search_cache.invalidate(kind + 's', entity_id)
+    feed_cache = current_app.extensions.get('feed_cache')
+    if feed_cache is not None:
+        for entity_id in ids:
+            feed_cache.invalidate(kind, entity_id, sitemap=True)
+
+
+def parse_ids(values):
+    ids = []
+    for value in values:
+        for part in str(value).split(','):
+            part = part.strip()
+            if part:
+                ids.append(int(part))
+    return ids
+
+
+# ----------------------------------------------------------------------------#
+# CLI.
+# ----------------------------------------------------------------------------#
+
+delete_cli = AppGroup('delete', help='Bulk delete venues or artists and their shows.')
+
+
+def run_delete(kind, ids, city, state, batch_size, pause, yes):
+    criteria = {k: v for k, v in (('city', city), ('state', state)) if v}
+    if not ids and not criteria:
+        raise click.UsageError('Pass --ids or at least one of --city/--state.')
+    if not yes:
+        click.confirm('Delete matching {}s and all their shows?'.format(kind), abort=True)
+    if ids:
+        deleted, shows = delete_ids(kind, parse_ids(ids), batch_size, pause)
+    else:
+        deleted, shows = delete_where(kind, criteria, batch_size, pause)
+    click.echo('Deleted {} {}s and {} shows.'.format(deleted, kind, shows))
+
+
+@delete_cli.command('venues')
+@click.option('--ids', multiple=True, help='Comma separated ids; may be repeated.')
+@click.option('--city')
+@click.option('--state')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--yes', is_flag=True)
+def delete_venues_command(ids, city, state, batch_size, pause, yes):
+    run_delete('venue', ids, city, state, batch_size, pause, yes)
+
+
+@delete_cli.command('artists')
+@click.option('--ids', multiple=True, help='Comma separated ids; may be repeated.')
+@click.option('--city')
+@click.option('--state')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+@click.option('--pause', default=0.0, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--yes', is_flag=True)
+def delete_artists_command(ids, city, state, batch_size, pause, yes):
+    run_delete('artist', ids, city, state, batch_size, pause, yes)
@@ -0,0 +1,110 @@
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+from flask import g, request
+
+# ----------------------------------------------------------------------------#
+# Traffic capture.
+# ----------------------------------------------------------------------------#
+
+MASK = '***'
+SECRET_FIELDS = re.compile(r'pass|secret|token|csrf|key|auth|session', re.IGNORECASE)
+
+
+def mask_form(form):
+    fields = {}
+    for name in form:
+        values = form.getlist(name)
+        if SECRET_FIELDS.search(name):
+            values = [MASK for _ in values]
+        fields[name] = values if len(values) > 1 else values[0]
+    return fields
+
+
+def mask_query(query_string):
+    pairs = urllib.parse.parse_qsl(query_string, keep_blank_values=True)
+    return urllib.parse.urlencode([(name, MASK if SECRET_FIELDS.search(name) else value)
+                                   for name, value in pairs], safe='*')
+
+
+def mask_json(value):
+    if isinstance(value, dict):
+        return {k: MASK if isinstance(k, str) and SECRET_FIELDS.search(k) else mask_json(v)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [mask_json(v) for v in value]
+    return value
+
+
+class CaptureWriter:
+    # Appends one JSON line per record from a background thread so request
+    # threads never wait on the file. Each line is a single write() on an
+    # O_APPEND descriptor, which keeps lines from different workers intact.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+
+    def ensure_running(self):
+        # Started lazily so every forked worker gets its own thread.
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.queue = queue.Queue(maxsize=10000)
+                    self.thread = threading.Thread(target=self.run, args=(self.queue,),
+                                                   name='traffic-capture', daemon=True)
+                    self.thread.start()
+                    self.pid = os.getpid()
+
+    def write(self, record):
+        self.ensure_running()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def run(self, records):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        while True:
+            record = records.get()
+            os.write(fd, (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+
+
+def init_capture(app):
+    if not app.config['TRAFFIC_CAPTURE_ENABLED']:
+        return None
+    rate = app.config['TRAFFIC_CAPTURE_SAMPLE_RATE']
+    writer = CaptureWriter(app.config['TRAFFIC_CAPTURE_FILE'])
+
+    @app.before_request
+    def start_capture():
+        g.capture_started = time.perf_counter() if random.random() < rate else None
+
+    @app.after_request
+    def finish_capture(response):
+        started = g.get('capture_started')
+        if started is None or request.path.startswith('/static/'):
+            return response
+        writer.write({
+            "ts": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "query": mask_query(request.query_string.decode('latin-1')),
+            "form": mask_form(request.form) if request.form else None,
+            "json": mask_json(request.get_json(silent=True)) if request.is_json else None,
+            "status": response.status_code,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+        })
+        return response
+
+    return writer
@@ -0,0 +1,292 @@
+import errno
+import json
+import os
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+from flask import Blueprint, Response, current_app, request
+
+# ----------------------------------------------------------------------------#
+# Server-sent events.
+# ----------------------------------------------------------------------------#
+#
+# New shows, venues and artists are announced on /events as small JSON
+# messages once their transaction has committed. Every worker keeps the
+# recent events in one shared ring buffer; a connection only remembers the
+# sequence number it has sent up to, so an idle client costs a thread
+# parked on a condition variable and nothing else.
+#
+# Events reach the other workers through a channel: Postgres
+# LISTEN/NOTIFY, or for a single host, one Unix datagram socket per worker
+# in EVENTS_SOCKET_DIR. A worker hears its own events back through the
+# channel, which keeps the order the same as everyone else's.
+
+events = Blueprint('events', __name__)
+
+CHANNEL = 'fyyur_events'
+
+
+class Broadcaster:
+
+    def __init__(self, buffer_size=1000):
+        self.condition = threading.Condition()
+        self.buffer = deque(maxlen=buffer_size)
+        self.seq = 0
+        self.clients = 0
+
+    def publish(self, event):
+        with self.condition:
+            self.seq += 1
+            self.buffer.append((self.seq, event))
+            self.condition.notify_all()
+
+    def since(self, seq):
+        # Events after seq, oldest first. A client that fell behind the
+        # buffer just misses the ones that were dropped.
+        if seq > self.seq:
+            seq = self.seq
+        return [item for item in self.buffer if item[0] > seq]
+
+    def wait(self, seq, timeout):
+        with self.condition:
+            if self.seq <= seq:
+                self.condition.wait(timeout)
+            return self.since(seq)
+
+
+# Channels
+# ----------------------------------------------------------------
+
+class LocalChannel:
+    # No other workers to tell.
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    def start(self):
+        pass
+
+    def send(self, payload):
+        self.deliver(payload)
+
+
+class SocketChannel:
+    # One datagram socket per worker process; a send goes to every socket
+    # in the directory. Sockets whose process is gone are removed.
+
+    def __init__(self, directory, deliver):
+        self.directory = directory
+        self.deliver = deliver
+        self.sock = None
+        self.path = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, '{}.sock'.format(os.getpid()))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        threading.Thread(target=self.run, name='events-socket', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                time.sleep(1)
+                continue
+            self.deliver(data.decode('utf-8', 'replace'))
+
+    def send(self, payload):
+        data = payload.encode('utf-8')
+        out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # A worker that is not reading just misses the event.
+        out.setblocking(False)
+        try:
+            for name in os.listdir(self.directory):
+                if not name.endswith('.sock'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    out.sendto(data, path)
+                except OSError as e:
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        try:
+                            os.unlink(path)
+                        except FileNotFoundError:
+                            pass
+                    elif e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        raise
+        finally:
+            out.close()
+
+
+class PostgresChannel:
+    # LISTEN on a dedicated connection; NOTIFY from any connection.
+
+    def __init__(self, engine, deliver):
+        self.engine = engine
+        self.deliver = deliver
+
+    def start(self):
+        threading.Thread(target=self.run, name='events-listen', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                time.sleep(1)
+
+    def listen(self):
+        conn = self.engine.raw_connection()
+        try:
+            dbapi = conn.dbapi_connection
+            dbapi.autocommit = True
+            cursor = dbapi.cursor()
+            cursor.execute('LISTEN ' + CHANNEL)
+            while True:
+                if select.select([dbapi], [], [], 60) == ([], [], []):
+                    continue
+                dbapi.poll()
+                while dbapi.notifies:
+                    self.deliver(dbapi.notifies.pop(0).payload)
+        finally:
+            conn.invalidate()
+
+    def send(self, payload):
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql('SELECT pg_notify(%(channel)s, %(payload)s)',
+                                 {"channel": CHANNEL, "payload": payload})
+            conn.commit()
+
+
+class EventHub:
+
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.broadcaster = Broadcaster(config['EVENTS_BUFFER_SIZE'])
+        self.lock = threading.Lock()
+        self.channel = None
+        self.pid = None
+
+    def make_channel(self):
+        kind = self.app.config['EVENTS_CHANNEL']
+        with self.app.app_context():
+            engine = current_app.extensions['sqlalchemy'].engine
+        if kind == 'auto':
+            kind = 'postgres' if engine.dialect.name == 'postgresql' else 'socket'
+        if kind == 'postgres':
+            return PostgresChannel(engine, self.deliver)
+        if kind == 'socket':
+            return SocketChannel(self.app.config['EVENTS_SOCKET_DIR'], self.deliver)
+        return LocalChannel(self.deliver)
+
+    def ensure_started(self):
+        # Per process, so each forked worker gets its own listener.
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.broadcaster = Broadcaster(self.broadcaster.buffer.maxlen)
+                self.channel = self.make_channel()
+                self.channel.start()
+                self.pid = os.getpid()
+
+    def deliver(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        self.broadcaster.publish(event)
+
+    def publish(self, kind, **data):
+        # Call after the commit. A failure here never fails the write.
+        data["type"] = kind
+        try:
+            self.ensure_started()
+            self.channel.send(json.dumps(data, default=str))
+        except Exception:
+            self.app.logger.exception('Could not publish %s event', kind)
+
+
+def publish(kind, **data):
+    hub = current_app.extensions.get('events')
+    if hub is not None:
+        hub.publish(kind, **data)
+
+
+def format_event(seq, event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(seq, event["type"], json.dumps(event, default=str))
+
+
+@events.route('/events')
+def stream():
+    hub = current_app.extensions.get('events')
+    if hub is None:
+        return Response('Events are disabled.\n', 404, mimetype='text/plain')
+    config = current_app.config
+    hub.ensure_started()
+    broadcaster = hub.broadcaster
+    with broadcaster.condition:
+        if broadcaster.clients >= config['EVENTS_MAX_CLIENTS']:
+            response = Response('Too many listeners.\n', 503, mimetype='text/plain')
+            response.retry_after = config['EVENTS_RETRY_SECONDS']
+            return response
+        broadcaster.clients += 1
+    released = []
+
+    def release():
+        # From the generator's finally or the response's close, whichever
+        # comes first; a body that is never read (HEAD, say) only closes.
+        with broadcaster.condition:
+            if not released:
+                released.append(True)
+                broadcaster.clients -= 1
+
+    types = set(filter(None, request.args.get('types', '').split(','))) or None
+    # Last-Event-ID is a sequence number of this worker's buffer; after a
+    # reconnect to another worker it only means "start from now".
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    seq = broadcaster.seq if last_id is None else last_id
+    heartbeat = config['EVENTS_HEARTBEAT_SECONDS']
+    # Connections are closed after a while so workers can be recycled;
+    # EventSource reconnects on its own.
+    deadline = time.monotonic() + config['EVENTS_MAX_SECONDS']
+
+    def generate(seq):
+        try:
+            yield 'retry: {}\n\n'.format(config['EVENTS_RETRY_SECONDS'] * 1000)
+            while time.monotonic() < deadline:
+                items = broadcaster.wait(seq, heartbeat)
+                if not items:
+                    yield ': keep-alive\n\n'
+                    continue
+                chunk = []
+                for seq, event in items:
+                    if types is None or event["type"] in types:
+                        chunk.append(format_event(seq, event))
+                if chunk:
+                    yield ''.join(chunk)
+        finally:
+            release()
+
+    response = Response(generate(seq), mimetype='text/event-stream')
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def init_events(app):
+    if not app.config['EVENTS_ENABLED']:
+        return None
+    hub = EventHub(app)
+    app.extensions['events'] = hub
+    app.register_blueprint(events)
+    return hub
@@ -6,13 +6,27 @@ from fabric.contrib.console import confirm
 
 def test():
     with settings(warn_only=True):
-        result = local(
-            "python test_tasks.py -v && python test_users.py -v", capture=True
-        )
+        result = local("python -m unittest discover -s tests -v", capture=True)
     if result.failed and not confirm("Tests failed. Continue?"):
         abort("Aborted at user request.")
 
 
+def perf_gate(tolerance='0.25', sql_tolerance='0', baseline='perf/baseline.json'):
+    # Benchmarks the hot routes on a synthetic SQLite dataset against the
+    # committed baseline, e.g. fab perf_gate:tolerance=0.1
+    with settings(warn_only=True):
+        result = local(
+            "python perf_gate.py gate {} --tolerance {} --sql-tolerance {}".format(
+                baseline, tolerance, sql_tolerance)
+        )
+    if result.failed:
+        abort("Hot routes regressed against {}.".format(baseline))
+
+
+def perf_baseline(baseline='perf/baseline.json'):
+    local("python perf_gate.py run --out {}".format(baseline))
+
+
 def commit():
     message = raw_input("Enter a git commit message: ")
     local("git add . && git commit -am '{}'".format(message))
@@ -39,14 +53,13 @@ def heroku():
 
 
 def heroku_test():
-    local(
-        "heroku run python test_tasks.py -v && heroku run python test_users.py -v"
-    )
+    local("heroku run python -m unittest discover -s tests -v")
 
 
-def deploy():
+def deploy(tolerance='0.25'):
     pull()
     test()
+    perf_gate(tolerance)
     commit()
     heroku()
     heroku_test()
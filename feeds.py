@@ -0,0 +1,345 @@
+import hashlib
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from archive import all_shows
+from models import db, Venue, Artist
+from sharding import scatter, shard_names, using_shard
+from venue_shards import venue_shard
+
+# ----------------------------------------------------------------------------#
+# Sitemap and calendar feeds.
+# ----------------------------------------------------------------------------#
+#
+# /sitemap.xml is an index of sitemap files, one per SITEMAP_PART_SIZE ids
+# of venues or artists. /venues/<id>/calendar.ics and
+# /artists/<id>/calendar.ics list an entity's shows from FEED_PAST_DAYS ago
+# onwards. Bodies are streamed from server-side cursors, so no feed is ever
+# held as ORM objects, and kept per worker in FeedCache.
+#
+# A cached feed is served without SQL for FEED_CACHE_TTL seconds. After
+# that, small aggregate queries fingerprint what it was built from: if that is
+# unchanged the feed is kept, otherwise it is rebuilt. Writes drop the
+# feeds they touch straight away, and other workers drop them when the read
+# model applies the change log. The ETag is the fingerprint, so a repeat
+# poll gets a 304 whether or not the body is cached.
+
+feeds = Blueprint('feeds', __name__)
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+class FeedCache:
+
+    def __init__(self, max_entries=2000, ttl=300, part_size=10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.part_size = part_size
+        self.lock = threading.Lock()
+        # key -> [checked_at, fingerprint, etag, body]
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def fresh(self, entry):
+        return time.monotonic() - entry[0] < self.ttl
+
+    def touch(self, entry):
+        with self.lock:
+            entry[0] = time.monotonic()
+
+    def put(self, key, fingerprint, etag, body):
+        with self.lock:
+            self.entries[key] = [time.monotonic(), fingerprint, etag, body]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, kind, entity_id, sitemap=False):
+        # kind is 'venue' or 'artist'. Drops the entity's calendar, and with
+        # sitemap=True (it was created or deleted) its sitemap file and the
+        # index too.
+        with self.lock:
+            stale = [key for key in self.entries
+                     if key[1:] == ('calendar', kind, entity_id)
+                     or (sitemap and key[1:] in (('sitemap', kind, entity_id // self.part_size),
+                                                 ('sitemap-index',)))]
+            for key in stale:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": sum(len(e[3]) for e in self.entries.values()),
+                    "hits": self.hits, "misses": self.misses}
+
+
+def etag_for(fingerprint):
+    return hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()[:20]
+
+
+def stream_rows(engines, size, query, shards, key=None):
+    # Rows of query from each shard through server-side cursors, merged on
+    # key when there is more than one shard. Needs no app context, so it can
+    # run while the response is being sent.
+    conns = []
+    try:
+        streams = []
+        for shard in shards:
+            conn = engines[shard].connect()
+            conns.append(conn)
+            streams.append(conn.execution_options(stream_results=True, yield_per=size).execute(query))
+        if len(streams) == 1:
+            yield from streams[0]
+        else:
+            yield from heapq.merge(*streams, key=key)
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def cached_feed(key, fingerprint, generate, mimetype):
+    # fingerprint() returns None when the entity does not exist;
+    # generate(fingerprint) yields str chunks.
+    cache = current_app.extensions['feed_cache']
+    entry = cache.get(key)
+    if entry is not None and cache.fresh(entry):
+        cache.hits += 1
+        return feed_response(entry[2], entry[3], mimetype)
+    current = fingerprint()
+    if current is None:
+        abort(404)
+    if entry is not None and entry[1] == current:
+        cache.touch(entry)
+        cache.hits += 1
+        return feed_response(entry[2], entry[3], mimetype)
+    cache.misses += 1
+    etag = etag_for((key[1:], current))
+    if etag in request.if_none_match:
+        return feed_response(etag, None, mimetype)
+
+    kept = []
+
+    def body(chunks):
+        for chunk in chunks:
+            chunk = chunk.encode('utf-8')
+            kept.append(chunk)
+            yield chunk
+        # Only a body that was generated to the end is kept.
+        cache.put(key, current, etag, b''.join(kept))
+
+    return feed_response(etag, body(generate(current)), mimetype)
+
+
+def feed_response(etag, body, mimetype):
+    if body is not None and etag in request.if_none_match:
+        body = None
+    response = Response(body if body is not None else b'', 304 if body is None else 200, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['FEED_MAX_AGE']
+    response.cache_control.must_revalidate = True
+    return response
+
+
+# Sitemaps
+# ----------------------------------------------------------------
+
+SITEMAP_KINDS = {'venues': Venue, 'artists': Artist}
+
+
+def sitemap_shards(kind):
+    return shard_names() if kind == 'venues' else [None]
+
+
+def max_ids():
+    venue_query = db.select(db.func.max(Venue.id))
+    venues = max([result or 0 for _, result in scatter(lambda conn: conn.execute(venue_query).scalar())])
+    artists = db.session.execute(db.select(db.func.max(Artist.id))).scalar() or 0
+    return venues, artists
+
+
+@feeds.route('/sitemap.xml')
+def sitemap_index():
+    size = current_app.extensions['feed_cache'].part_size
+    root = request.host_url
+
+    def fingerprint():
+        return max_ids(), size
+
+    def generate(current):
+        venues, artists = current[0]
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{}">\n'.format(SITEMAP_NS)
+        yield '<sitemap><loc>{}sitemaps/pages.xml</loc></sitemap>\n'.format(escape(root))
+        for kind, max_id in (('venues', venues), ('artists', artists)):
+            for part in range(max_id // size + 1 if max_id else 0):
+                yield '<sitemap><loc>{}sitemaps/{}-{}.xml</loc></sitemap>\n'.format(escape(root), kind, part)
+        yield '</sitemapindex>\n'
+
+    return cached_feed((root, 'sitemap-index'), fingerprint, generate, 'application/xml')
+
+
+@feeds.route('/sitemaps/pages.xml')
+def sitemap_pages():
+    urls = ''.join('<url><loc>{}{}</loc></url>\n'.format(escape(request.host_url), path)
+                   for path in ('', 'venues', 'artists', 'shows'))
+    body = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{}">\n{}</urlset>\n'.format(SITEMAP_NS, urls)
+    return feed_response(etag_for(body), body, 'application/xml')
+
+
+@feeds.route('/sitemaps/<any(venues, artists):kind>-<int:part>.xml')
+def sitemap_part(kind, part):
+    model = SITEMAP_KINDS[kind]
+    size = current_app.extensions['feed_cache'].part_size
+    root = request.host_url
+    in_part = db.and_(model.id >= part * size, model.id < (part + 1) * size)
+    shards = sitemap_shards(kind)
+
+    def fingerprint():
+        # The id set decides the file: its count and sum change with any
+        # insert or delete in the range.
+        query = db.select(db.func.count(model.id), db.func.sum(model.id)).where(in_part)
+        stats = [tuple(result) for _, result in scatter(lambda conn: conn.execute(query).one(), shards)]
+        if part > 0 and not any(count for count, _ in stats):
+            return None
+        return stats
+
+    engines = current_app.extensions['sqlalchemy'].engines
+    size = current_app.config['FEED_FETCH_SIZE']
+
+    def generate(current):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{}">\n'.format(SITEMAP_NS)
+        query = db.select(model.id).where(in_part).order_by(model.id)
+        for row in stream_rows(engines, size, query, shards, key=lambda row: row.id):
+            yield '<url><loc>{}{}/{}</loc></url>\n'.format(escape(root), kind, row.id)
+        yield '</urlset>\n'
+
+    return cached_feed((root, 'sitemap', kind[:-1], part), fingerprint, generate, 'application/xml')
+
+
+# Calendars
+# ----------------------------------------------------------------
+
+def ical_text(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def ical_line(line):
+    # Lines longer than 75 octets are folded onto continuation lines.
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts = []
+    while data:
+        cut = 75 if not parts else 74
+        # Never split a multi-byte character.
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def ical_time(value):
+    # Show times are naive local time, written as floating times.
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def calendar_query(kind, entity_id, since):
+    # Archived shows too, for a FEED_PAST_DAYS longer than
+    # SHOW_ARCHIVE_AFTER_DAYS.
+    shows = all_shows()
+    fk = shows.c.venue_id if kind == 'venue' else shows.c.artist_id
+    return db.select(shows.c.id, shows.c.venue_id, shows.c.artist_id, shows.c.start_time,
+                     Venue.name.label('venue_name'), Venue.address, Venue.city, Venue.state,
+                     Artist.name.label('artist_name')) \
+        .join(Venue, Venue.id == shows.c.venue_id) \
+        .join(Artist, Artist.id == shows.c.artist_id) \
+        .where(fk == entity_id).where(shows.c.start_time >= since).order_by(shows.c.start_time, shows.c.id)
+
+
+def calendar_fingerprint(kind, entity_id, since, shards):
+    # Versions of the entity and of everything on its shows (renames), and
+    # the shows' count and newest id (added or deleted shows).
+    shows = all_shows()
+    model, fk, other, other_fk = (Venue, shows.c.venue_id, Artist, shows.c.artist_id) if kind == 'venue' \
+        else (Artist, shows.c.artist_id, Venue, shows.c.venue_id)
+    version = db.session.execute(db.select(model.version).where(model.id == entity_id)).scalar()
+    if version is None:
+        return None
+    query = db.select(db.func.count(shows.c.id), db.func.max(shows.c.id), db.func.sum(other.version)) \
+        .join(other, other.id == other_fk).where(fk == entity_id).where(shows.c.start_time >= since)
+    return version, since.date(), [tuple(result) for _, result in scatter(lambda conn: conn.execute(query).one(), shards)]
+
+
+def calendar(kind, entity_id):
+    config = current_app.config
+    # Whole days, so the fingerprint only moves at midnight.
+    since = datetime.combine(datetime.now().date() - timedelta(days=config['FEED_PAST_DAYS']), datetime.min.time())
+    duration = config['FEED_SHOW_HOURS']
+    root = request.host_url
+    host = request.host
+    engines = current_app.extensions['sqlalchemy'].engines
+    size = config['FEED_FETCH_SIZE']
+    shards = []
+
+    def fingerprint():
+        # A venue row lives on its shard, an artist on the default database.
+        shards.extend([venue_shard(entity_id)] if kind == 'venue' else shard_names())
+        with using_shard(shards[0] if kind == 'venue' else None):
+            return calendar_fingerprint(kind, entity_id, since, shards)
+
+    def generate(current):
+        yield ical_line('BEGIN:VCALENDAR')
+        yield ical_line('VERSION:2.0')
+        yield ical_line('PRODID:-//Fyyur//Shows//EN')
+        yield ical_line('CALSCALE:GREGORIAN')
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        query = calendar_query(kind, entity_id, since)
+        for row in stream_rows(engines, size, query, shards, key=lambda row: (row.start_time, row.venue_id, row.id)):
+            # Show ids are per shard; with the venue id they are unique.
+            lines = [
+                'BEGIN:VEVENT',
+                'UID:show-{}-{}@{}'.format(row.venue_id, row.id, host),
+                'DTSTAMP:' + stamp,
+                'DTSTART:' + ical_time(row.start_time),
+                'DURATION:PT{}H'.format(duration),
+                'SUMMARY:' + ical_text('{} at {}'.format(row.artist_name, row.venue_name)),
+                'LOCATION:' + ical_text(', '.join(filter(None, (row.venue_name, row.address, row.city, row.state)))),
+                'URL:{}venues/{}'.format(root, row.venue_id),
+                'END:VEVENT',
+            ]
+            yield ''.join(ical_line(line) for line in lines)
+        yield ical_line('END:VCALENDAR')
+
+    return cached_feed((root, 'calendar', kind, entity_id), fingerprint, generate, 'text/calendar')
+
+
+@feeds.route('/venues/<int:venue_id>/calendar.ics')
+def venue_calendar(venue_id):
+    return calendar('venue', venue_id)
+
+
+@feeds.route('/artists/<int:artist_id>/calendar.ics')
+def artist_calendar(artist_id):
+    return calendar('artist', artist_id)
+
+
+def init_feeds(app):
+    cache = FeedCache(app.config['FEED_CACHE_SIZE'], app.config['FEED_CACHE_TTL'], app.config['SITEMAP_PART_SIZE'])
+    app.extensions['feed_cache'] = cache
+    app.register_blueprint(feeds)
+    return cache
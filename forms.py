@@ -1,7 +1,7 @@
 import re
 from datetime import datetime
-from flask_wtf import Form
-from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField
+from flask_wtf import FlaskForm, Form
+from wtforms import StringField, SelectField, SelectMultipleField, DateTimeField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired, AnyOf, URL, ValidationError
 
 
@@ -26,6 +26,15 @@ class ShowForm(Form):
     )
 
 
+class TourForm(Form):
+    artist_id = StringField(
+        'artist_id', validators=[DataRequired()]
+    )
+    shows = TextAreaField(
+        'shows', validators=[DataRequired()]
+    )
+
+
 class VenueForm(Form):
     name = StringField(
         'name', validators=[DataRequired()]
@@ -246,3 +255,9 @@ class ArtistForm(Form):
     seeking_description = StringField(
         'seeking_description'
     )
+
+
+class DeleteForm(FlaskForm):
+    # Only the CSRF token: deleting a venue or an artist is a POST from the
+    # confirmation page.
+    pass
@@ -0,0 +1,136 @@
+import csv
+import math
+
+# ----------------------------------------------------------------------------#
+# Geohash grid.
+# ----------------------------------------------------------------------------#
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    # (height, width) of a geohash cell in degrees
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = (5 * precision) // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def precision_for_radius(lat, radius_km):
+    # Largest precision whose cells are still at least `radius_km` on each
+    # side, so the centre cell plus its eight neighbours cover the circle.
+    radius_lat = radius_km / KM_PER_DEGREE
+    radius_lon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        if height >= radius_lat and width >= radius_lon:
+            return precision
+    return 0
+
+
+def covering_cells(lat, lon, radius_km):
+    precision = precision_for_radius(lat, radius_km)
+    if precision == 0:
+        return ['']
+    height, width = cell_size(precision)
+    cells = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_lat = min(max(lat + dlat, -90.0), 90.0)
+            cell_lon = (lon + dlon + 180.0) % 360.0 - 180.0
+            cells.add(geohash_encode(cell_lat, cell_lon, precision))
+    return sorted(cells)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+# ----------------------------------------------------------------------------#
+# Offline geocoding.
+# ----------------------------------------------------------------------------#
+
+def normalize_place(value):
+    return ' '.join((value or '').split()).casefold()
+
+
+class Geocoder:
+    # Resolves venues against a local CSV with the columns
+    # city,state,address,latitude,longitude. Rows with an empty address act
+    # as the city centroid used when no street-level match exists.
+
+    def __init__(self, path):
+        self.path = path
+        self.addresses = {}
+        self.cities = {}
+        self._loaded = False
+
+    def load(self):
+        try:
+            with open(self.path, newline='') as f:
+                for row in csv.DictReader(f):
+                    coords = (float(row['latitude']), float(row['longitude']))
+                    city = normalize_place(row['city'])
+                    state = normalize_place(row['state'])
+                    address = normalize_place(row.get('address'))
+                    if address:
+                        self.addresses[(address, city, state)] = coords
+                    else:
+                        self.cities[(city, state)] = coords
+        except FileNotFoundError:
+            pass
+        self._loaded = True
+
+    def lookup(self, address, city, state):
+        if not self._loaded:
+            self.load()
+        city = normalize_place(city)
+        state = normalize_place(state)
+        coords = self.addresses.get((normalize_place(address), city, state))
+        if coords is None:
+            coords = self.cities.get((city, state))
+        return coords
+
+
+def geocode_venue(geocoder, venue):
+    coords = geocoder.lookup(venue.address, venue.city, venue.state)
+    if coords is None:
+        venue.latitude = None
+        venue.longitude = None
+        venue.geohash = None
+        return False
+    venue.latitude, venue.longitude = coords
+    venue.geohash = geohash_encode(*coords)
+    return True
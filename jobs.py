@@ -0,0 +1,206 @@
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+
+# ----------------------------------------------------------------------------#
+# Database-backed job queue.
+# ----------------------------------------------------------------------------#
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+BACKOFF_BASE = 5
+BACKOFF_MAX = 3600
+
+tasks = {}
+
+
+def task(name):
+    def register(fn):
+        tasks[name] = fn
+        return fn
+    return register
+
+
+def enqueue(name, payload=None, key=None, delay=0, max_attempts=5):
+    # Enqueue in its own transaction. With an idempotency key the first
+    # job for that key wins and later calls return it unchanged.
+    if name not in tasks:
+        raise ValueError('Unknown task ' + name)
+    now = datetime.now()
+    if key is not None:
+        job = Job.query.filter_by(idempotency_key=key).first()
+        if job is not None:
+            return job
+    job = Job(
+        name=name,
+        payload=json.dumps(payload or {}),
+        status=QUEUED,
+        idempotency_key=key,
+        attempts=0,
+        max_attempts=max_attempts,
+        run_at=now + timedelta(seconds=delay),
+        created_at=now,
+        updated_at=now
+    )
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        job = Job.query.filter_by(idempotency_key=key).first()
+    return job
+
+
+def backoff(attempts):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return delay + random.uniform(0, delay / 4)
+
+
+def claim(worker_id):
+    now = datetime.now()
+    candidates = Job.query.with_entities(Job.id).filter(
+        Job.status == QUEUED).filter(Job.run_at <= now).order_by(Job.run_at).limit(10).all()
+    for (job_id,) in candidates:
+        # Compare-and-set so two workers never run the same job.
+        claimed = Job.query.filter_by(id=job_id, status=QUEUED).update({
+            "status": RUNNING,
+            "locked_by": worker_id,
+            "updated_at": now
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def run_job(job):
+    error = None
+    try:
+        tasks[job.name](**json.loads(job.payload))
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+    job.attempts += 1
+    job.updated_at = datetime.now()
+    job.locked_by = None
+    if error is None:
+        job.status = DONE
+        job.last_error = None
+    elif job.attempts >= job.max_attempts:
+        job.status = FAILED
+        job.last_error = error
+    else:
+        job.status = QUEUED
+        job.last_error = error
+        job.run_at = datetime.now() + timedelta(seconds=backoff(job.attempts))
+    db.session.commit()
+    return error is None
+
+
+def work(app, poll_interval=1.0, burst=False):
+    worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    with app.app_context():
+        # Connections inherited from the parent process must not be shared.
+        db.engine.dispose()
+        while True:
+            job = claim(worker_id)
+            if job is None:
+                db.session.remove()
+                if burst:
+                    return
+                time.sleep(poll_interval)
+                continue
+            run_job(job)
+            db.session.remove()
+
+
+def requeue_stale(timeout):
+    # Jobs left running by a worker that died are handed back to the queue.
+    cutoff = datetime.now() - timedelta(seconds=timeout)
+    count = Job.query.filter(Job.status == RUNNING).filter(Job.updated_at < cutoff).update({
+        "status": QUEUED,
+        "locked_by": None
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+# ----------------------------------------------------------------------------#
+# CLI.
+# ----------------------------------------------------------------------------#
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background workers.')
+
+
+@jobs_cli.command('work')
+@click.option('--processes', '-p', default=2, show_default=True)
+@click.option('--poll-interval', default=1.0, show_default=True)
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty.')
+def work_command(processes, poll_interval, burst):
+    from flask import current_app
+    app = current_app._get_current_object()
+    requeue_stale(app.config['JOB_STALE_TIMEOUT'])
+    db.session.remove()
+    db.engine.dispose()
+    pool = []
+    for _ in range(processes):
+        p = multiprocessing.Process(target=work, args=(app, poll_interval, burst))
+        p.start()
+        pool.append(p)
+    try:
+        for p in pool:
+            p.join()
+    except KeyboardInterrupt:
+        for p in pool:
+            p.terminate()
+        sys.exit(1)
+
+
+@jobs_cli.command('list')
+@click.option('--status', default=None)
+@click.option('--limit', default=20, show_default=True)
+def list_command(status, limit):
+    query = Job.query.order_by(Job.id.desc())
+    if status:
+        query = query.filter_by(status=status)
+    for job in query.limit(limit):
+        click.echo('{:>6} {:<8} {:<20} attempts={}/{} run_at={} key={}'.format(
+            job.id, job.status, job.name, job.attempts, job.max_attempts,
+            job.run_at.isoformat(timespec='seconds'), job.idempotency_key or '-'))
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    rows = db.session.query(Job.name, Job.status, db.func.count(Job.id)).group_by(
+        Job.name, Job.status).order_by(Job.name)
+    for name, status, count in rows:
+        click.echo('{:<20} {:<8} {}'.format(name, status, count))
+
+
+@jobs_cli.command('retry')
+@click.argument('job_id', type=int)
+def retry_command(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None:
+        raise click.ClickException('No job {}'.format(job_id))
+    job.status = QUEUED
+    job.attempts = 0
+    job.run_at = datetime.now()
+    job.updated_at = datetime.now()
+    db.session.commit()
+    click.echo('Requeued job {}'.format(job_id))
@@ -0,0 +1,281 @@
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from models import db, Venue, Artist, Show
+from sharding import scatter
+from venue_shards import venue_shards
+
+# ----------------------------------------------------------------------------#
+# Artist / venue matching.
+# ----------------------------------------------------------------------------#
+
+GENRE_WEIGHT = 3.0
+CITY_WEIGHT = 2.0
+STATE_WEIGHT = 0.5
+ACTIVITY_WEIGHT = 1.0
+
+
+def split_genres(value):
+    # Genres are stored as a plain string column; depending on how the row
+    # was written it looks like "Jazz,Rock", "{Jazz,Rock}" or a list.
+    if not value:
+        return frozenset()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = value
+    else:
+        items = value.strip().strip('{}').split(',')
+    return frozenset(g.strip().strip('"') for g in items if g.strip().strip('"'))
+
+
+class Profile:
+    __slots__ = ('id', 'name', 'image_link', 'genres', 'city', 'state', 'seeking')
+
+    def __init__(self, id, name, image_link, genres, city, state, seeking):
+        self.id = id
+        self.name = name
+        self.image_link = image_link
+        self.genres = split_genres(genres)
+        self.city = (city or '').strip().casefold()
+        self.state = (state or '').strip().casefold()
+        self.seeking = bool(seeking)
+
+    def match_key(self):
+        return self.genres, self.city, self.state, self.seeking
+
+
+class Side:
+    # Inverted indexes over the seeking profiles of one entity type.
+
+    def __init__(self):
+        self.profiles = {}
+        self.by_genre = defaultdict(set)
+        self.by_place = defaultdict(set)
+        self.activity = defaultdict(int)
+
+    def add(self, profile):
+        self.profiles[profile.id] = profile
+        if not profile.seeking:
+            return
+        for genre in profile.genres:
+            self.by_genre[genre].add(profile.id)
+        self.by_place[(profile.city, profile.state)].add(profile.id)
+
+    def remove(self, entity_id):
+        profile = self.profiles.pop(entity_id, None)
+        if profile is None:
+            return None
+        for genre in profile.genres:
+            self.by_genre[genre].discard(entity_id)
+        self.by_place[(profile.city, profile.state)].discard(entity_id)
+        return profile
+
+    def candidates(self, profile):
+        ids = set(self.by_place.get((profile.city, profile.state), ()))
+        for genre in profile.genres:
+            ids.update(self.by_genre.get(genre, ()))
+        return ids
+
+
+class MatchEngine:
+
+    def __init__(self, top_k=6, activity_days=90, cache_ttl=300, index_ttl=3600):
+        self.top_k = top_k
+        self.activity_days = activity_days
+        self.cache_ttl = cache_ttl
+        self.index_ttl = index_ttl
+        self.lock = threading.RLock()
+        self.venues = None
+        self.artists = None
+        self.cache = {}
+        self.built_at = 0
+
+    # Index maintenance
+    # ----------------------------------------------------------------
+
+    def queries(self):
+        since = datetime.now() - timedelta(days=self.activity_days)
+        venue_query = db.select(
+            Venue.id, Venue.name, Venue.image_link, Venue.genres,
+            Venue.city, Venue.state, Venue.seeking_talent)
+        artist_query = db.select(
+            Artist.id, Artist.name, Artist.image_link, Artist.genres,
+            Artist.city, Artist.state, Artist.seeking_venue)
+        venue_activity = db.select(Show.venue_id, db.func.count(Show.id)).where(
+            Show.start_time >= since).group_by(Show.venue_id)
+        artist_activity = db.select(Show.artist_id, db.func.count(Show.id)).where(
+            Show.start_time >= since).group_by(Show.artist_id)
+        return venue_query, artist_query, venue_activity, artist_activity
+
+    def build(self):
+        venues = Side()
+        artists = Side()
+        venue_query, artist_query, venue_activity, artist_activity = self.queries()
+        # Venues and show counts come from every shard; an artist booked on
+        # several shards has its counts added up.
+        for _, (venue_rows, venue_counts, artist_counts) in scatter(lambda conn: (
+                conn.execute(venue_query).all(),
+                conn.execute(venue_activity).all(),
+                conn.execute(artist_activity).all())):
+            for row in venue_rows:
+                venues.add(Profile(*row))
+            for venue_id, count in venue_counts:
+                venues.activity[venue_id] = count
+            for artist_id, count in artist_counts:
+                artists.activity[artist_id] += count
+        for row in db.session.execute(artist_query):
+            artists.add(Profile(*row))
+
+        with self.lock:
+            self.venues = venues
+            self.artists = artists
+            self.cache = {}
+            self.built_at = time.monotonic()
+
+    def ensure_built(self):
+        if self.venues is None or time.monotonic() - self.built_at > self.index_ttl:
+            self.build()
+
+    def _sides(self, kind):
+        if kind == 'venue':
+            return self.venues, self.artists
+        return self.artists, self.venues
+
+    def _invalidate_around(self, kind, profile):
+        # Drop cached lists of the counterparts that could have ranked this
+        # profile: those sharing a genre or a city with it.
+        other = self._sides(kind)[1]
+        self.cache.pop((kind, profile.id), None)
+        other_kind = 'artist' if kind == 'venue' else 'venue'
+        ids = set(other.by_place.get((profile.city, profile.state), ()))
+        for genre in profile.genres:
+            ids.update(other.by_genre.get(genre, ()))
+        for other_id in ids:
+            self.cache.pop((other_kind, other_id), None)
+
+    def update(self, kind, entity_id, name, image_link, genres, city, state, seeking):
+        if self.venues is None:
+            return
+        profile = Profile(entity_id, name, image_link, genres, city, state, seeking)
+        with self.lock:
+            own = self._sides(kind)[0]
+            old = own.profiles.get(entity_id)
+            if old is not None and old.match_key() == profile.match_key():
+                old.name = profile.name
+                old.image_link = profile.image_link
+                return
+            if old is not None:
+                own.remove(entity_id)
+                self._invalidate_around(kind, old)
+            own.add(profile)
+            self._invalidate_around(kind, profile)
+
+    def update_venue(self, venue):
+        self.update('venue', venue.id, venue.name, venue.image_link, venue.genres,
+                    venue.city, venue.state, venue.seeking_talent)
+
+    def update_artist(self, artist):
+        self.update('artist', artist.id, artist.name, artist.image_link, artist.genres,
+                    artist.city, artist.state, artist.seeking_venue)
+
+    def remove(self, kind, entity_id):
+        if self.venues is None:
+            return
+        with self.lock:
+            old = self._sides(kind)[0].remove(entity_id)
+            if old is not None:
+                self._invalidate_around(kind, old)
+
+    def reload(self, venue_ids, artist_ids):
+        # Applies changes made by any worker, as the read model reads them
+        # from change_log: profiles and show counts are loaded as they are
+        # now, and an entity that is gone is removed.
+        if self.venues is None:
+            return
+        venue_query, artist_query, venue_activity, artist_activity = self.queries()
+        venues, artists = {}, {}
+        venue_counts, artist_counts = defaultdict(int), defaultdict(int)
+        if venue_ids:
+            for _, (rows, counts) in scatter(lambda conn: (
+                    conn.execute(venue_query.where(Venue.id.in_(venue_ids))).all(),
+                    conn.execute(venue_activity.where(Show.venue_id.in_(venue_ids))).all()),
+                    list(venue_shards(venue_ids))):
+                venues.update((row.id, row) for row in rows)
+                venue_counts.update(counts)
+        if artist_ids:
+            artists = {row.id: row for row in db.session.execute(artist_query.where(Artist.id.in_(artist_ids)))}
+            for _, counts in scatter(lambda conn: conn.execute(
+                    artist_activity.where(Show.artist_id.in_(artist_ids))).all()):
+                for artist_id, count in counts:
+                    artist_counts[artist_id] += count
+        with self.lock:
+            for kind, ids, rows, counts in (('venue', venue_ids, venues, venue_counts),
+                                            ('artist', artist_ids, artists, artist_counts)):
+                own = self._sides(kind)[0]
+                for entity_id in ids:
+                    if entity_id not in rows:
+                        self.remove(kind, entity_id)
+                        own.activity.pop(entity_id, None)
+                        continue
+                    self.update(kind, *rows[entity_id])
+                    if own.activity.get(entity_id, 0) != counts[entity_id]:
+                        own.activity[entity_id] = counts[entity_id]
+                        self._invalidate_around(kind, own.profiles[entity_id])
+
+    def record_show(self, artist_id, venue_id):
+        if self.venues is None:
+            return
+        with self.lock:
+            self.artists.activity[artist_id] += 1
+            self.venues.activity[venue_id] += 1
+            for kind, entity_id in (('artist', artist_id), ('venue', venue_id)):
+                profile = self._sides(kind)[0].profiles.get(entity_id)
+                if profile is not None:
+                    self._invalidate_around(kind, profile)
+
+    # Scoring
+    # ----------------------------------------------------------------
+
+    def score(self, profile, candidate, activity):
+        score = 0.0
+        if profile.genres and candidate.genres:
+            overlap = len(profile.genres & candidate.genres)
+            score += GENRE_WEIGHT * overlap / len(profile.genres | candidate.genres)
+        if candidate.state == profile.state:
+            score += CITY_WEIGHT if candidate.city == profile.city else STATE_WEIGHT
+        score += ACTIVITY_WEIGHT * math.log1p(activity)
+        return score
+
+    def recommend(self, kind, entity_id):
+        self.ensure_built()
+        with self.lock:
+            cached = self.cache.get((kind, entity_id))
+            if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+                return cached[1]
+            own, other = self._sides(kind)
+            profile = own.profiles.get(entity_id)
+            # Only a venue seeking talent gets artists, and only artists
+            # seeking a venue are suggested; the same the other way round.
+            if profile is None or not profile.seeking:
+                return []
+            ranked = heapq.nlargest(self.top_k, (
+                (self.score(profile, other.profiles[c], other.activity[c]), c)
+                for c in other.candidates(profile) if other.profiles[c].seeking
+            ))
+            result = [{
+                "id": c,
+                "name": other.profiles[c].name,
+                "image_link": other.profiles[c].image_link,
+                "score": round(score, 2)
+            } for score, c in ranked]
+            self.cache[(kind, entity_id)] = (time.monotonic(), result)
+            return result
+
+    def artists_for_venue(self, venue_id):
+        return self.recommend('venue', venue_id)
+
+    def venues_for_artist(self, artist_id):
+        return self.recommend('artist', artist_id)
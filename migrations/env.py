@@ -74,10 +74,21 @@ def run_migrations_online():
     connectable = current_app.extensions['migrate'].db.get_engine()
 
     with connectable.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            # DDL waiting on a lock blocks every query queued behind it;
+            # give up quickly instead (see online_migrations.py).
+            connection.exec_driver_sql("SET lock_timeout = '{}'".format(
+                current_app.config['MIGRATION_LOCK_TIMEOUT']))
+            connection.exec_driver_sql("SET statement_timeout = '{}'".format(
+                current_app.config['MIGRATION_STATEMENT_TIMEOUT']))
+            connection.commit()
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            # Each revision commits on its own, so a long online migration
+            # does not hold the earlier ones' locks.
+            transaction_per_migration=True,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,33 @@
+"""add change_log
+
+Revision ID: 03f72ed2f980
+Revises: 09c4cd1da27e
+Create Date: 2026-10-19 17:40:21.508114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '03f72ed2f980'
+down_revision = '09c4cd1da27e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=20), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_change_log_created_at'), 'change_log', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_change_log_created_at'), table_name='change_log')
+    op.drop_table('change_log')
@@ -0,0 +1,33 @@
+"""add venue_shards directory
+
+Revision ID: 09c4cd1da27e
+Revises: c09d663abd95
+Create Date: 2026-10-19 15:12:07.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '09c4cd1da27e'
+down_revision = 'c09d663abd95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('venue_shards',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.String(length=64), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # Existing venues all live on the default database.
+    op.execute('INSERT INTO venue_shards (id, shard) SELECT id, NULL FROM venues')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("SELECT setval(pg_get_serial_sequence('venue_shards', 'id'), "
+                   "COALESCE((SELECT MAX(id) FROM venue_shards), 0) + 1, false)")
+
+
+def downgrade():
+    op.drop_table('venue_shards')
@@ -0,0 +1,35 @@
+"""cascade show deletes from venues and artists
+
+Revision ID: 3544c53bb24d
+Revises: 97f1fd6a36e7
+Create Date: 2026-10-19 12:04:48.270931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3544c53bb24d'
+down_revision = '97f1fd6a36e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('shows_artist_id_fkey', 'shows', type_='foreignkey')
+    op.drop_constraint('shows_venue_id_fkey', 'shows', type_='foreignkey')
+    op.create_foreign_key('shows_artist_id_fkey', 'shows', 'artists', ['artist_id'], ['id'], ondelete='CASCADE')
+    op.create_foreign_key('shows_venue_id_fkey', 'shows', 'venues', ['venue_id'], ['id'], ondelete='CASCADE')
+    # Cascades look shows up by the foreign key, so both sides need an index.
+    op.create_index(op.f('ix_shows_artist_id'), 'shows', ['artist_id'], unique=False)
+    op.create_index(op.f('ix_shows_venue_id'), 'shows', ['venue_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_shows_venue_id'), table_name='shows')
+    op.drop_index(op.f('ix_shows_artist_id'), table_name='shows')
+    op.drop_constraint('shows_venue_id_fkey', 'shows', type_='foreignkey')
+    op.drop_constraint('shows_artist_id_fkey', 'shows', type_='foreignkey')
+    op.create_foreign_key('shows_venue_id_fkey', 'shows', 'venues', ['venue_id'], ['id'])
+    op.create_foreign_key('shows_artist_id_fkey', 'shows', 'artists', ['artist_id'], ['id'])
@@ -0,0 +1,31 @@
+"""drop shows_all view
+
+Revision ID: 5d2b8e7f41a3
+Revises: 71a179c4ebed
+Create Date: 2026-10-19 19:05:12.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2b8e7f41a3'
+down_revision = '71a179c4ebed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nothing reads it; current and archived shows are queried separately,
+    # per shard.
+    op.execute('DROP VIEW IF EXISTS shows_all')
+
+
+def downgrade():
+    op.execute("""
+        CREATE VIEW shows_all AS
+        SELECT id, artist_id, venue_id, start_time FROM shows
+        UNION ALL
+        SELECT id, artist_id, venue_id, start_time FROM shows_archive
+    """)
@@ -0,0 +1,42 @@
+"""add page_views and trending
+
+Revision ID: 71a179c4ebed
+Revises: 03f72ed2f980
+Create Date: 2026-10-19 18:32:54.117046
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '71a179c4ebed'
+down_revision = '03f72ed2f980'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('page_views',
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('views', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'entity_id', 'bucket')
+    )
+    op.create_index(op.f('ix_page_views_bucket'), 'page_views', ['bucket'], unique=False)
+    op.create_table('trending',
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.Column('computed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'rank')
+    )
+
+
+def downgrade():
+    op.drop_table('trending')
+    op.drop_index(op.f('ix_page_views_bucket'), table_name='page_views')
+    op.drop_table('page_views')
@@ -0,0 +1,30 @@
+"""add venue coordinates and geohash
+
+Revision ID: 8c812dc90312
+Revises: 7a18b8fef96e
+Create Date: 2026-10-19 09:12:41.113702
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c812dc90312'
+down_revision = '7a18b8fef96e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('venues', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('venues', sa.Column('longitude', sa.Float(), nullable=True))
+    op.add_column('venues', sa.Column('geohash', sa.String(length=12), nullable=True))
+    op.create_index(op.f('ix_venues_geohash'), 'venues', ['geohash'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_venues_geohash'), table_name='venues')
+    op.drop_column('venues', 'geohash')
+    op.drop_column('venues', 'longitude')
+    op.drop_column('venues', 'latitude')
@@ -0,0 +1,33 @@
+"""add link_checks
+
+Revision ID: 8e41c7d2a9f6
+Revises: 5d2b8e7f41a3
+Create Date: 2026-10-19 20:14:37.905318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e41c7d2a9f6'
+down_revision = '5d2b8e7f41a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('link_checks',
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('field', sa.String(length=40), nullable=False),
+    sa.Column('url', sa.String(length=500), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=True),
+    sa.Column('error', sa.String(length=250), nullable=True),
+    sa.Column('checked_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'entity_id', 'field')
+    )
+
+
+def downgrade():
+    op.drop_table('link_checks')
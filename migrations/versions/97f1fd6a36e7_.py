@@ -0,0 +1,26 @@
+"""add version columns to venues and artists
+
+Revision ID: 97f1fd6a36e7
+Revises: 22334801b9f3
+Create Date: 2026-10-19 11:20:05.602214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '97f1fd6a36e7'
+down_revision = '22334801b9f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('venues', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('artists', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('artists', 'version')
+    op.drop_column('venues', 'version')
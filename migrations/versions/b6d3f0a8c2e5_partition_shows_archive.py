@@ -0,0 +1,57 @@
+"""partition shows_archive where create_all made it a plain table
+
+Revision ID: b6d3f0a8c2e5
+Revises: 8e41c7d2a9f6
+Create Date: 2026-10-19 21:02:48.316540
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d3f0a8c2e5'
+down_revision = '8e41c7d2a9f6'
+branch_labels = None
+depends_on = None
+
+
+def is_partitioned():
+    return op.get_bind().execute(sa.text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('shows_archive'))"
+    )).scalar()
+
+
+def upgrade():
+    # A database set up with db.create_all() before the model declared the
+    # partitioning has a plain shows_archive, which the archive job cannot
+    # attach yearly partitions to. Rebuild it as the partitioned parent with
+    # a default partition; the archive job adds the yearly ones.
+    if op.get_bind().dialect.name != 'postgresql' or is_partitioned():
+        return
+    op.execute('ALTER TABLE shows_archive RENAME TO shows_archive_plain')
+    # Frees the primary key's name for the new table.
+    op.execute('ALTER INDEX IF EXISTS shows_archive_pkey RENAME TO shows_archive_plain_pkey')
+    op.execute("""
+        CREATE TABLE shows_archive (
+            id INTEGER NOT NULL,
+            start_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            artist_id INTEGER NOT NULL REFERENCES artists (id) ON DELETE CASCADE,
+            venue_id INTEGER NOT NULL REFERENCES venues (id) ON DELETE CASCADE,
+            archived_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id, start_time)
+        ) PARTITION BY RANGE (start_time)
+    """)
+    op.execute('CREATE TABLE shows_archive_default PARTITION OF shows_archive DEFAULT')
+    op.execute("""
+        INSERT INTO shows_archive (id, start_time, artist_id, venue_id, archived_at)
+        SELECT id, start_time, artist_id, venue_id, archived_at FROM shows_archive_plain
+    """)
+    op.drop_table('shows_archive_plain')
+    op.create_index(op.f('ix_shows_archive_artist_id'), 'shows_archive', ['artist_id'], unique=False)
+    op.create_index(op.f('ix_shows_archive_venue_id'), 'shows_archive', ['venue_id'], unique=False)
+
+
+def downgrade():
+    # The partitioned table is what c09d663abd95 creates on Postgres.
+    pass
@@ -0,0 +1,60 @@
+"""add shows_archive and shows_all view
+
+Revision ID: c09d663abd95
+Revises: 3544c53bb24d
+Create Date: 2026-10-19 13:41:26.051877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c09d663abd95'
+down_revision = '3544c53bb24d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # Yearly partitions are created on demand by the archive job.
+        op.execute("""
+            CREATE TABLE shows_archive (
+                id INTEGER NOT NULL,
+                start_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                artist_id INTEGER NOT NULL REFERENCES artists (id) ON DELETE CASCADE,
+                venue_id INTEGER NOT NULL REFERENCES venues (id) ON DELETE CASCADE,
+                archived_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (id, start_time)
+            ) PARTITION BY RANGE (start_time)
+        """)
+        op.execute('CREATE TABLE shows_archive_default PARTITION OF shows_archive DEFAULT')
+    else:
+        op.create_table('shows_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('start_time', sa.DateTime(), nullable=False),
+        sa.Column('artist_id', sa.Integer(), nullable=False),
+        sa.Column('venue_id', sa.Integer(), nullable=False),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['artist_id'], ['artists.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['venue_id'], ['venues.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id', 'start_time')
+        )
+    op.create_index(op.f('ix_shows_archive_artist_id'), 'shows_archive', ['artist_id'], unique=False)
+    op.create_index(op.f('ix_shows_archive_venue_id'), 'shows_archive', ['venue_id'], unique=False)
+    op.create_index(op.f('ix_shows_start_time'), 'shows', ['start_time'], unique=False)
+    op.execute("""
+        CREATE VIEW shows_all AS
+        SELECT id, artist_id, venue_id, start_time FROM shows
+        UNION ALL
+        SELECT id, artist_id, venue_id, start_time FROM shows_archive
+    """)
+
+
+def downgrade():
+    op.execute('DROP VIEW shows_all')
+    op.drop_index(op.f('ix_shows_start_time'), table_name='shows')
+    op.drop_index(op.f('ix_shows_archive_venue_id'), table_name='shows_archive')
+    op.drop_index(op.f('ix_shows_archive_artist_id'), table_name='shows_archive')
+    op.drop_table('shows_archive')
@@ -0,0 +1,35 @@
+"""index shows by venue and artist together with start_time
+
+Revision ID: c5e1a7d3f9b2
+Revises: b6d3f0a8c2e5
+Create Date: 2026-10-19 22:10:05.774120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index, drop_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e1a7d3f9b2'
+down_revision = 'b6d3f0a8c2e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently, so shows stays writable; the single-column
+    # indexes go once the composite ones, which lead with the same
+    # columns, are in place.
+    create_index('ix_shows_venue_id_start_time', 'shows', ['venue_id', 'start_time'])
+    create_index('ix_shows_artist_id_start_time', 'shows', ['artist_id', 'start_time'])
+    drop_index('ix_shows_venue_id', 'shows')
+    drop_index('ix_shows_artist_id', 'shows')
+
+
+def downgrade():
+    create_index('ix_shows_artist_id', 'shows', ['artist_id'])
+    create_index('ix_shows_venue_id', 'shows', ['venue_id'])
+    drop_index('ix_shows_artist_id_start_time', 'shows')
+    drop_index('ix_shows_venue_id_start_time', 'shows')
@@ -1,15 +1,54 @@
+import sqlite3
+
 from app import app, db
 from flask_migrate import Migrate
+from sqlalchemy import DDL, event
+from sqlalchemy.engine import Engine
 
 migrate = Migrate(app, db)
 
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores ON DELETE CASCADE unless asked per connection.
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
 class Show(db.Model):
     __tablename__ = 'shows'
+    # Upcoming shows of a venue or artist are one range scan, already in
+    # start_time order; the indexes also serve the foreign keys.
+    __table_args__ = (
+        db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_shows_artist_id_start_time', 'artist_id', 'start_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    artist_id = db.Column(db.Integer, db.ForeignKey('artists.id'), nullable=False)
-    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id'), nullable=False)
-    start_time = db.Column(db.DateTime, nullable=False)
+    artist_id = db.Column(db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), nullable=False)
+    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ShowArchive(db.Model):
+    # Cold storage for shows older than SHOW_ARCHIVE_AFTER_DAYS. On Postgres
+    # the table is range partitioned by start_time (one partition per year),
+    # which is why start_time is part of the primary key. create_all builds
+    # it that way too, so shards made by `flask shards init` match.
+    __tablename__ = 'shows_archive'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (start_time)'}
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    start_time = db.Column(db.DateTime, primary_key=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), nullable=False, index=True)
+    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), nullable=False, index=True)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+
+# Yearly partitions are created on demand by the archive job.
+event.listen(ShowArchive.__table__, 'after_create', DDL(
+    'CREATE TABLE IF NOT EXISTS shows_archive_default PARTITION OF shows_archive DEFAULT'
+).execute_if(dialect='postgresql'))
 
 
 class Venue(db.Model):
@@ -26,12 +65,72 @@ class Venue(db.Model):
     website_link = db.Column(db.String(250), nullable=True)
     seeking_talent = db.Column(db.Boolean, default=False)
     seeking_description = db.Column(db.String(500), nullable=True)
-    shows = db.relationship('Show', backref='venue', lazy=True)
+    shows = db.relationship('Show', backref='venue', lazy=True, passive_deletes=True)
     genres = db.Column(db.String(500))
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geohash = db.Column(db.String(12), nullable=True, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     # TODO: implement any missing fields, as a database migration using Flask-Migrate
 
 
+class VenueShard(db.Model):
+    # Directory of venue placement. Always on the default database; its
+    # sequence hands out venue ids so they stay unique across shards.
+    __tablename__ = 'venue_shards'
+    id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.String(64), nullable=True)
+
+
+class ChangeLog(db.Model):
+    # Venue and artist writes, read by the in-memory read model. Written in
+    # the same transaction as the change itself; on the default database.
+    __tablename__ = 'change_log'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(20), nullable=False, default='upsert')
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class LinkCheck(db.Model):
+    # Latest result of the validate_links job per venue or artist link:
+    # the HTTP status, or why no request was made. On the default database.
+    __tablename__ = 'link_checks'
+    kind = db.Column(db.String(20), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    field = db.Column(db.String(40), primary_key=True)
+    url = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.String(250), nullable=True)
+    checked_at = db.Column(db.DateTime, nullable=False)
+
+
+class PageView(db.Model):
+    # View counts per venue or artist page and hour, written in batches by
+    # trending.ViewCounter. On the default database.
+    __tablename__ = 'page_views'
+    kind = db.Column(db.String(20), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True, index=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Trending(db.Model):
+    # Top venues and artists by time-decayed views, rebuilt by the
+    # compute_trending job. name is copied so the home page needs no join.
+    __tablename__ = 'trending'
+    kind = db.Column(db.String(20), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    entity_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+
 class Artist(db.Model):
     __tablename__ = 'artists'
 
@@ -46,4 +145,24 @@ class Artist(db.Model):
     website_link = db.Column(db.String(250), nullable=True)
     seeking_venue = db.Column(db.Boolean, default=False)
     seeking_description = db.Column(db.String(500), nullable=True)
-    shows = db.relationship('Show', backref='artist', lazy=True)
+    shows = db.relationship('Show', backref='artist', lazy=True, passive_deletes=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    idempotency_key = db.Column(db.String(250), nullable=True, unique=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, index=True)
+    locked_by = db.Column(db.String(120), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,223 @@
+import logging
+import time
+from contextlib import contextmanager, nullcontext
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.exc import OperationalError
+
+# ----------------------------------------------------------------------------#
+# Online migration helpers.
+# ----------------------------------------------------------------------------#
+#
+# For migrations on large tables that must not block the app. Adding a
+# column and filling it looks like:
+#
+#   from online_migrations import add_column, backfill, set_not_null
+#
+#   def upgrade():
+#       add_column('shows', sa.Column('ends_at', sa.DateTime(), nullable=True))
+#       backfill('shows', {'ends_at': sa.text("start_time + interval '3 hours'")},
+#                where='ends_at IS NULL')
+#       set_not_null('shows', 'ends_at')
+#
+# env.py sets a short lock_timeout for every migration, so DDL that cannot
+# get its lock fails quickly instead of queueing every query behind it;
+# the helpers here retry such statements. Backfills, concurrent index
+# builds and set_not_null run outside the migration's transaction (which
+# commits what came before them): they commit as they go, must be safe to
+# run again, and lift the statement timeout for their long scans. A backfill that stops part way resumes
+# from its last checkpoint on the next `flask db upgrade`.
+
+logger = logging.getLogger('alembic.online')
+
+CHECKPOINTS = sa.table(
+    'online_migration_checkpoints',
+    sa.column('name', sa.String),
+    sa.column('last_key', sa.BigInteger),
+    sa.column('updated_at', sa.DateTime),
+)
+
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def is_lock_timeout(error):
+    return getattr(error.orig, 'pgcode', None) == LOCK_NOT_AVAILABLE
+
+
+@contextmanager
+def session_statement_timeout(bind, value):
+    # Session-level, for autocommit blocks where SET LOCAL would not outlive
+    # the statement. 0 turns the timeout off; the previous value is restored.
+    previous = bind.exec_driver_sql('SHOW statement_timeout').scalar()
+    bind.exec_driver_sql("SET statement_timeout = '{}'".format(value))
+    try:
+        yield
+    finally:
+        bind.exec_driver_sql("SET statement_timeout = '{}'".format(previous))
+
+
+def with_lock_retries(fn, attempts=10, delay=0.5, savepoint=True):
+    # Runs fn, retrying with backoff while it times out waiting for a lock.
+    # In a transaction each attempt gets a savepoint so the migration's
+    # transaction stays usable; in an autocommit block (savepoint=False)
+    # every statement is its own transaction already.
+    bind = op.get_bind()
+    for attempt in range(1, attempts + 1):
+        nested = bind.begin_nested() if savepoint else None
+        try:
+            result = fn()
+            if nested is not None:
+                nested.commit()
+            return result
+        except OperationalError as e:
+            if nested is not None:
+                nested.rollback()
+            if not is_lock_timeout(e) or attempt == attempts:
+                raise
+            logger.info('Lock not available, retrying (%d/%d)', attempt, attempts)
+            time.sleep(delay * attempt)
+
+
+# Schema changes
+# ----------------------------------------------------------------
+
+def add_column(table, column, **kw):
+    # A nullable column without a volatile default is a catalog-only
+    # change; anything else rewrites the table.
+    if not column.nullable and column.server_default is None:
+        raise ValueError('Add {} as nullable, backfill it, then use set_not_null().'.format(column.name))
+    with_lock_retries(lambda: op.add_column(table, column, **kw))
+
+
+def set_not_null(table, column):
+    # On Postgres a validated CHECK lets SET NOT NULL skip its table scan,
+    # and VALIDATE only takes a lock that lets reads and writes through.
+    # Each step commits on its own: ADD CONSTRAINT and SET NOT NULL take
+    # ACCESS EXCLUSIVE, which a shared transaction would hold through the
+    # whole VALIDATE scan. Safe to run again after a failure part way.
+    if not is_postgres():
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, nullable=False)
+        return
+    name = 'ck_{}_{}_not_null'.format(table, column)
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        with_lock_retries(lambda: op.execute(
+            'ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {1}, '
+            'ADD CONSTRAINT {1} CHECK ({2} IS NOT NULL) NOT VALID'.format(table, name, column)), savepoint=False)
+        with session_statement_timeout(bind, 0):
+            op.execute('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(table, name))
+        with_lock_retries(lambda: op.alter_column(table, column, nullable=False), savepoint=False)
+        with_lock_retries(lambda: op.drop_constraint(name, table, type_='check'), savepoint=False)
+
+
+def create_index(name, table, columns, unique=False, **kw):
+    # CREATE INDEX CONCURRENTLY on Postgres, which cannot run in a
+    # transaction. A failed concurrent build leaves an INVALID index
+    # behind; it is dropped and built again. The build has no statement
+    # timeout: on a big table it outlasts MIGRATION_STATEMENT_TIMEOUT.
+    if not is_postgres():
+        op.create_index(name, table, columns, unique=unique, **kw)
+        return
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        invalid = bind.execute(sa.text(
+            'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name AND NOT i.indisvalid'), {"name": name}).scalar()
+        with session_statement_timeout(bind, 0):
+            if invalid:
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True,
+                            if_not_exists=True, **kw)
+
+
+def drop_index(name, table):
+    if not is_postgres():
+        op.drop_index(name, table_name=table)
+        return
+    with op.get_context().autocommit_block():
+        with session_statement_timeout(op.get_bind(), 0):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+
+
+# Backfills
+# ----------------------------------------------------------------
+
+def ensure_checkpoints(bind):
+    sa.Table('online_migration_checkpoints', sa.MetaData(),
+             sa.Column('name', sa.String(200), primary_key=True),
+             sa.Column('last_key', sa.BigInteger(), nullable=False),
+             sa.Column('updated_at', sa.DateTime(), nullable=False)).create(bind, checkfirst=True)
+
+
+def read_checkpoint(bind, name):
+    return bind.execute(sa.select(CHECKPOINTS.c.last_key).where(CHECKPOINTS.c.name == name)).scalar()
+
+
+def write_checkpoint(bind, name, last_key):
+    values = {"last_key": last_key, "updated_at": sa.func.now()}
+    if bind.execute(CHECKPOINTS.update().where(CHECKPOINTS.c.name == name).values(**values)).rowcount == 0:
+        bind.execute(CHECKPOINTS.insert().values(name=name, **values))
+
+
+def backfill(table, values, where=None, key='id', batch_size=1000, pause=0.0, throttle=0.0,
+             statement_timeout='30s', name=None):
+    # UPDATE table SET values in key ranges of batch_size, each batch
+    # committed on its own. values maps column names to SQL expressions;
+    # where (SQL text) should skip rows already done so a rerun is cheap.
+    # pause sleeps between batches; throttle sleeps that fraction of each
+    # batch's run time as well, backing off when the database is slow.
+    # Returns the number of rows updated.
+    name = name or 'backfill:{}:{}'.format(table, ','.join(sorted(values)))
+    target = sa.table(table, sa.column(key), *[sa.column(column) for column in values])
+    key_column = target.c[key]
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        ensure_checkpoints(bind)
+        checkpoint = read_checkpoint(bind, name)
+        low, high = bind.execute(sa.select(sa.func.min(key_column), sa.func.max(key_column))).one()
+        if high is None:
+            return 0
+        start = low if checkpoint is None else max(low, checkpoint + 1)
+        if start > low:
+            logger.info('%s: resuming at %s=%s', name, key, start)
+        update = target.update().values(**values)
+        if where is not None:
+            update = update.where(sa.text(where))
+        postgres = bind.dialect.name == 'postgresql'
+        updated = 0
+        began = time.monotonic()
+        with session_statement_timeout(bind, statement_timeout) if statement_timeout and postgres \
+                else nullcontext():
+            # Each statement commits on its own here. A batch that ran but
+            # was not checkpointed is simply run again on resume.
+            while start <= high:
+                end = start + batch_size - 1
+                batch_began = time.monotonic()
+                updated += bind.execute(update.where(key_column.between(start, end))).rowcount
+                write_checkpoint(bind, name, end)
+                took = time.monotonic() - batch_began
+                report_progress(name, start - low, end - low + 1, high - low + 1, updated,
+                                time.monotonic() - began)
+                start = end + 1
+                if pause or throttle:
+                    time.sleep(pause + took * throttle)
+            # Finished: a later run (after a downgrade, say) starts over.
+            bind.execute(CHECKPOINTS.delete().where(CHECKPOINTS.c.name == name))
+    return updated
+
+
+def report_progress(name, previous, done, total, updated, elapsed):
+    # Logged at each whole percent, so big tables don't flood the output.
+    done = min(done, total)
+    if done != total and int(previous * 100 / total) == int(done * 100 / total):
+        return
+    rate = done / elapsed if elapsed else 0
+    eta = (total - done) / rate if rate else 0
+    logger.info('%s: %d%% of key range, %d rows updated, %.0fs elapsed, ~%.0fs left',
+                name, done * 100 // total, updated, elapsed, eta)
@@ -0,0 +1,264 @@
+"""Benchmark the hot routes on a synthetic SQLite dataset and gate on a baseline.
+
+    python perf_gate.py run --out perf/baseline.json
+    python perf_gate.py gate perf/baseline.json --tolerance 0.25 --sql-tolerance 0
+
+Each run builds the same dataset in a temporary SQLite database, warms the
+app up, then times every route in ROUTES with the test client and counts
+its SQL statements. The search cache is emptied before every timed request,
+so the searches are measured rather than the cache. `gate` exits non-zero when a route is slower than the
+baseline by more than the tolerance or runs more statements than it did.
+The baseline should come from the machine that runs the gate; with
+--calibrate, latencies are scaled by a short CPU loop timed in both runs,
+which roughly corrects for a faster or slower machine.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from replay import percentile
+
+SEED = 20240501
+VENUES = 200
+ARTISTS = 300
+SHOWS = 1500
+CITIES = [('San Francisco', 'CA'), ('New York', 'NY'), ('Austin', 'TX'), ('Chicago', 'IL'),
+          ('Seattle', 'WA'), ('Nashville', 'TN'), ('Portland', 'OR'), ('Denver', 'CO')]
+GENRES = ['Jazz', 'Reggae', 'Swing', 'Classical', 'Folk', 'R&B', 'Hip-Hop', 'Rock n Roll', 'Blues']
+WORDS = ['Park', 'Hall', 'Club', 'Dueling', 'Pianos', 'Musical', 'Hop', 'Guns', 'Petals',
+         'Quartet', 'Matt', 'Wild', 'Sax', 'Band', 'Room', 'Garden', 'Stage', 'Cellar']
+
+# name: (method, path, form). The hot routes a deploy must not slow down.
+ROUTES = {
+    'home': ('GET', '/', None),
+    'venues': ('GET', '/venues', None),
+    'artists': ('GET', '/artists', None),
+    'shows': ('GET', '/shows', None),
+    'venue detail': ('GET', '/venues/7', None),
+    'artist detail': ('GET', '/artists/11', None),
+    'venue search': ('POST', '/venues/search', {'search_term': 'hall'}),
+    'artist search': ('POST', '/artists/search', {'search_term': 'sax'}),
+}
+
+# Everything that writes, throttles or logs per request is off, so the
+# numbers are the routes' own.
+SETTINGS = '''
+SQLALCHEMY_DATABASE_URI = {database!r}
+SQLALCHEMY_BINDS = {{}}
+SHARDS = {{}}
+SHARD_MAP = {{}}
+DEBUG = False
+WTF_CSRF_ENABLED = False
+RATE_LIMIT_ENABLED = False
+TRAFFIC_CAPTURE_ENABLED = False
+SLOW_QUERY_LOG_ENABLED = False
+VIEW_COUNTS_ENABLED = False
+EVENTS_ENABLED = False
+PROFILING_ENABLED = False
+LOG_LEVEL = 'WARNING'
+LOG_FILE = {log!r}
+RATE_LIMIT_FILE = {ratelimit!r}
+JINJA_BYTECODE_CACHE_DIR = {bytecode!r}
+THUMBNAIL_CACHE_DIR = {thumbnails!r}
+'''
+
+
+def configure(directory):
+    # Must run before app is imported: config is read at import.
+    path = os.path.join(directory, 'settings.py')
+    with open(path, 'w') as f:
+        f.write(SETTINGS.format(
+            database='sqlite:///' + os.path.join(directory, 'perf.db'),
+            log=os.path.join(directory, 'app.log'),
+            ratelimit=os.path.join(directory, 'ratelimit.bin'),
+            bytecode=os.path.join(directory, 'bytecode'),
+            thumbnails=os.path.join(directory, 'thumbnails'),
+        ))
+    os.environ['FYYUR_SETTINGS'] = path
+
+
+def seed(db, now):
+    from models import Venue, Artist, Show, VenueShard
+    rng = random.Random(SEED)
+
+    def name():
+        return ' '.join(rng.sample(WORDS, 2)) + ' {}'.format(rng.randint(1, 99))
+
+    def genres():
+        return '{' + ','.join(rng.sample(GENRES, rng.randint(1, 3))) + '}'
+
+    venues, artists, shows = [], [], []
+    for i in range(1, VENUES + 1):
+        city, state = rng.choice(CITIES)
+        venues.append({"id": i, "name": name(), "city": city, "state": state, "address": '{} Main St'.format(i),
+                       "phone": '555-555-{:04d}'.format(i), "genres": genres(), "seeking_talent": i % 3 == 0,
+                       "image_link": 'https://images.example.com/venues/{}.jpg'.format(i)})
+    for i in range(1, ARTISTS + 1):
+        city, state = rng.choice(CITIES)
+        artists.append({"id": i, "name": name(), "city": city, "state": state, "phone": '555-444-{:04d}'.format(i),
+                        "genres": genres(), "seeking_venue": i % 4 == 0,
+                        "image_link": 'https://images.example.com/artists/{}.jpg'.format(i)})
+    # Two thirds in the past, within the archive window; the rest upcoming.
+    for i in range(1, SHOWS + 1):
+        hours = rng.randint(-24 * 120, 24 * 60)
+        shows.append({"id": i, "venue_id": rng.randint(1, VENUES), "artist_id": rng.randint(1, ARTISTS),
+                      "start_time": now + timedelta(hours=hours)})
+    db.session.execute(db.insert(VenueShard), [{"id": v["id"], "shard": None} for v in venues])
+    db.session.execute(db.insert(Venue), venues)
+    db.session.execute(db.insert(Artist), artists)
+    db.session.execute(db.insert(Show), shows)
+    db.session.commit()
+
+
+def calibrate(rounds=10):
+    # Milliseconds for a fixed pure-Python workload, best of a few.
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        total = 0
+        for i in range(200000):
+            total += i % 7
+        took = (time.perf_counter() - started) * 1000
+        best = took if best is None else min(best, took)
+    return round(best, 3)
+
+
+def run(iterations, warmup):
+    # Before the app starts its background threads.
+    calibration = calibrate()
+    with tempfile.TemporaryDirectory() as directory:
+        configure(directory)
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        from app import app, db
+
+        with app.app_context():
+            seed(db, datetime.now())
+        client = app.test_client()
+        search_cache = app.extensions['search_cache']
+        statements = [0]
+        request_thread = threading.get_ident()
+
+        def count(*args):
+            # Background refreshes (the read model, say) are not the route's.
+            if threading.get_ident() == request_thread:
+                statements[0] += 1
+
+        event.listen(Engine, 'before_cursor_execute', count)
+        samples = {name: ([], []) for name in ROUTES}
+        try:
+            for name, (method, path, form) in ROUTES.items():
+                for _ in range(warmup):
+                    client.open(path, method=method, data=form).get_data()
+            # Routes take turns, so a noisy moment is shared out between
+            # them; the collector is kept out of the timings, as timeit does.
+            for _ in range(iterations):
+                for name, (method, path, form) in ROUTES.items():
+                    search_cache.clear()
+                    gc.collect()
+                    gc.disable()
+                    statements[0] = 0
+                    started = time.perf_counter()
+                    response = client.open(path, method=method, data=form)
+                    response.get_data()
+                    took = (time.perf_counter() - started) * 1000
+                    gc.enable()
+                    if response.status_code >= 400:
+                        raise SystemExit('{} {} returned {}'.format(method, path, response.status_code))
+                    samples[name][0].append(took)
+                    samples[name][1].append(statements[0])
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+    results = {}
+    for name, (latencies, counts) in samples.items():
+        results[name] = {
+            "requests": iterations,
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p90_ms": round(percentile(latencies, 90), 3),
+            "sql": max(counts),
+        }
+    return {
+        "calibration_ms": calibration,
+        "dataset": {"venues": VENUES, "artists": ARTISTS, "shows": SHOWS, "seed": SEED},
+        "routes": results,
+    }
+
+
+def compare(baseline, report, tolerance, sql_tolerance, floor_ms, calibrated=False):
+    # Returns (lines, failed). A route fails when its scaled p50 is more
+    # than tolerance above the baseline's, ignoring differences under
+    # floor_ms, or when it runs more than sql_tolerance extra statements.
+    scale = 1.0
+    if calibrated and report['calibration_ms']:
+        scale = baseline['calibration_ms'] / report['calibration_ms']
+    lines = ['{:<16} {:>10} {:>10} {:>8} {:>6} {:>6}  {}'.format(
+        'route', 'base p50', 'p50', 'change', 'sql', 'base', '')]
+    failed = False
+    for name, base in baseline['routes'].items():
+        current = report['routes'].get(name)
+        if current is None:
+            lines.append('{:<16} missing from this run  FAIL'.format(name))
+            failed = True
+            continue
+        p50 = current['p50_ms'] * scale
+        change = (p50 - base['p50_ms']) / base['p50_ms'] if base['p50_ms'] else 0.0
+        slow = change > tolerance and p50 - base['p50_ms'] > floor_ms
+        chatty = current['sql'] > base['sql'] + sql_tolerance
+        verdict = 'FAIL' if slow or chatty else 'ok'
+        failed = failed or slow or chatty
+        lines.append('{:<16} {:>10.2f} {:>10.2f} {:>+7.1%} {:>6} {:>6}  {}'.format(
+            name, base['p50_ms'], p50, change, current['sql'], base['sql'], verdict))
+    if calibrated:
+        lines.append('latency scaled by {:.2f} for machine speed'.format(scale))
+    return lines, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='Benchmark the routes and print or save the report.')
+    gate_parser = sub.add_parser('gate', help='Benchmark the routes and compare with a baseline.')
+    gate_parser.add_argument('baseline')
+    gate_parser.add_argument('--tolerance', type=float, default=0.25,
+                             help='Allowed p50 slowdown as a fraction of the baseline.')
+    gate_parser.add_argument('--sql-tolerance', type=int, default=0,
+                             help='Allowed extra SQL statements per request.')
+    gate_parser.add_argument('--floor-ms', type=float, default=1.0,
+                             help='Slowdowns smaller than this are noise.')
+    gate_parser.add_argument('--calibrate', action='store_true',
+                             help='Scale latencies by the calibration loop, for a baseline from another machine.')
+    for p in (run_parser, gate_parser):
+        p.add_argument('--iterations', type=int, default=30)
+        p.add_argument('--warmup', type=int, default=3)
+        p.add_argument('--out', help='Write the JSON report here.')
+
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.command == 'gate':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report = run(args.iterations, args.warmup)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    if baseline is None:
+        for name, r in report['routes'].items():
+            print('{:<16} p50 {:>8.2f} ms  p90 {:>8.2f} ms  {:>3} sql'.format(name, r['p50_ms'], r['p90_ms'], r['sql']))
+        return 0
+    lines, failed = compare(baseline, report, args.tolerance, args.sql_tolerance, args.floor_ms,
+                            args.calibrate)
+    print('\n'.join(lines))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import sharding
+from archive import all_shows
+from models import db, Venue, Artist
+from sharding import scatter
+
+# ----------------------------------------------------------------------------#
+# Static snapshot.
+# ----------------------------------------------------------------------------#
+#
+# `flask prerender` writes the public catalog pages as plain HTML, laid out
+# so a web server can serve them before falling through to the app:
+#
+#   location / { try_files $uri/index.html @fyyur; }
+#
+# Requests with a query string (?past_page=2) should always go to the app.
+# A manifest keeps a fingerprint per page; only pages whose fingerprint
+# changed, or whose templates changed, are rendered again.
+
+MANIFEST = 'manifest.json'
+
+_app = None
+
+
+def file_for(out_dir, path):
+    return os.path.join(out_dir, path.strip('/'), 'index.html')
+
+
+def write_atomic(target, data):
+    # Readers see either the old file or the new one, never a partial write.
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def templates_digest(app):
+    h = hashlib.sha1()
+    root = os.path.join(app.root_path, app.template_folder)
+    for directory, _, files in sorted(os.walk(root)):
+        for name in sorted(files):
+            with open(os.path.join(directory, name), 'rb') as f:
+                h.update(name.encode('utf-8'))
+                h.update(f.read())
+    return h.hexdigest()
+
+
+# Fingerprints
+# ----------------------------------------------------------------
+
+def show_stats(kind, other, now):
+    # Per entity: show count, newest show id, sum of the counterparts'
+    # versions (catches renames on the other side) and upcoming count
+    # (catches shows moving from upcoming to past). Archived shows count
+    # too: they are on the past-shows pages.
+    shows = all_shows()
+    key = shows.c.venue_id if kind == 'venue' else shows.c.artist_id
+    other_id = shows.c.artist_id if other is Artist else shows.c.venue_id
+    return db.select(
+        key, db.func.count(shows.c.id), db.func.max(shows.c.id), db.func.sum(other.version),
+        db.func.sum(db.case((shows.c.start_time > now, 1), else_=0))
+    ).join(other, other.id == other_id).group_by(key)
+
+
+def fingerprints(now):
+    venue_stats = show_stats('venue', Artist, now)
+    artist_stats = show_stats('artist', Venue, now)
+    venues = db.select(Venue.id, Venue.version, Venue.city, Venue.state)
+
+    parts = {}
+    existing = set()
+    listing = []
+    for shard, (venue_rows, v_stats, a_stats) in scatter(lambda conn: (
+            conn.execute(venues).all(),
+            conn.execute(venue_stats).all(),
+            conn.execute(artist_stats).all())):
+        for venue_id, version, city, state in venue_rows:
+            existing.add('/venues/{}'.format(venue_id))
+            parts.setdefault('/venues/{}'.format(venue_id), []).append(version)
+        for row in v_stats:
+            parts.setdefault('/venues/{}'.format(row[0]), []).append((shard,) + tuple(row[1:]))
+            listing.append((shard, row[0], row[4]))
+        for row in a_stats:
+            parts.setdefault('/artists/{}'.format(row[0]), []).append((shard,) + tuple(row[1:]))
+        listing.extend((shard,) + tuple(row) for row in venue_rows)
+
+    artists = Artist.query.with_entities(Artist.id, Artist.version).order_by(Artist.id).all()
+    for artist_id, version in artists:
+        existing.add('/artists/{}'.format(artist_id))
+        parts.setdefault('/artists/{}'.format(artist_id), []).append(version)
+
+    # Artist copies on shards can have shows after the artist itself is
+    # gone; only pages of entities that exist are rendered.
+    pages = {path: digest(sorted(value, key=repr)) for path, value in parts.items() if path in existing}
+    pages['/venues'] = digest(sorted(listing, key=repr))
+    pages['/artists'] = digest([tuple(a) for a in artists])
+    return pages
+
+
+# Rendering
+# ----------------------------------------------------------------
+
+def init_worker(app):
+    # Runs in each forked worker: connections and the shard thread pool
+    # belong to the parent and must not be shared.
+    global _app
+    _app = app
+    sharding._executor = None
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def render_pages(paths, out_dir):
+    results = []
+    client = _app.test_client()
+    for path in paths:
+        response = client.get(path, headers={'X-Prerender': '1'})
+        target = file_for(out_dir, path)
+        if response.status_code == 200:
+            write_atomic(target, response.get_data())
+        elif os.path.exists(target):
+            os.unlink(target)
+        results.append((path, response.status_code))
+    return results
+
+
+def chunked(items, count):
+    size = max(1, -(-len(items) // max(count, 1)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def prerender(app, out_dir, workers, full=False):
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    pages = fingerprints(datetime.now())
+    template_hash = templates_digest(app)
+    if full or manifest.get('templates') != template_hash:
+        previous = {}
+    else:
+        previous = manifest.get('pages', {})
+
+    stale = sorted(path for path, value in pages.items() if previous.get(path) != value)
+    removed = sorted(set(manifest.get('pages', {})) - set(pages))
+    for path in removed:
+        shutil.rmtree(os.path.join(out_dir, path.strip('/')), ignore_errors=True)
+
+    # Warm the recommendation index once so workers inherit it on fork.
+    app.extensions['matcher'].ensure_built()
+    failed = {}
+    if stale:
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_worker, initargs=(app,)) as pool:
+            for results in pool.map(partial(render_pages, out_dir=out_dir), chunked(stale, workers * 4)):
+                for path, status in results:
+                    if status != 200:
+                        failed[path] = status
+
+    # Failed pages are left out so the next run retries them.
+    rendered = {path: value for path, value in pages.items() if path not in failed}
+    write_atomic(manifest_path, json.dumps({
+        "templates": template_hash,
+        "rendered_at": datetime.now().isoformat(),
+        "pages": rendered,
+    }, indent=1).encode('utf-8'))
+    return len(stale) - len(failed), len(removed), failed
+
+
+@click.command('prerender')
+@click.option('--out', 'out_dir', default=None, help='Output directory (PRERENDER_DIR).')
+@click.option('--workers', default=None, type=int, help='Worker processes (PRERENDER_WORKERS).')
+@click.option('--full', is_flag=True, help='Render every page, ignoring the manifest.')
+@with_appcontext
+def prerender_command(out_dir, workers, full):
+    app = current_app._get_current_object()
+    out_dir = out_dir or app.config['PRERENDER_DIR']
+    workers = workers or app.config['PRERENDER_WORKERS']
+    rendered, removed, failed = prerender(app, out_dir, workers, full)
+    click.echo('Rendered {} pages, removed {}, {} failed.'.format(rendered, removed, len(failed)))
+    for path, status in sorted(failed.items()):
+        click.echo('  {} -> {}'.format(path, status))
@@ -0,0 +1,231 @@
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from flask import appcontext_tearing_down, g, request
+
+# ----------------------------------------------------------------------------#
+# Memory and CPU profiling.
+# ----------------------------------------------------------------------------#
+#
+# Opt-in with PROFILING_ENABLED. Every request has tracemalloc's peak reset
+# when it starts, and records per endpoint:
+#
+#   peak      bytes allocated at the request's high-water mark,
+#   retained  bytes still allocated once the app context is torn down,
+#             after the session has been removed; steady growth here is
+#             what shows up as creeping RSS.
+#
+# A fraction of requests (PROFILE_SNAPSHOT_RATE) also take a snapshot at
+# the start and once the response is built, and the difference is charged
+# to the innermost line of this project that allocated it.
+#
+# tracemalloc counts the whole process, so requests are measured one at a
+# time; one that starts while another is being measured is only counted.
+# Tracing slows allocation down severalfold: this is for a staging worker
+# or one production worker for a while, not for everyday use.
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def project_frame(traceback):
+    # Innermost frame in this project, else the innermost frame at all.
+    for frame in reversed(traceback):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(PROJECT_ROOT) and 'site-packages' not in filename \
+                and filename != os.path.abspath(__file__):
+            return '{}:{}'.format(os.path.relpath(filename, PROJECT_ROOT), frame.lineno)
+    frame = traceback[-1]
+    return '{}:{}'.format(frame.filename, frame.lineno)
+
+
+class RouteMemory:
+
+    def __init__(self):
+        self.requests = 0
+        self.measured = 0
+        self.peak_max = 0
+        self.peak_total = 0
+        self.retained_total = 0
+        self.snapshots = 0
+        self.sites = Counter()
+
+    def summary(self, top):
+        measured = self.measured or 1
+        return {
+            "requests": self.requests,
+            "measured": self.measured,
+            "peak_max_kb": round(self.peak_max / 1024, 1),
+            "peak_avg_kb": round(self.peak_total / measured / 1024, 1),
+            "retained_total_kb": round(self.retained_total / 1024, 1),
+            "retained_avg_kb": round(self.retained_total / measured / 1024, 1),
+            "snapshots": self.snapshots,
+            # Bytes per snapshot held by each site when the response was ready.
+            "top_sites": [{"site": site, "kb": round(size / self.snapshots / 1024, 1)}
+                          for site, size in self.sites.most_common(top)] if self.snapshots else [],
+        }
+
+
+class MemoryProfiler:
+
+    def __init__(self, frames=25, snapshot_rate=0.1, top=10):
+        self.frames = frames
+        self.snapshot_rate = snapshot_rate
+        self.top = top
+        self.lock = threading.Lock()
+        self.measuring = threading.Lock()
+        self.routes = {}
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def route(self, endpoint):
+        stats = self.routes.get(endpoint)
+        if stats is None:
+            stats = self.routes.setdefault(endpoint, RouteMemory())
+        return stats
+
+    def begin(self):
+        endpoint = request.endpoint or request.path
+        with self.lock:
+            self.route(endpoint).requests += 1
+        if not tracemalloc.is_tracing() or not self.measuring.acquire(blocking=False):
+            return
+        g.memory_profile = state = {"endpoint": endpoint, "peak": 0, "freed": 0}
+        if random.random() < self.snapshot_rate:
+            state["snapshot"] = tracemalloc.take_snapshot()
+        # After the snapshot, which allocates plenty of its own.
+        tracemalloc.reset_peak()
+        state["start"] = tracemalloc.get_traced_memory()[0]
+
+    def response_ready(self, response):
+        state = g.get('memory_profile')
+        if state is not None and "snapshot" in state:
+            held, state["peak"] = tracemalloc.get_traced_memory()
+            state["sites"] = self.sites_since(state.pop("snapshot"))
+            # The snapshots' own memory is not the request's.
+            state["freed"] = held - tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        return response
+
+    def sites_since(self, before):
+        sites = Counter()
+        for diff in tracemalloc.take_snapshot().compare_to(before, 'traceback'):
+            if diff.size_diff > 0:
+                sites[project_frame(diff.traceback)] += diff.size_diff
+        return sites
+
+    def finish(self, sender, **extra):
+        state = g.pop('memory_profile', None)
+        if state is None:
+            return
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            start = state["start"] - state["freed"]
+            peak = max(peak - start, state["peak"] - state["start"])
+            retained = current - start
+            with self.lock:
+                stats = self.route(state["endpoint"])
+                stats.measured += 1
+                stats.peak_max = max(stats.peak_max, peak)
+                stats.peak_total += peak
+                stats.retained_total += retained
+                if "sites" in state:
+                    stats.snapshots += 1
+                    stats.sites.update(state["sites"])
+        finally:
+            self.measuring.release()
+
+    def report(self, sort='peak_max_kb', limit=20):
+        with self.lock:
+            routes = [dict(stats.summary(self.top), endpoint=endpoint)
+                      for endpoint, stats in self.routes.items()]
+        routes.sort(key=lambda route: route.get(sort) or 0, reverse=True)
+        current = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        return {
+            "tracing": tracemalloc.is_tracing(),
+            "traced_kb": round(current / 1024, 1),
+            # ru_maxrss is in kilobytes on Linux.
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "routes": routes[:limit],
+        }
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+
+# Sampling CPU profile
+# ----------------------------------------------------------------
+#
+# Like py-spy, but from inside the process: the admin request reads every
+# other thread's Python stack at a fixed interval for a few seconds. The result
+# is in the collapsed format flame graph tools read, one line per distinct
+# stack with its sample count. Threads waiting in threading, queue or
+# socket code are left out unless idle samples are asked for; a thread
+# blocked in a C call made straight from our code (a socket recv in
+# events.py, say) cannot be told apart and is sampled as if busy.
+
+IDLE_MODULES = ('threading.py', 'selectors.py', 'socketserver.py', 'queue.py', 'ssl.py', 'socket.py')
+
+cpu_lock = threading.Lock()
+
+
+def stack_of(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def is_idle(frame):
+    return os.path.basename(frame.f_code.co_filename) in IDLE_MODULES
+
+
+def sample_stacks(seconds, interval, idle=False):
+    # Returns (Counter of collapsed stacks, number of sampling rounds).
+    own = threading.get_ident()
+    stacks = Counter()
+    rounds = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own or (not idle and is_idle(frame)):
+                continue
+            stacks[stack_of(frame)] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+
+def cpu_profile(seconds, interval, idle=False):
+    # One profile at a time; returns None while another is running.
+    if not cpu_lock.acquire(blocking=False):
+        return None
+    try:
+        return sample_stacks(seconds, interval, idle)
+    finally:
+        cpu_lock.release()
+
+
+def init_profiling(app):
+    config = app.config
+    if not config['PROFILING_ENABLED']:
+        return None
+    profiler = MemoryProfiler(config['PROFILE_TRACEMALLOC_FRAMES'], config['PROFILE_SNAPSHOT_RATE'],
+                              config['PROFILE_TOP_SITES'])
+    profiler.start()
+    app.before_request(profiler.begin)
+    app.after_request(profiler.response_ready)
+    appcontext_tearing_down.connect(profiler.finish, app)
+    app.extensions['memory_profiler'] = profiler
+    return profiler
@@ -0,0 +1,220 @@
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS, CACHING_DISABLED, NO_CACHE_KEY
+
+from models import db, Venue, Artist, Show, VenueShard
+
+# ----------------------------------------------------------------------------#
+# Prebuilt statements.
+# ----------------------------------------------------------------------------#
+#
+# The hot controller queries, built once at import with bound parameters.
+# SQLAlchemy keys its compiled-statement cache on a statement's structure,
+# so these compile once per process and engine; a call only binds values.
+# Building the statement inline every request gets the same cache entry,
+# but pays for constructing the statement and computing its key each time.
+
+def param(name, **kw):
+    return db.bindparam(name, **kw)
+
+
+VENUE_SHARD = db.select(VenueShard.shard).where(VenueShard.id == param('venue_id'))
+
+VENUE_BY_ID = db.select(Venue).where(Venue.id == param('venue_id'))
+
+ARTIST_BY_ID = db.select(Artist).where(Artist.id == param('artist_id'))
+
+VENUE_NAME = db.select(Venue.name).where(Venue.id == param('venue_id'))
+
+ARTIST_NAME = db.select(Artist.name).where(Artist.id == param('artist_id'))
+
+_upcoming_by_venue = db.select(Show.venue_id, db.func.count(Show.id).label('upcoming')).where(
+    Show.start_time > param('now')).group_by(Show.venue_id).subquery()
+
+VENUE_SUMMARIES = db.select(
+    Venue.id, Venue.name, Venue.version, Venue.city, Venue.state,
+    db.func.coalesce(_upcoming_by_venue.c.upcoming, 0).label('num_upcoming_shows')
+).outerjoin(_upcoming_by_venue, _upcoming_by_venue.c.venue_id == Venue.id).order_by(Venue.id)
+
+VENUE_SEARCH = VENUE_SUMMARIES.where(Venue.name.ilike(param('pattern')))
+
+ARTIST_SEARCH = db.select(Artist.id, Artist.name, Artist.version).where(
+    Artist.name.ilike(param('pattern'))).order_by(Artist.id)
+
+# Expanding: one cached statement for any number of ids.
+ARTIST_UPCOMING_COUNTS = db.select(Show.artist_id, db.func.count(Show.id)).where(
+    Show.artist_id.in_(param('ids', expanding=True))).where(
+    Show.start_time > param('now')).group_by(Show.artist_id)
+
+UPCOMING_SHOWS = {
+    'venue': db.select(Show.artist_id, Artist.name, Artist.image_link, Show.start_time)
+    .join(Artist, Artist.id == Show.artist_id)
+    .where(Show.venue_id == param('entity_id'))
+    .where(Show.start_time > param('now'))
+    .order_by(Show.start_time),
+    'artist': db.select(Show.venue_id, Venue.name, Venue.image_link, Show.start_time)
+    .join(Venue, Venue.id == Show.venue_id)
+    .where(Show.artist_id == param('entity_id'))
+    .where(Show.start_time > param('now'))
+    .order_by(Show.start_time),
+}
+
+
+def contains(key):
+    return '%' + key + '%'
+
+
+def venue_by_id(venue_id):
+    # On the current shard; the caller picks it.
+    return db.session.execute(VENUE_BY_ID, {"venue_id": venue_id}).scalar()
+
+
+def artist_by_id(artist_id):
+    return db.session.execute(ARTIST_BY_ID, {"artist_id": artist_id}).scalar()
+
+
+def venue_name(venue_id):
+    return db.session.execute(VENUE_NAME, {"venue_id": venue_id}).scalar()
+
+
+def artist_name(artist_id):
+    return db.session.execute(ARTIST_NAME, {"artist_id": artist_id}).scalar()
+
+
+def search_artists(key):
+    return db.session.execute(ARTIST_SEARCH, {"pattern": contains(key)}).all()
+
+
+# ----------------------------------------------------------------------------#
+# Compiled cache statistics.
+# ----------------------------------------------------------------------------#
+#
+# Every execution reports whether its compiled form came from the cache.
+# "disabled" is a statement run with caching off, "uncacheable" one that
+# has no cache key (textual SQL, for instance).
+
+OUTCOMES = {
+    CACHE_HIT: 'hits',
+    CACHE_MISS: 'misses',
+    CACHING_DISABLED: 'disabled',
+    NO_CACHE_KEY: 'uncacheable',
+}
+
+
+class StatementCacheStats:
+
+    def __init__(self):
+        self.counts = dict.fromkeys(OUTCOMES.values(), 0)
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        outcome = OUTCOMES.get(getattr(context, 'cache_hit', None))
+        if outcome is not None:
+            # A lost increment under contention only blurs the ratio.
+            self.counts[outcome] += 1
+
+    def reset(self):
+        self.counts = dict.fromkeys(OUTCOMES.values(), 0)
+
+    def stats(self, engines=()):
+        counts = dict(self.counts)
+        cached = counts['hits'] + counts['misses']
+        counts["hit_rate"] = round(counts['hits'] / cached, 4) if cached else None
+        counts["engines"] = {
+            name or 'default': {
+                "entries": len(engine._compiled_cache) if engine._compiled_cache is not None else 0,
+                "size": engine._compiled_cache.capacity if engine._compiled_cache is not None else 0,
+            }
+            for name, engine in engines
+        }
+        return counts
+
+
+def init_statement_stats(app):
+    if not app.config['STATEMENT_CACHE_STATS_ENABLED']:
+        return None
+    stats = StatementCacheStats()
+    event.listen(Engine, 'after_cursor_execute', stats.after_execute)
+    app.extensions['statement_cache'] = stats
+    return stats
+
+
+# ----------------------------------------------------------------------------#
+# CLI.
+# ----------------------------------------------------------------------------#
+#
+# `flask queries bench` times each hot query three ways on the configured
+# database: built inline with caching off (compiled on every call), built
+# inline per call as the controllers used to, and the prebuilt statement.
+# The difference is the Python-side overhead per call; the round trip to
+# the database is the same in all three.
+
+queries_cli = AppGroup('queries', help='Inspect the prebuilt statements.')
+
+
+def bench_cases():
+    now = datetime.now()
+    venue_id = db.session.execute(db.select(db.func.min(Venue.id))).scalar() or 1
+    artist_id = db.session.execute(db.select(db.func.min(Artist.id))).scalar() or 1
+    ids = db.session.execute(db.select(Artist.id).order_by(Artist.id).limit(20)).scalars().all() or [artist_id]
+
+    def venue_search_inline():
+        upcoming = db.select(Show.venue_id, db.func.count(Show.id).label('upcoming')).where(
+            Show.start_time > now).group_by(Show.venue_id).subquery()
+        return db.select(
+            Venue.id, Venue.name, Venue.version, Venue.city, Venue.state,
+            db.func.coalesce(upcoming.c.upcoming, 0).label('num_upcoming_shows')
+        ).outerjoin(upcoming, upcoming.c.venue_id == Venue.id).where(
+            Venue.name.ilike('%a%')).order_by(Venue.id), {}
+
+    return [
+        ('venue by id',
+         lambda: (db.select(Venue).where(Venue.id == venue_id), {}),
+         VENUE_BY_ID, {"venue_id": venue_id}),
+        ('venue shard',
+         lambda: (db.select(VenueShard.shard).where(VenueShard.id == venue_id), {}),
+         VENUE_SHARD, {"venue_id": venue_id}),
+        ('venue search', venue_search_inline, VENUE_SEARCH, {"pattern": '%a%', "now": now}),
+        ('artist search',
+         lambda: (db.select(Artist.id, Artist.name, Artist.version).where(Artist.name.ilike('%a%')), {}),
+         ARTIST_SEARCH, {"pattern": '%a%'}),
+        ('artist upcoming counts',
+         lambda: (db.select(Show.artist_id, db.func.count(Show.id)).where(Show.artist_id.in_(ids)).where(
+             Show.start_time > now).group_by(Show.artist_id), {}),
+         ARTIST_UPCOMING_COUNTS, {"ids": ids, "now": now}),
+        ('upcoming shows',
+         lambda: (db.select(Show.artist_id, Artist.name, Artist.image_link, Show.start_time)
+                  .join(Artist, Artist.id == Show.artist_id).where(Show.venue_id == venue_id)
+                  .where(Show.start_time > now).order_by(Show.start_time), {}),
+         UPCOMING_SHOWS['venue'], {"entity_id": venue_id, "now": now}),
+    ]
+
+
+def time_calls(conn, build, iterations):
+    began = time.perf_counter()
+    for _ in range(iterations):
+        statement, params = build()
+        conn.execute(statement, params).all()
+    return (time.perf_counter() - began) / iterations * 1e6
+
+
+@queries_cli.command('bench')
+@click.option('--iterations', default=2000, show_default=True)
+def bench_command(iterations):
+    cases = bench_cases()
+    click.echo('{:<24} {:>12} {:>12} {:>12}'.format('us per call', 'uncached', 'inline', 'prebuilt'))
+    with db.engine.connect() as conn, db.engine.execution_options(compiled_cache=None).connect() as uncached:
+        for name, inline, prebuilt, params in cases:
+            # One untimed call of each warms the cache and the connection.
+            time_calls(conn, inline, 1)
+            time_calls(conn, lambda: (prebuilt, params), 1)
+            timings = (
+                time_calls(uncached, inline, iterations),
+                time_calls(conn, inline, iterations),
+                time_calls(conn, lambda: (prebuilt, params), iterations),
+            )
+            click.echo('{:<24} {:>12.1f} {:>12.1f} {:>12.1f}'.format(name, *timings))
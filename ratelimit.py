@@ -0,0 +1,100 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+# ----------------------------------------------------------------------------#
+# Rate limiting.
+# ----------------------------------------------------------------------------#
+
+# owner fingerprint, tokens left, last update (unix time)
+SLOT = struct.Struct('<Qdd')
+STRIPES = 64
+
+
+class TokenBucketStore:
+    # A fixed table of token buckets in a memory-mapped file. Every worker
+    # on the host maps the same file; a byte-range lock on the slot keeps
+    # processes apart and a striped lock keeps threads of one process apart.
+    # Keys that hash to the same slot evict each other, which only ever
+    # gives the newcomer a full bucket.
+
+    def __init__(self, path, slots):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.slots = slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * SLOT.size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.locks = [threading.Lock() for _ in range(STRIPES)]
+
+    def take(self, key, capacity, rate, now=None):
+        # Takes one token. Returns 0 on success, otherwise the seconds until
+        # a token will be available.
+        now = time.time() if now is None else now
+        fingerprint = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        slot = fingerprint % self.slots
+        offset = slot * SLOT.size
+        with self.locks[slot % STRIPES]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, SLOT.size, offset)
+            try:
+                owner, tokens, updated = SLOT.unpack_from(self.map, offset)
+                if owner != fingerprint or now < updated:
+                    # New key, evicted key or the clock stepped back.
+                    tokens, updated = capacity, now
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0.0
+                else:
+                    wait = (1 - tokens) / rate
+                SLOT.pack_into(self.map, offset, fingerprint, tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, SLOT.size, offset)
+        return wait
+
+
+class RateLimiter:
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+
+    def check(self, name):
+        burst, per_second = self.limits[name]
+        # remote_addr only: X-Forwarded-For is not trusted unless a proxy
+        # fixer has already rewritten it.
+        wait = self.store.take('{}:{}'.format(name, request.remote_addr), burst, per_second)
+        if wait:
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+
+def rate_limited(name):
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiter')
+            if limiter is not None:
+                limiter.check(name)
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def init_rate_limiter(app):
+    config = app.config
+    if not config['RATE_LIMIT_ENABLED']:
+        return None
+    store = TokenBucketStore(config['RATE_LIMIT_FILE'], config['RATE_LIMIT_SLOTS'])
+    limiter = RateLimiter(store, config['RATE_LIMITS'])
+    app.extensions['rate_limiter'] = limiter
+    return limiter
@@ -0,0 +1,418 @@
+import bisect
+import heapq
+import os
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import db, Venue, Artist, Show, ChangeLog
+from sharding import scatter, shard_names
+from venue_shards import venue_shards
+
+# ----------------------------------------------------------------------------#
+# Catalog read model.
+# ----------------------------------------------------------------------------#
+#
+# Venues, artists and their upcoming show times, held in memory so the
+# listing pages and searches run without SQL. Writers add a row to
+# change_log in the same transaction as their change; a background thread
+# in each process applies new rows, and is woken right after a commit that
+# logged something. A full rebuild runs every READ_MODEL_REBUILD_INTERVAL as
+# a safety net, and change_log rows older than CHANGE_LOG_RETENTION (which
+# must be longer) are pruned then. A process that has committed a change
+# applies it before its next read, so a redirect after a form shows it.
+#
+# change_log ids come from a sequence, so they are handed out in order but
+# can commit out of order: a row with a lower id can become visible after
+# one with a higher id has been applied. Ids skipped over by a refresh are
+# kept as gaps and asked for again until they show up or GAP_TIMEOUT passes
+# (a rolled back transaction leaves a gap that never fills).
+
+REFRESH_BATCH = 5000
+GAP_WINDOW = 1000
+GAP_TIMEOUT = 60
+
+
+def log_change(kind, entity_id, op='upsert'):
+    # Call before the commit that makes the change.
+    db.session.add(ChangeLog(kind=kind, entity_id=entity_id, op=op, created_at=datetime.now()))
+    db.session.info['catalog_changed'] = True
+
+
+class VenueRecord:
+    __slots__ = ('id', 'name', 'key', 'city', 'state', 'version', 'upcoming')
+
+    def __init__(self, id, name, city, state, version, upcoming):
+        self.id = id
+        self.name = name
+        self.key = (name or '').casefold()
+        self.city = city
+        self.state = state
+        self.version = version
+        # Sorted start times (unix seconds) of upcoming shows.
+        self.upcoming = upcoming
+
+
+class ArtistRecord:
+    __slots__ = ('id', 'name', 'key', 'version', 'upcoming')
+
+    def __init__(self, id, name, version, upcoming):
+        self.id = id
+        self.name = name
+        self.key = (name or '').casefold()
+        self.version = version
+        self.upcoming = upcoming
+
+
+def trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+class NameIndex:
+    # Trigram postings over casefolded names, for substring search. A
+    # candidate has every trigram of the term, which is necessary but not
+    # sufficient; the caller checks the match.
+
+    def __init__(self, records=()):
+        self.grams = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        for gram in trigrams(record.key):
+            self.grams.setdefault(gram, set()).add(record.id)
+
+    def remove(self, record):
+        for gram in trigrams(record.key):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(record.id)
+                if not ids:
+                    del self.grams[gram]
+
+    def candidates(self, key):
+        # None when the term is too short to narrow anything down.
+        grams = trigrams(key)
+        if not grams:
+            return None
+        postings = sorted((self.grams.get(gram, ()) for gram in grams), key=len)
+        found = set(postings[0])
+        for ids in postings[1:]:
+            if not found:
+                break
+            found &= ids
+        return found
+
+
+def upcoming_count(record, now):
+    return len(record.upcoming) - bisect.bisect_right(record.upcoming, now)
+
+
+def start_times(rows):
+    # [(entity_id, start_time), ...] -> {entity_id: array of sorted timestamps}
+    times = {}
+    for entity_id, start_time in rows:
+        times.setdefault(entity_id, []).append(start_time.timestamp())
+    return {entity_id: array('d', sorted(values)) for entity_id, values in times.items()}
+
+
+class ReadModel:
+
+    def __init__(self, app, refresh_interval=2, rebuild_interval=3600, retention=86400):
+        self.app = app
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.retention = retention
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.wake = threading.Event()
+        # Commits in this process that logged changes, and how many of
+        # them the model has caught up with.
+        self.changes = 0
+        self.applied = 0
+        self.venues = {}
+        self.artists = {}
+        self.by_area = {}
+        self.venue_names = NameIndex()
+        self.artist_names = NameIndex()
+        self.last_id = 0
+        # change_log id -> time.monotonic() it was first skipped over.
+        self.gaps = {}
+        self.built_at = None
+        self.thread = None
+        self.pid = None
+
+    # Loading
+    # ----------------------------------------------------------------
+
+    def load_venues(self, ids, now):
+        # ids=None loads every venue; otherwise only the given ones, each
+        # from its own shard. Only upcoming shows are kept, and those are
+        # never archived, so `shows` alone is enough here.
+        if ids is None:
+            shards = shard_names()
+            venue_query = db.select(Venue.id, Venue.name, Venue.city, Venue.state, Venue.version)
+            show_query = db.select(Show.venue_id, Show.start_time).where(Show.start_time > now)
+        else:
+            shards = list(venue_shards(ids))
+            venue_query = db.select(Venue.id, Venue.name, Venue.city, Venue.state, Venue.version).where(
+                Venue.id.in_(ids))
+            show_query = db.select(Show.venue_id, Show.start_time).where(Show.start_time > now).where(
+                Show.venue_id.in_(ids))
+        records = {}
+        for _, (venue_rows, show_rows) in scatter(
+                lambda conn: (conn.execute(venue_query).all(), conn.execute(show_query).all()), shards):
+            times = start_times(show_rows)
+            for venue_id, name, city, state, version in venue_rows:
+                records[venue_id] = VenueRecord(venue_id, name, city, state, version,
+                                                times.get(venue_id, array('d')))
+        return records
+
+    def load_artists(self, ids, now):
+        artist_query = db.select(Artist.id, Artist.name, Artist.version)
+        show_query = db.select(Show.artist_id, Show.start_time).where(Show.start_time > now)
+        if ids is not None:
+            artist_query = artist_query.where(Artist.id.in_(ids))
+            show_query = show_query.where(Show.artist_id.in_(ids))
+        # An artist's shows can be on any shard.
+        rows = []
+        for _, result in scatter(lambda conn: conn.execute(show_query).all()):
+            rows.extend(result)
+        times = start_times(rows)
+        return {artist_id: ArtistRecord(artist_id, name, version, times.get(artist_id, array('d')))
+                for artist_id, name, version in db.session.execute(artist_query)}
+
+    def rebuild(self):
+        now = datetime.now()
+        # Read the log position first: anything logged while loading is
+        # applied again by the next refresh, which is harmless.
+        last_id = db.session.execute(db.select(db.func.max(ChangeLog.id))).scalar() or 0
+        # Rows below last_id may still be uncommitted: the missing ids just
+        # below it start out as gaps.
+        present = set(db.session.execute(
+            db.select(ChangeLog.id).where(ChangeLog.id > last_id - GAP_WINDOW)).scalars())
+        noticed = time.monotonic()
+        gaps = {i: noticed for i in range(max(last_id - GAP_WINDOW, 0) + 1, last_id) if i not in present}
+        venues = self.load_venues(None, now)
+        artists = self.load_artists(None, now)
+        db.session.execute(db.delete(ChangeLog).where(
+            ChangeLog.created_at < now - timedelta(seconds=self.retention)))
+        db.session.commit()
+        by_area = {}
+        for record in venues.values():
+            by_area.setdefault((record.state, record.city), []).append(record.id)
+        with self.lock:
+            self.venues = venues
+            self.artists = artists
+            self.by_area = {area: sorted(ids) for area, ids in by_area.items()}
+            self.venue_names = NameIndex(venues.values())
+            self.artist_names = NameIndex(artists.values())
+            self.last_id = last_id
+            self.gaps = gaps
+            self.built_at = time.monotonic()
+
+    def refresh(self):
+        if self.built_at is None or time.monotonic() - self.built_at > self.rebuild_interval:
+            self.rebuild()
+            return
+        while True:
+            noticed = time.monotonic()
+            gaps = {i: at for i, at in self.gaps.items() if noticed - at < GAP_TIMEOUT}
+            unseen = ChangeLog.id > self.last_id
+            if gaps:
+                unseen = db.or_(unseen, ChangeLog.id.in_(list(gaps)))
+            rows = db.session.execute(
+                db.select(ChangeLog.id, ChangeLog.kind, ChangeLog.entity_id, ChangeLog.op)
+                .where(unseen).order_by(ChangeLog.id).limit(REFRESH_BATCH)
+            ).all()
+            db.session.rollback()
+            if not rows:
+                self.gaps = gaps
+                return
+            last_id = max(self.last_id, rows[-1].id)
+            seen = {row.id for row in rows}
+            for i in range(self.last_id + 1, last_id):
+                if i not in seen:
+                    gaps[i] = noticed
+            for i in seen:
+                gaps.pop(i, None)
+            if len(gaps) > GAP_WINDOW:
+                gaps = dict(sorted(gaps.items())[-GAP_WINDOW:])
+            # Rows can arrive out of order, so every entry reloads the
+            # entity as it is now; one that is gone is dropped.
+            latest = {(kind, entity_id) for _, kind, entity_id, _ in rows}
+            now = datetime.now()
+            venue_ids = [i for kind, i in latest if kind == 'venue']
+            artist_ids = [i for kind, i in latest if kind == 'artist']
+            venues = self.load_venues(venue_ids, now) if venue_ids else {}
+            artists = self.load_artists(artist_ids, now) if artist_ids else {}
+            applied = []
+            with self.lock:
+                for kind, entity_id in latest:
+                    if kind == 'venue':
+                        old = self.drop_venue(entity_id)
+                        new = venues.get(entity_id)
+                        if new is not None:
+                            self.add_venue(new)
+                    elif kind == 'artist':
+                        old = self.drop_artist(entity_id)
+                        new = artists.get(entity_id)
+                        if new is not None:
+                            self.add_artist(new)
+                    else:
+                        continue
+                    applied.append((kind, entity_id, old, new))
+                self.last_id = last_id
+                self.gaps = gaps
+            # Searches are served from here, so cached results computed
+            # before the change was applied are dropped now. Feeds cached
+            # by this worker go too, for changes made by other workers.
+            search_cache = self.app.extensions.get('search_cache')
+            feed_cache = self.app.extensions.get('feed_cache')
+            matcher = self.app.extensions.get('matcher')
+            for kind, entity_id, old, new in applied:
+                if search_cache is not None:
+                    search_cache.invalidate(kind + 's', entity_id, new and new.name)
+                    if old is not None and (new is None or old.name != new.name):
+                        search_cache.invalidate(kind + 's', entity_id, old.name)
+                if feed_cache is not None:
+                    feed_cache.invalidate(kind, entity_id, sitemap=old is None or new is None)
+            # The matcher's indexes follow the same changes.
+            if matcher is not None:
+                matcher.reload([i for kind, i, _, _ in applied if kind == 'venue'],
+                               [i for kind, i, _, _ in applied if kind == 'artist'])
+            if len(rows) < REFRESH_BATCH:
+                return
+
+    def drop_venue(self, venue_id):
+        record = self.venues.pop(venue_id, None)
+        if record is not None:
+            self.venue_names.remove(record)
+            ids = self.by_area.get((record.state, record.city))
+            if ids is not None:
+                ids.remove(venue_id)
+                if not ids:
+                    del self.by_area[(record.state, record.city)]
+        return record
+
+    def add_venue(self, record):
+        self.venues[record.id] = record
+        self.venue_names.add(record)
+        bisect.insort(self.by_area.setdefault((record.state, record.city), []), record.id)
+
+    def drop_artist(self, artist_id):
+        record = self.artists.pop(artist_id, None)
+        if record is not None:
+            self.artist_names.remove(record)
+        return record
+
+    def add_artist(self, record):
+        self.artists[record.id] = record
+        self.artist_names.add(record)
+
+    # Background refresh
+    # ----------------------------------------------------------------
+
+    def ensure_running(self):
+        # Started lazily so every forked worker gets its own thread.
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.built_at = None
+                    self.refresh_lock = threading.Lock()
+                    self.catch_up()
+                    self.pid = os.getpid()
+                    self.thread = threading.Thread(target=self.run, name='read-model', daemon=True)
+                    self.thread.start()
+        elif self.applied != self.changes:
+            try:
+                self.catch_up()
+            except Exception:
+                # Serve what is there; the background thread retries.
+                self.app.logger.exception('Read model refresh failed')
+
+    def catch_up(self):
+        # A fresh app context gets its own session, leaving the caller's
+        # transaction alone.
+        with self.refresh_lock:
+            target = self.changes
+            with self.app.app_context():
+                self.refresh()
+            self.applied = target
+
+    def run(self):
+        while True:
+            self.wake.wait(self.refresh_interval)
+            self.wake.clear()
+            try:
+                self.catch_up()
+            except Exception:
+                self.app.logger.exception('Read model refresh failed')
+
+    def changed(self, session):
+        if session.info.pop('catalog_changed', False):
+            self.changes += 1
+            self.wake.set()
+
+    # Queries
+    # ----------------------------------------------------------------
+
+    def recent_venues(self, limit):
+        self.ensure_running()
+        with self.lock:
+            return [self.venues[i] for i in heapq.nlargest(limit, self.venues)]
+
+    def recent_artists(self, limit):
+        self.ensure_running()
+        with self.lock:
+            return [self.artists[i] for i in heapq.nlargest(limit, self.artists)]
+
+    def areas(self):
+        # [(city, state, [venue dict, ...]), ...] grouped like /venues.
+        self.ensure_running()
+        now = time.time()
+        with self.lock:
+            return [(city, state, [self.venue_summary(self.venues[i], now) for i in ids])
+                    for (state, city), ids in sorted(self.by_area.items())]
+
+    def all_artists(self):
+        self.ensure_running()
+        with self.lock:
+            return [self.artists[i] for i in sorted(self.artists)]
+
+    def search_venues(self, term):
+        self.ensure_running()
+        key = term.casefold()
+        now = time.time()
+        with self.lock:
+            ids = self.venue_names.candidates(key)
+            return [self.venue_summary(self.venues[i], now) for i in sorted(self.venues if ids is None else ids)
+                    if key in self.venues[i].key]
+
+    def search_artists(self, term):
+        self.ensure_running()
+        key = term.casefold()
+        now = time.time()
+        with self.lock:
+            ids = self.artist_names.candidates(key)
+            return [{"id": r.id, "name": r.name, "version": r.version, "num_upcoming_shows": upcoming_count(r, now)}
+                    for r in (self.artists[i] for i in sorted(self.artists if ids is None else ids))
+                    if key in r.key]
+
+    def venue_summary(self, record, now):
+        return {"id": record.id, "name": record.name, "version": record.version,
+                "num_upcoming_shows": upcoming_count(record, now)}
+
+
+def init_read_model(app):
+    config = app.config
+    if not config['READ_MODEL_ENABLED']:
+        return None
+    read_model = ReadModel(app, config['READ_MODEL_REFRESH_INTERVAL'],
+                           config['READ_MODEL_REBUILD_INTERVAL'], config['CHANGE_LOG_RETENTION'])
+    event.listen(db.session, 'after_commit', read_model.changed)
+    app.extensions['read_model'] = read_model
+    return read_model
@@ -0,0 +1,196 @@
+"""Replay captured traffic against a running Fyyur instance.
+
+    python replay.py run traffic/requests.jsonl --target http://127.0.0.1:5000 \\
+        --concurrency 8 --speedup 4 --out results/build-42.json
+    python replay.py diff results/build-41.json results/build-42.json
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def route_of(record):
+    return '{} {}'.format(record['method'], ID_SEGMENT.sub('/<id>', record['path']))
+
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+opener = urllib.request.build_opener(NoRedirect)
+
+
+def send(target, record, timeout):
+    url = target.rstrip('/') + record['path']
+    if record.get('query'):
+        url += '?' + record['query']
+    data = None
+    headers = {'User-Agent': 'fyyur-replay'}
+    if record.get('json') is not None:
+        data = json.dumps(record['json']).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    elif record.get('form') is not None:
+        data = urllib.parse.urlencode(record['form'], doseq=True).encode('utf-8')
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    req = urllib.request.Request(url, data=data, headers=headers, method=record['method'])
+    started = time.perf_counter()
+    try:
+        with opener.open(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return status, (time.perf_counter() - started) * 1000
+
+
+def run(records, target, concurrency, speedup, timeout):
+    # With a speed-up, requests keep the captured spacing divided by the
+    # factor; speed-up 0 sends them as fast as the pool allows.
+    results = []
+    lock = threading.Lock()
+    origin = records[0]['ts'] if records else 0
+    started = time.perf_counter()
+
+    def fire(record):
+        status, latency = send(target, record, timeout)
+        with lock:
+            results.append((route_of(record), status, record.get('status'), latency))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            if speedup > 0:
+                delay = (record['ts'] - origin) / speedup - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(fire, record)
+    elapsed = time.perf_counter() - started
+    return summarize(results, elapsed)
+
+
+def summarize(results, elapsed):
+    routes = {}
+    for route, status, expected, latency in results:
+        routes.setdefault(route, []).append((status, expected, latency))
+
+    def stats(rows):
+        latencies = [r[2] for r in rows]
+        errors = sum(1 for status, _, _ in rows if status is None or status >= 500)
+        mismatched = sum(1 for status, expected, _ in rows if expected is not None and status != expected)
+        return {
+            "requests": len(rows),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p90_ms": round(percentile(latencies, 90), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "error_rate": round(errors / len(rows), 4),
+            "status_mismatch_rate": round(mismatched / len(rows), 4),
+        }
+
+    all_rows = [row for rows in routes.values() for row in rows]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(all_rows) / elapsed, 2) if elapsed else None,
+        "overall": stats(all_rows) if all_rows else None,
+        "routes": {route: stats(rows) for route, rows in sorted(routes.items())},
+    }
+
+
+def diff(old, new):
+    lines = []
+
+    def change(label, a, b):
+        if a is None or b is None:
+            return '{:<44} {:>10} -> {:>10}'.format(label, str(a), str(b))
+        pct = ((b - a) / a * 100) if a else 0.0
+        return '{:<44} {:>10} -> {:>10} ({:+.1f}%)'.format(label, a, b, pct)
+
+    lines.append(change('throughput_rps', old.get('throughput_rps'), new.get('throughput_rps')))
+    for route in sorted(set(old['routes']) | set(new['routes'])):
+        a = old['routes'].get(route)
+        b = new['routes'].get(route)
+        if a is None or b is None:
+            lines.append('{:<44} {}'.format(route, 'only in new run' if a is None else 'only in old run'))
+            continue
+        for key in ('p50_ms', 'p99_ms', 'error_rate'):
+            lines.append(change('{} {}'.format(route, key), a[key], b[key]))
+    return '\n'.join(lines)
+
+
+def print_report(report):
+    print('elapsed {elapsed_s}s, {throughput_rps} req/s'.format(**report))
+    print('{:<44} {:>6} {:>9} {:>9} {:>9} {:>7}'.format('route', 'n', 'p50', 'p90', 'p99', 'errors'))
+    for route, s in report['routes'].items():
+        print('{:<44} {:>6} {:>9} {:>9} {:>9} {:>6.1%}'.format(
+            route, s['requests'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['error_rate']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help='Replay a capture file.')
+    run_parser.add_argument('capture')
+    run_parser.add_argument('--target', default='http://127.0.0.1:5000')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--speedup', type=float, default=1.0,
+                            help='Time compression factor; 0 replays without pauses.')
+    run_parser.add_argument('--timeout', type=float, default=30.0)
+    run_parser.add_argument('--limit', type=int, default=None)
+    run_parser.add_argument('--out', help='Write the JSON report here.')
+    run_parser.add_argument('--baseline', help='Previous report to diff against.')
+
+    diff_parser = sub.add_parser('diff', help='Compare two reports.')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if args.command == 'diff':
+        with open(args.old) as f_old, open(args.new) as f_new:
+            print(diff(json.load(f_old), json.load(f_new)))
+        return 0
+
+    records = sorted(load(args.capture), key=lambda r: r['ts'])[:args.limit]
+    if not records:
+        print('No records in ' + args.capture, file=sys.stderr)
+        return 1
+    report = run(records, args.target, args.concurrency, args.speedup, args.timeout)
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print()
+            print(diff(json.load(f), report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
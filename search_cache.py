@@ -0,0 +1,84 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------------#
+# Search result cache.
+# ----------------------------------------------------------------------------#
+
+_SPACE = re.compile(r'\s+')
+
+
+def normalize_term(term):
+    return _SPACE.sub(' ', term or '').strip().casefold()
+
+
+class SearchCache:
+    # LRU with a TTL, keyed on (kind, normalized term). Each entry remembers
+    # the ids in its result so a write only drops the searches it can change:
+    # those listing the entity, and those whose term matches its new name.
+    # Per process; the TTL bounds how long other workers serve stale results.
+
+    def __init__(self, max_entries=1000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, kind, term):
+        key = (kind, term)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None, self.generation
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2], self.generation
+
+    def put(self, kind, term, result, ids, generation):
+        with self.lock:
+            # Something was invalidated while this result was computed; it
+            # may already be stale, so it is not kept.
+            if generation != self.generation:
+                return
+            self.entries[(kind, term)] = (time.monotonic() + self.ttl, frozenset(ids), result)
+            self.entries.move_to_end((kind, term))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, kind, entity_id=None, name=None):
+        name = normalize_term(name) if name else None
+        with self.lock:
+            self.generation += 1
+            stale = [key for key, (_, ids, _) in self.entries.items()
+                     if key[0] == kind and (entity_id in ids or (name is not None and key[1] in name))]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "invalidated": self.invalidations,
+            }
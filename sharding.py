@@ -0,0 +1,91 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.util import find_tables
+
+# ----------------------------------------------------------------------------#
+# Sharding.
+# ----------------------------------------------------------------------------#
+#
+# Venues, their shows and archived shows live on the shard that SHARD_MAP
+# assigns to the venue's state. Shards are SQLAlchemy binds; shard None is
+# the default database, which holds unmapped states as well as the global
+# tables (artists, jobs and the venue directory).
+
+GLOBAL_TABLES = frozenset(['jobs', 'venue_shards', 'change_log', 'page_views', 'trending', 'link_checks'])
+
+current_shard = contextvars.ContextVar('current_shard', default=None)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def is_global(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in GLOBAL_TABLES
+    if clause is not None:
+        return any(table.name in GLOBAL_TABLES for table in find_tables(clause, include_crud=True))
+    return False
+
+
+class ShardSession(Session):
+    # Everything but the global tables goes to the shard selected with
+    # using_shard(); outside of it the normal bind rules apply.
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = current_shard.get()
+        if bind is None and shard is not None and not is_global(mapper, clause):
+            return self._db.engines[shard]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@contextmanager
+def using_shard(shard):
+    token = current_shard.set(shard)
+    try:
+        yield shard
+    finally:
+        current_shard.reset(token)
+
+
+def shard_names():
+    return [None] + sorted(current_app.config['SHARDS'])
+
+
+def shard_for_state(state):
+    shard = current_app.config['SHARD_MAP'].get(state)
+    if shard is not None and shard not in current_app.config['SHARDS']:
+        raise ValueError('SHARD_MAP sends {} to unknown shard {}'.format(state, shard))
+    return shard
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config['SHARD_FANOUT_WORKERS'],
+                                           thread_name_prefix='shard')
+    return _executor
+
+
+def scatter(query, shards=None):
+    # Runs query(connection) on each shard concurrently and returns
+    # [(shard, result), ...] in shard order. Workers run in a copy of the
+    # caller's context so request logging still sees their statements.
+    engines = current_app.extensions['sqlalchemy'].engines
+    shards = shard_names() if shards is None else list(shards)
+
+    def run(shard):
+        with engines[shard].connect() as conn:
+            return query(conn)
+
+    if len(shards) == 1:
+        return [(shards[0], run(shards[0]))]
+    pool = executor()
+    futures = [(shard, pool.submit(contextvars.copy_context().run, run, shard)) for shard in shards]
+    return [(shard, future.result()) for shard, future in futures]
@@ -0,0 +1,218 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import time
+import traceback
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from structured_logging import SizedTimedRotatingFileHandler
+
+# ----------------------------------------------------------------------------#
+# Slow query log.
+# ----------------------------------------------------------------------------#
+
+logger = logging.getLogger('fyyur.slow_query')
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+MAX_PARAM_LENGTH = 200
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\?|:\w+|\$\d+|__\[POSTCOMPILE_\w+\]')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+
+def normalize_statement(statement):
+    sql = _STRING.sub('?', statement)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def short_params(parameters):
+    text = repr(parameters)
+    if len(text) > MAX_PARAM_LENGTH:
+        text = text[:MAX_PARAM_LENGTH] + '...'
+    return text
+
+
+def calling_frame():
+    # Innermost frame that belongs to this project rather than a library.
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(PROJECT_ROOT) and 'site-packages' not in filename \
+                and filename != os.path.abspath(__file__):
+            return '{}:{} in {}'.format(os.path.relpath(filename, PROJECT_ROOT), frame.lineno, frame.name)
+    return None
+
+
+class SlowQueryRecorder:
+
+    def __init__(self, threshold_ms, explain=True, analyze=False):
+        self.threshold = threshold_ms / 1000.0
+        self.explain = explain
+        self.analyze = analyze
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('slow_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed < self.threshold:
+            return
+        record = self.record(elapsed, statement, parameters)
+        if self.explain and not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+            record["plan"] = self.explain_plan(conn, cursor, statement, parameters)
+        logger.warning(json.dumps(record, default=str))
+
+    def failed(self, context):
+        # A statement that raised never reaches after_cursor_execute, so its
+        # start is popped here; otherwise the next statement on the
+        # connection would be timed from it. A slow failure (a statement
+        # timeout, say) is logged, without a plan.
+        conn = context.connection
+        if conn is None or context.execution_context is None or context.statement is None:
+            return
+        starts = conn.info.get('slow_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed >= self.threshold:
+            record = self.record(elapsed, context.statement, context.parameters)
+            record["error"] = str(context.original_exception)
+            logger.warning(json.dumps(record, default=str))
+
+    def record(self, elapsed, statement, parameters):
+        return {
+            "duration_ms": round(elapsed * 1000, 2),
+            "statement": statement,
+            "normalized": normalize_statement(statement),
+            "parameters": short_params(parameters),
+            "route": request.endpoint if has_request_context() else None,
+            "frame": calling_frame(),
+        }
+
+    def explain_plan(self, conn, cursor, statement, parameters):
+        # Runs on a raw DBAPI cursor so it does not re-enter these events.
+        dialect = conn.dialect.name
+        if dialect == 'postgresql':
+            prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if self.analyze else 'EXPLAIN '
+        elif dialect == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        raw = cursor.connection.cursor()
+        try:
+            if dialect == 'postgresql':
+                # A failed EXPLAIN must not abort the caller's transaction.
+                raw.execute('SAVEPOINT slow_query_explain')
+            try:
+                raw.execute(prefix + statement, parameters)
+                rows = raw.fetchall()
+            finally:
+                if dialect == 'postgresql':
+                    raw.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return '\n'.join(' | '.join(str(col) for col in row) for row in rows)
+        except Exception as e:
+            return 'EXPLAIN failed: {}'.format(e)
+        finally:
+            raw.close()
+
+
+def init_slow_query_log(app):
+    config = app.config
+    if not config['SLOW_QUERY_LOG_ENABLED']:
+        return None
+    recorder = SlowQueryRecorder(
+        config['SLOW_QUERY_THRESHOLD_MS'],
+        explain=config['SLOW_QUERY_EXPLAIN'],
+        analyze=config['SLOW_QUERY_EXPLAIN_ANALYZE']
+    )
+    event.listen(Engine, 'before_cursor_execute', recorder.before)
+    event.listen(Engine, 'after_cursor_execute', recorder.after)
+    event.listen(Engine, 'handle_error', recorder.failed)
+
+    # Every worker appends to the same file; this handler locks around
+    # writes and rotation.
+    file_handler = SizedTimedRotatingFileHandler(
+        config['SLOW_QUERY_LOG_FILE'],
+        max_bytes=config['SLOW_QUERY_LOG_MAX_BYTES'],
+        when=config['SLOW_QUERY_LOG_ROTATE_WHEN'],
+        backupCount=config['SLOW_QUERY_LOG_BACKUP_COUNT'],
+        delay=True
+    )
+    file_handler.setFormatter(logging.Formatter('%(message)s'))
+    queue_handler = QueueHandler(queue.Queue(-1))
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_listener():
+        # A worker forked after import has the queue but not the thread.
+        listener.queue = queue_handler.queue = queue.Queue(-1)
+        listener._thread = None
+        listener.start()
+
+    os.register_at_fork(after_in_child=restart_listener)
+    return recorder
+
+
+def read_records(path, limit):
+    # Only the live file is read; rotated files age out of the report.
+    try:
+        with open(path) as f:
+            lines = deque(f, maxlen=limit)
+    except FileNotFoundError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def aggregate(records):
+    groups = {}
+    for record in records:
+        key = record.get('normalized') or normalize_statement(record['statement'])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                "normalized": key,
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "routes": set(),
+                "slowest": record,
+            }
+        group["count"] += 1
+        group["total_ms"] += record['duration_ms']
+        if record['duration_ms'] >= group["max_ms"]:
+            group["max_ms"] = record['duration_ms']
+            group["slowest"] = record
+        if record.get('route'):
+            group["routes"].add(record['route'])
+    result = sorted(groups.values(), key=lambda g: g["total_ms"], reverse=True)
+    for group in result:
+        group["avg_ms"] = round(group["total_ms"] / group["count"], 2)
+        group["total_ms"] = round(group["total_ms"], 2)
+        group["routes"] = sorted(group["routes"])
+    return result
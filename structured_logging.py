@@ -0,0 +1,209 @@
+import atexit
+import copy
+import fcntl
+import json
+import logging
+import os
+import queue
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ----------------------------------------------------------------------------#
+# Structured, non-blocking logging.
+# ----------------------------------------------------------------------------#
+
+CONTEXT_FIELDS = ('request_id', 'route', 'method', 'path', 'status', 'latency_ms', 'sql_count')
+
+
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    # Rotates at the configured interval or once the file passes max_bytes,
+    # whichever comes first.
+    #
+    # Every worker process writes to the same file, so each write holds a
+    # lock on <file>.lock. Under it, a process whose file was rotated by
+    # another reopens the new one, and a file already written since the
+    # rollover time is not rotated again.
+
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+        self.lock_fd = os.open(self.baseFilename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+
+    def emit(self, record):
+        # lockf locks belong to the process, so a descriptor inherited
+        # across fork still excludes the parent.
+        fcntl.lockf(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            super().emit(record)
+        finally:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+
+    def shouldRollover(self, record):
+        if self.stream is not None and not self.is_current():
+            self.stream.close()
+            self.stream = None
+        if self.stream is None:
+            self.stream = self._open()
+        if super().shouldRollover(record):
+            if os.fstat(self.stream.fileno()).st_mtime < self.rolloverAt:
+                return True
+            # Rotated by another process since this one last wrote.
+            self.rolloverAt = self.computeRollover(int(time.time()))
+        if self.max_bytes > 0:
+            self.stream.seek(0, os.SEEK_END)
+            if self.stream.tell() >= self.max_bytes:
+                return True
+        return False
+
+    def is_current(self):
+        try:
+            on_disk = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self.stream.fileno())
+        return (on_disk.st_dev, on_disk.st_ino) == (opened.st_dev, opened.st_ino)
+
+    def rotation_filename(self, default_name):
+        # A second size rotation on the same day must not replace the first.
+        name, n = default_name, 0
+        while os.path.exists(name):
+            n += 1
+            name = '{}.{}'.format(default_name, n)
+        return name
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "where": '{}:{}'.format(record.pathname, record.lineno),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    # Runs on the request thread, before the record is queued, so the
+    # request's fields are still reachable.
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = getattr(record, 'request_id', None) or g.get('request_id')
+            record.route = getattr(record, 'route', None) or request.endpoint
+            record.method = getattr(record, 'method', None) or request.method
+            record.path = getattr(record, 'path', None) or request.path
+            if getattr(record, 'sql_count', None) is None:
+                record.sql_count = g.get('sql_count')
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a fraction of INFO-and-below records; warnings and errors always
+    # pass.
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class StructuredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        # Resolve the message and traceback here; the listener thread only
+        # sees a plain copy without args or exc_info.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def count_queries(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+
+
+def init_logging(app):
+    config = app.config
+    file_handler = SizedTimedRotatingFileHandler(
+        config['LOG_FILE'],
+        max_bytes=config['LOG_MAX_BYTES'],
+        when=config['LOG_ROTATE_WHEN'],
+        backupCount=config['LOG_BACKUP_COUNT'],
+        delay=True
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(-1)
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(SamplingFilter(config['LOG_INFO_SAMPLE_RATE']))
+    level = logging.getLevelName(config['LOG_LEVEL'])
+    queue_handler.setLevel(level)
+    app.logger.setLevel(level)
+    app.logger.addHandler(queue_handler)
+    # Flask's own stderr handler would format and write on the request
+    # thread, which is what the queue is for.
+    app.logger.removeHandler(default_handler)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_listener():
+        # A worker forked after import has the queue but not the thread.
+        listener.queue = queue_handler.queue = queue.Queue(-1)
+        listener._thread = None
+        listener.start()
+
+    os.register_at_fork(after_in_child=restart_listener)
+    return listener
+
+
+def init_request_logging(app):
+    if not event.contains(Engine, 'before_cursor_execute', count_queries):
+        event.listen(Engine, 'before_cursor_execute', count_queries)
+
+    @app.before_request
+    def start_request_log():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+
+    @app.after_request
+    def finish_request_log(response):
+        started = g.get('request_started')
+        if started is not None:
+            latency = round((time.perf_counter() - started) * 1000, 2)
+            app.logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+                "status": response.status_code,
+                "latency_ms": latency
+            })
+        response.headers['X-Request-ID'] = g.get('request_id', '')
+        return response
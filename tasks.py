@@ -0,0 +1,165 @@
+import hashlib
+import http.client
+import socket
+from datetime import datetime, timedelta
+import urllib.error
+import urllib.request
+
+from flask import current_app
+
+from jobs import task, enqueue
+from thumbnails import build_opener, cache_from_config, url_digest, FetchError
+from archive import archive_cutoff, archive_shows
+from trending import compute_trending
+from models import db, Venue, Artist, LinkCheck
+from sharding import shard_names, using_shard
+from venue_shards import venue_shard, sync_artist
+
+# ----------------------------------------------------------------------------#
+# Background tasks.
+# ----------------------------------------------------------------------------#
+
+LINK_TIMEOUT = 10
+
+
+LINK_FIELDS = ('image_link', 'website_link', 'facebook_link')
+
+
+def check_url(url, allow_private=False):
+    # Links are user input: requests go through the thumbnail fetcher's
+    # opener, which only connects to public addresses.
+    req = urllib.request.Request(url, method='HEAD', headers={'User-Agent': 'Fyyur link check'})
+    try:
+        with build_opener(allow_private).open(req, timeout=LINK_TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        if e.code >= 500 or e.code == 429:
+            # Worth another attempt once the origin recovers.
+            raise
+        return e.code
+
+
+@task('validate_links')
+def validate_links(kind, entity_id):
+    model = Venue if kind == 'venue' else Artist
+    with using_shard(venue_shard(entity_id) if kind == 'venue' else None):
+        entity = db.session.get(model, entity_id)
+    if entity is None:
+        return
+    allow_private = current_app.config['THUMBNAIL_ALLOW_PRIVATE_HOSTS']
+    results = []
+    for field in LINK_FIELDS:
+        url = getattr(entity, field)
+        if not url:
+            continue
+        status = error = None
+        if not url.startswith(('http://', 'https://')):
+            error = 'Not an http(s) link'
+        else:
+            try:
+                status = check_url(url, allow_private)
+            except urllib.error.HTTPError:
+                raise
+            except (FetchError, http.client.InvalidURL, ValueError) as e:
+                # A refused address or a malformed url: another attempt
+                # would fail the same way.
+                error = str(e)
+            except (urllib.error.URLError, socket.timeout, http.client.HTTPException) as e:
+                error = 'Unreachable: {}'.format(e)
+        if error or status >= 400:
+            current_app.logger.warning('%s %s %s failed (%s): %s', kind, entity_id, field, error or status, url)
+        results.append({"kind": kind, "entity_id": entity_id, "field": field, "url": url[:500],
+                        "status": status, "error": error and error[:250], "checked_at": datetime.now()})
+    # Replaces the entity's previous results, including those of links
+    # that have since been removed.
+    db.session.execute(db.delete(LinkCheck).where(LinkCheck.kind == kind, LinkCheck.entity_id == entity_id))
+    if results:
+        db.session.execute(db.insert(LinkCheck), results)
+    db.session.commit()
+
+
+def broken_links(kind, entity):
+    # {field: problem} for the entity's links that failed their last check;
+    # a link edited since then is not reported until it is checked again.
+    rows = db.session.execute(db.select(LinkCheck.field, LinkCheck.url, LinkCheck.status, LinkCheck.error).where(
+        LinkCheck.kind == kind, LinkCheck.entity_id == entity.id)).all()
+    return {field: error or 'returned HTTP {}'.format(status)
+            for field, url, status, error in rows
+            if (error or status >= 400) and url == (getattr(entity, field, None) or '')[:500]}
+
+
+@task('generate_thumbnails')
+def generate_thumbnails(url):
+    try:
+        cache_from_config(current_app.config).warm(url)
+    except FetchError as e:
+        current_app.logger.warning('Could not build thumbnails for %s: %s', url, e)
+
+
+@task('sync_artist_copies')
+def sync_artist_copies(artist_id):
+    sync_artist(artist_id)
+
+
+@task('archive_shows')
+def archive_old_shows():
+    moved = archive_shows(archive_cutoff(), current_app.config['SHOW_ARCHIVE_BATCH_SIZE'])
+    current_app.logger.info('Archived %s shows', moved)
+    schedule_archive()
+
+
+@task('compute_trending')
+def compute_trending_job():
+    counts = compute_trending()
+    current_app.logger.info('Ranked %s venues and %s artists', counts['venue'], counts['artist'])
+    schedule_trending()
+
+
+def enqueue_link_check(kind, entity):
+    # Keyed on the links themselves so re-saving a profile without touching
+    # them does not queue the same check again.
+    links = '|'.join(getattr(entity, f) or '' for f in ('image_link', 'website_link', 'facebook_link'))
+    digest = hashlib.sha1(links.encode('utf-8')).hexdigest()[:16]
+    key = 'validate_links:{}:{}:{}'.format(kind, entity.id, digest)
+    return enqueue('validate_links', {"kind": kind, "entity_id": entity.id}, key=key)
+
+
+def enqueue_thumbnails(entity):
+    if not entity.image_link:
+        return None
+    key = 'generate_thumbnails:' + url_digest(entity.image_link)
+    return enqueue('generate_thumbnails', {"url": entity.image_link}, key=key)
+
+
+def enqueue_artist_sync(entity):
+    # Refreshes the artist copies kept on venue shards. The job always
+    # copies the current row, so it is safe to queue once per edit.
+    return enqueue('sync_artist_copies', {"artist_id": entity.id})
+
+
+def enqueue_profile_jobs(kind, entity):
+    enqueue_link_check(kind, entity)
+    enqueue_thumbnails(entity)
+    if kind == 'artist' and len(shard_names()) > 1:
+        enqueue_artist_sync(entity)
+
+
+def schedule_archive(delay=None):
+    # The job queues its own next run; keying it on the run's time slot
+    # means racing workers cannot queue it twice.
+    interval = current_app.config['SHOW_ARCHIVE_INTERVAL']
+    if delay is None:
+        delay = interval
+    run_at = datetime.now() + timedelta(seconds=delay)
+    slot = int(run_at.timestamp()) // interval
+    return enqueue('archive_shows', key='archive_shows:{}'.format(slot), delay=delay)
+
+
+def schedule_trending(delay=None):
+    # Same self-scheduling as the archive job.
+    interval = current_app.config['TRENDING_INTERVAL']
+    if delay is None:
+        delay = interval
+    run_at = datetime.now() + timedelta(seconds=delay)
+    slot = int(run_at.timestamp()) // interval
+    return enqueue('compute_trending', key='compute_trending:{}'.format(slot), delay=delay)
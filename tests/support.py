@@ -0,0 +1,54 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SETTINGS = '''
+SQLALCHEMY_DATABASE_URI = {database!r}
+SHARDS = {{'west': {west!r}}}
+SHARD_MAP = {{'CA': 'west', 'OR': 'west'}}
+SQLALCHEMY_BINDS = SHARDS
+DEBUG = False
+WTF_CSRF_ENABLED = False
+RATE_LIMIT_ENABLED = False
+TRAFFIC_CAPTURE_ENABLED = False
+SLOW_QUERY_LOG_ENABLED = False
+VIEW_COUNTS_ENABLED = False
+EVENTS_ENABLED = False
+PROFILING_ENABLED = False
+LOG_FILE = {log!r}
+RATE_LIMIT_FILE = {ratelimit!r}
+JINJA_BYTECODE_CACHE_DIR = {bytecode!r}
+THUMBNAIL_CACHE_DIR = {thumbnails!r}
+THUMBNAIL_ALLOW_PRIVATE_HOSTS = True
+'''
+
+
+def load_app():
+    # The app reads its config at import, so every test module shares one
+    # import: SQLite files in a temporary directory, with CA and OR venues
+    # on a 'west' shard.
+    if 'app' in sys.modules:
+        return sys.modules['app'].app
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    path = os.path.join(directory, 'settings.py')
+    with open(path, 'w') as f:
+        f.write(SETTINGS.format(
+            database='sqlite:///' + os.path.join(directory, 'test.db'),
+            west='sqlite:///' + os.path.join(directory, 'west.db'),
+            log=os.path.join(directory, 'app.log'),
+            ratelimit=os.path.join(directory, 'ratelimit.bin'),
+            bytecode=os.path.join(directory, 'bytecode'),
+            thumbnails=os.path.join(directory, 'thumbnails'),
+        ))
+    os.environ['FYYUR_SETTINGS'] = path
+    from app import app, db
+    from sharding import GLOBAL_TABLES
+    with app.app_context():
+        tables = [t for t in db.metadata.sorted_tables if t.name not in GLOBAL_TABLES]
+        db.metadata.create_all(db.engines['west'], tables=tables)
+    return app
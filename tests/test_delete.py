@@ -0,0 +1,61 @@
+import re
+import unittest
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from models import Artist  # noqa: E402
+
+
+class DeleteArtistTest(unittest.TestCase):
+    # The detail page links to a confirmation page; only its POST, which
+    # carries the CSRF token, deletes.
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            artist = Artist(name='The Wild Sax Band', city='San Francisco', state='CA', phone='432-325-5432',
+                            genres='Jazz')
+            db.session.add(artist)
+            db.session.commit()
+            self.artist_id = artist.id
+        self.url = '/artists/{}/delete'.format(self.artist_id)
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        with app.app_context():
+            db.session.execute(db.delete(Artist).where(Artist.id == self.artist_id))
+            db.session.commit()
+
+    def exists(self):
+        with app.app_context():
+            return db.session.get(Artist, self.artist_id) is not None
+
+    def test_get_only_asks_for_confirmation(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('method="post"', response.get_data(as_text=True))
+        self.assertTrue(self.exists())
+
+    def test_post_deletes(self):
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(self.exists())
+
+    def test_post_needs_the_csrf_token(self):
+        app.config['WTF_CSRF_ENABLED'] = True
+        self.assertEqual(self.client.post(self.url).status_code, 400)
+        self.assertTrue(self.exists())
+        page = self.client.get(self.url).get_data(as_text=True)
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+        self.assertEqual(self.client.post(self.url, data={'csrf_token': token}).status_code, 302)
+        self.assertFalse(self.exists())
+
+    def test_missing_artist_is_404(self):
+        self.assertEqual(self.client.get('/artists/{}/delete'.format(self.artist_id + 1000)).status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
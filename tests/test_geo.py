@@ -0,0 +1,73 @@
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geo import (EARTH_RADIUS_KM, cell_size, covering_cells, geohash_encode, haversine_km,  # noqa: E402
+                 precision_for_radius)
+
+
+def destination(lat, lon, bearing, distance_km):
+    # The point distance_km from (lat, lon) along bearing (degrees).
+    phi, lam, theta = math.radians(lat), math.radians(lon), math.radians(bearing)
+    delta = distance_km / EARTH_RADIUS_KM
+    phi2 = math.asin(math.sin(phi) * math.cos(delta) + math.cos(phi) * math.sin(delta) * math.cos(theta))
+    lam2 = lam + math.atan2(math.sin(theta) * math.sin(delta) * math.cos(phi),
+                            math.cos(delta) - math.sin(phi) * math.sin(phi2))
+    return math.degrees(phi2), (math.degrees(lam2) + 540.0) % 360.0 - 180.0
+
+
+class CoveringCellsTest(unittest.TestCase):
+    # Every point within the radius has to fall in one of the cells, or
+    # /venues/nearby misses it.
+
+    def assertCovers(self, lat, lon, radius_km):
+        cells = covering_cells(lat, lon, radius_km)
+        for bearing in range(0, 360, 5):
+            for fraction in (0.5, 0.999):
+                point = destination(lat, lon, bearing, radius_km * fraction)
+                self.assertLessEqual(haversine_km(lat, lon, *point), radius_km)
+                geohash = geohash_encode(*point)
+                self.assertTrue(any(geohash.startswith(cell) for cell in cells),
+                                '{} within {} km of {} not in {}'.format(point, radius_km, (lat, lon), cells))
+
+    def test_centre_of_a_city(self):
+        for radius in (1, 25, 500):
+            self.assertCovers(40.7128, -74.0060, radius)
+
+    def test_on_and_beside_cell_edges(self):
+        for radius in (2, 25, 150):
+            height, width = cell_size(precision_for_radius(37.0, radius))
+            edge_lat, edge_lon = height * round(37.0 / height), width * round(-122.0 / width)
+            for nudge in (-1e-9, 0.0, 1e-9):
+                self.assertCovers(edge_lat + nudge, edge_lon, radius)
+                self.assertCovers(edge_lat, edge_lon + nudge, radius)
+                self.assertCovers(edge_lat + nudge, edge_lon + nudge, radius)
+
+    def test_across_the_antimeridian(self):
+        for lon in (180.0, 179.9999, -180.0, -179.9999):
+            for radius in (3, 25, 200):
+                self.assertCovers(-17.7134, lon, radius)
+        cells = covering_cells(0.0, 179.9999, 25)
+        self.assertIn(geohash_encode(0.0, -179.9999, len(cells[0])), cells)
+
+    def test_on_the_equator_and_prime_meridian(self):
+        for radius in (1, 25):
+            self.assertCovers(0.0, 0.0, radius)
+
+    def test_near_a_pole_covers_everything(self):
+        self.assertEqual(covering_cells(89.95, 10.0, 25), [''])
+        self.assertCovers(89.95, 10.0, 25)
+
+    def test_cells_are_at_least_the_radius(self):
+        for lat in (0.0, 45.0, 70.0):
+            for radius in (0.5, 10, 300):
+                height, width = cell_size(precision_for_radius(lat, radius))
+                self.assertGreaterEqual(height * 111.32, radius)
+                self.assertGreaterEqual(width * 111.32 * math.cos(math.radians(lat)), radius)
+
+
+if __name__ == '__main__':
+    unittest.main()
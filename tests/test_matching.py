@@ -0,0 +1,77 @@
+import unittest
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from matching import MatchEngine  # noqa: E402
+from models import Artist, Venue, VenueShard  # noqa: E402
+from read_model import log_change  # noqa: E402
+
+
+class RecommendTest(unittest.TestCase):
+    # A worker's matcher follows changes other workers log to change_log,
+    # through the read model's refresh.
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.matcher = MatchEngine()
+        self.read_model = app.extensions['read_model']
+        self.addCleanup(app.extensions.__setitem__, 'matcher', app.extensions['matcher'])
+        app.extensions['matcher'] = self.matcher
+        directory = VenueShard(shard=None)
+        db.session.add(directory)
+        db.session.commit()
+        self.venue_id = directory.id
+        db.session.add(Venue(id=self.venue_id, name='Park Square Live Music & Coffee', city='New York',
+                             state='NY', address='34 Whiskey Moore Ave', phone='415-000-1234', genres='Jazz',
+                             seeking_talent=True))
+        self.artist = Artist(name='Matt Quevedo', city='New York', state='NY', phone='300-400-5000',
+                             genres='Jazz', seeking_venue=True)
+        self.other = Artist(name='The Wild Sax Band', city='New York', state='NY', phone='432-325-5432',
+                            genres='Jazz', seeking_venue=False)
+        db.session.add_all([self.artist, self.other])
+        db.session.commit()
+        self.artist_id, self.other_id = self.artist.id, self.other.id
+        self.read_model.catch_up()
+        self.matcher.build()
+
+    def tearDown(self):
+        db.session.execute(db.delete(Venue).where(Venue.id == self.venue_id))
+        db.session.execute(db.delete(VenueShard).where(VenueShard.id == self.venue_id))
+        db.session.execute(db.delete(Artist).where(Artist.id.in_([self.artist_id, self.other_id])))
+        db.session.commit()
+        self.context.pop()
+
+    def recommended(self, kind, entity_id):
+        return [r['id'] for r in self.matcher.recommend(kind, entity_id)]
+
+    def test_only_seeking_profiles_match(self):
+        self.assertEqual(self.recommended('venue', self.venue_id), [self.artist_id])
+        self.assertEqual(self.recommended('artist', self.artist_id), [self.venue_id])
+        self.assertEqual(self.recommended('artist', self.other_id), [])
+
+    def test_change_log_updates_the_indexes(self):
+        self.assertEqual(self.recommended('venue', self.venue_id), [self.artist_id])
+        # As another worker would: the row and its change_log entry, with
+        # nothing told to this matcher.
+        db.session.execute(db.update(Artist).where(Artist.id == self.other_id).values(seeking_venue=True))
+        db.session.execute(db.update(Artist).where(Artist.id == self.artist_id).values(genres='Metal', city='Reno',
+                                                                                        state='NV'))
+        log_change('artist', self.other_id)
+        log_change('artist', self.artist_id)
+        db.session.commit()
+        self.read_model.catch_up()
+        self.assertEqual(self.recommended('venue', self.venue_id), [self.other_id])
+        db.session.execute(db.update(Venue).where(Venue.id == self.venue_id).values(seeking_talent=False))
+        log_change('venue', self.venue_id)
+        db.session.commit()
+        self.read_model.catch_up()
+        self.assertEqual(self.recommended('venue', self.venue_id), [])
+        self.assertEqual(self.recommended('artist', self.other_id), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
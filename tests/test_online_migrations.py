@@ -0,0 +1,212 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy as sa  # noqa: E402
+from alembic.migration import MigrationContext  # noqa: E402
+from alembic.operations import Operations  # noqa: E402
+
+import online_migrations  # noqa: E402
+from online_migrations import add_column, backfill, create_index, drop_index, set_not_null  # noqa: E402
+
+# A Postgres server to run the Postgres-only paths against, e.g.
+# postgresql+psycopg2://postgres@localhost:5432/postgres. A scratch database is
+# created on it and dropped afterwards; without it those tests are skipped.
+POSTGRES_URL = os.environ.get('FYYUR_TEST_POSTGRES_URL')
+SCRATCH_DATABASE = 'fyyur_online_migrations_test'
+VERSIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations', 'versions')
+
+
+def load_migration(filename):
+    spec = importlib.util.spec_from_file_location(filename[:-3], os.path.join(VERSIONS, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def migrate(engine, fn):
+    # Runs fn the way `flask db upgrade` runs a migration: with `op` bound
+    # and inside the migration's transaction.
+    with engine.connect() as conn:
+        context = MigrationContext.configure(conn)
+        with Operations.context(context), context.begin_transaction():
+            return fn()
+
+
+class BackfillTest(unittest.TestCase):
+    # On SQLite here; PostgresBackfillTest runs the same against Postgres.
+
+    def make_engine(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        return sa.create_engine('sqlite:///' + os.path.join(directory, 'test.db'))
+
+    def setUp(self):
+        self.engine = self.make_engine()
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql('DROP TABLE IF EXISTS online_migration_checkpoints')
+            conn.exec_driver_sql('DROP TABLE IF EXISTS tickets')
+            conn.exec_driver_sql('CREATE TABLE tickets (id INTEGER PRIMARY KEY, price INTEGER NOT NULL)')
+            conn.execute(sa.text('INSERT INTO tickets (id, price) VALUES (:id, :price)'),
+                         [{"id": i, "price": i % 50} for i in range(1, 2501)])
+        migrate(self.engine, lambda: add_column('tickets', sa.Column('total', sa.Integer(), nullable=True)))
+
+    def totals(self):
+        with self.engine.connect() as conn:
+            return dict(conn.execute(sa.text('SELECT id, total FROM tickets')).all())
+
+    def checkpoints(self):
+        with self.engine.connect() as conn:
+            return conn.execute(sa.text('SELECT name, last_key FROM online_migration_checkpoints')).all()
+
+    def test_fills_every_batch_and_clears_its_checkpoint(self):
+        updated = migrate(self.engine, lambda: backfill('tickets', {'total': sa.text('price + 1')},
+                                                        where='total IS NULL', batch_size=1000))
+        self.assertEqual(updated, 2500)
+        totals = self.totals()
+        self.assertEqual(totals[1], 2)
+        self.assertEqual(totals[2500], 1)
+        self.assertNotIn(None, totals.values())
+        self.assertEqual(self.checkpoints(), [])
+
+    def test_resumes_after_the_last_checkpoint(self):
+        name = 'backfill:tickets:total'
+        with self.engine.begin() as conn:
+            online_migrations.ensure_checkpoints(conn)
+            online_migrations.write_checkpoint(conn, name, 1999)
+        updated = migrate(self.engine, lambda: backfill('tickets', {'total': sa.text('price + 1')},
+                                                        where='total IS NULL', batch_size=1000))
+        self.assertEqual(updated, 501)
+        totals = self.totals()
+        self.assertIsNone(totals[1999])
+        self.assertEqual(totals[2000], 1)
+
+    def test_rejects_not_null_column_without_default(self):
+        with self.assertRaises(ValueError):
+            migrate(self.engine, lambda: add_column('tickets', sa.Column('seat', sa.Integer(), nullable=False)))
+
+
+class PostgresTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if not POSTGRES_URL:
+            raise unittest.SkipTest('FYYUR_TEST_POSTGRES_URL is not set')
+        cls.admin = sa.create_engine(POSTGRES_URL, isolation_level='AUTOCOMMIT')
+        with cls.admin.connect() as conn:
+            conn.exec_driver_sql('DROP DATABASE IF EXISTS {}'.format(SCRATCH_DATABASE))
+            conn.exec_driver_sql('CREATE DATABASE {}'.format(SCRATCH_DATABASE))
+        cls.url = sa.make_url(POSTGRES_URL).set(database=SCRATCH_DATABASE)
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.admin.connect() as conn:
+            conn.exec_driver_sql('DROP DATABASE IF EXISTS {} WITH (FORCE)'.format(SCRATCH_DATABASE))
+        cls.admin.dispose()
+
+    def make_engine(self):
+        engine = sa.create_engine(self.url)
+        self.addCleanup(engine.dispose)
+        return engine
+
+    def indexes(self, table):
+        with self.engine.connect() as conn:
+            return dict(conn.execute(sa.text(
+                'SELECT c.relname, i.indisvalid FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_class t ON t.oid = i.indrelid '
+                'WHERE t.relname = :table AND NOT i.indisprimary'), {"table": table}).all())
+
+
+class PostgresBackfillTest(PostgresTestCase, BackfillTest):
+    pass
+
+
+class PostgresSchemaTest(PostgresTestCase):
+
+    def setUp(self):
+        self.engine = self.make_engine()
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql('DROP TABLE IF EXISTS shows')
+            conn.exec_driver_sql('CREATE TABLE shows (id SERIAL PRIMARY KEY, artist_id INTEGER NOT NULL, '
+                                 'venue_id INTEGER NOT NULL, start_time TIMESTAMP NOT NULL, ends_at TIMESTAMP)')
+            conn.exec_driver_sql('CREATE INDEX ix_shows_artist_id ON shows (artist_id)')
+            conn.exec_driver_sql('CREATE INDEX ix_shows_venue_id ON shows (venue_id)')
+            conn.exec_driver_sql("INSERT INTO shows (artist_id, venue_id, start_time) "
+                                 "SELECT mod(i, 7), mod(i, 5), now() + i * interval '1 hour' FROM generate_series(1, 100) i")
+
+    def test_shows_index_migration_up_and_down(self):
+        migration = load_migration('c5e1a7d3f9b2_shows_venue_and_artist_by_start_time.py')
+        migrate(self.engine, migration.upgrade)
+        self.assertEqual(self.indexes('shows'), {'ix_shows_venue_id_start_time': True,
+                                                 'ix_shows_artist_id_start_time': True})
+        migrate(self.engine, migration.downgrade)
+        self.assertEqual(self.indexes('shows'), {'ix_shows_artist_id': True, 'ix_shows_venue_id': True})
+
+    def test_create_index_replaces_an_invalid_build(self):
+        # A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind.
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            with self.assertRaises(sa.exc.IntegrityError):
+                conn.exec_driver_sql('CREATE UNIQUE INDEX CONCURRENTLY ix_shows_slot ON shows (venue_id)')
+        self.assertFalse(self.indexes('shows')['ix_shows_slot'])
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql('DELETE FROM shows WHERE id > 5')
+        migrate(self.engine, lambda: create_index('ix_shows_slot', 'shows', ['venue_id'], unique=True))
+        self.assertTrue(self.indexes('shows')['ix_shows_slot'])
+        # Running it again is a no-op.
+        migrate(self.engine, lambda: create_index('ix_shows_slot', 'shows', ['venue_id'], unique=True))
+        migrate(self.engine, lambda: drop_index('ix_shows_slot', 'shows'))
+        self.assertNotIn('ix_shows_slot', self.indexes('shows'))
+
+    def not_null(self):
+        with self.engine.connect() as conn:
+            return conn.execute(sa.text(
+                "SELECT attnotnull FROM pg_attribute WHERE attrelid = 'shows'::regclass AND attname = 'ends_at'"
+            )).scalar(), conn.execute(sa.text(
+                "SELECT conname FROM pg_constraint WHERE conrelid = 'shows'::regclass AND contype = 'c'"
+            )).scalars().all()
+
+    def test_set_not_null_validates_and_can_run_again(self):
+        with self.assertRaises(sa.exc.IntegrityError):
+            migrate(self.engine, lambda: set_not_null('shows', 'ends_at'))
+        self.assertEqual(self.not_null(), (False, ['ck_shows_ends_at_not_null']))
+        migrate(self.engine, lambda: backfill('shows', {'ends_at': sa.text("start_time + interval '3 hours'")},
+                                              where='ends_at IS NULL', batch_size=30))
+        migrate(self.engine, lambda: set_not_null('shows', 'ends_at'))
+        self.assertEqual(self.not_null(), (True, []))
+
+    def test_lock_timeouts_are_retried(self):
+        # Another session holds the table for a while; with a short
+        # lock_timeout the ALTER fails a few times, then goes through.
+        held = threading.Event()
+
+        def hold_lock():
+            with self.engine.begin() as conn:
+                conn.exec_driver_sql('LOCK TABLE shows IN ACCESS SHARE MODE')
+                held.set()
+                time.sleep(0.6)
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        self.addCleanup(holder.join)
+        held.wait()
+
+        def add():
+            online_migrations.op.get_bind().exec_driver_sql("SET LOCAL lock_timeout = '100ms'")
+            add_column('shows', sa.Column('doors_at', sa.DateTime(), nullable=True))
+
+        with self.assertLogs('alembic.online', 'INFO') as logs:
+            migrate(self.engine, add)
+        self.assertTrue(any('retrying' in line for line in logs.output))
+        with self.engine.connect() as conn:
+            self.assertIn('doors_at', [c['name'] for c in sa.inspect(conn).get_columns('shows')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import time
+import unittest
+from datetime import datetime
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from models import Artist, ChangeLog  # noqa: E402
+import read_model  # noqa: E402
+from read_model import GAP_TIMEOUT, ReadModel  # noqa: E402
+
+
+class GapReplayTest(unittest.TestCase):
+    # change_log ids are handed out in order but can commit out of order.
+    # Here the rows are written with explicit ids to play that out.
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.model = ReadModel(app)
+        self.model.rebuild()
+        self.base = self.model.last_id
+        self.addCleanup(self.forget)
+        self.artists = []
+        for name in ('Guns N Petals', 'Matt Quevedo', 'The Wild Sax Band'):
+            artist = Artist(name=name, city='San Francisco', state='CA', phone='326-123-5000')
+            db.session.add(artist)
+            db.session.commit()
+            self.artists.append(artist.id)
+
+    def forget(self):
+        db.session.rollback()
+        db.session.execute(db.delete(ChangeLog).where(ChangeLog.id > self.base))
+        db.session.execute(db.delete(Artist).where(Artist.id.in_(self.artists)))
+        db.session.commit()
+
+    def commit_change(self, offset, artist_id):
+        db.session.add(ChangeLog(id=self.base + offset, kind='artist', entity_id=artist_id, op='upsert',
+                                 created_at=datetime.now()))
+        db.session.commit()
+
+    def known(self):
+        return sorted(set(self.artists) & set(self.model.artists))
+
+    def test_a_late_commit_below_last_id_is_applied(self):
+        first, second, _ = self.artists
+        self.commit_change(2, second)
+        self.model.refresh()
+        self.assertEqual(self.known(), [second])
+        self.assertEqual(self.model.last_id, self.base + 2)
+        self.assertEqual(list(self.model.gaps), [self.base + 1])
+
+        self.commit_change(1, first)
+        self.model.refresh()
+        self.assertEqual(self.known(), [first, second])
+        self.assertEqual(self.model.last_id, self.base + 2)
+        self.assertEqual(self.model.gaps, {})
+
+    def test_a_gap_that_never_fills_expires(self):
+        first, second, _ = self.artists
+        self.commit_change(2, second)
+        self.model.refresh()
+        # The transaction holding base + 1 rolled back; after GAP_TIMEOUT
+        # the id is no longer asked for.
+        self.model.gaps[self.base + 1] = time.monotonic() - GAP_TIMEOUT - 1
+        self.model.refresh()
+        self.assertEqual(self.model.gaps, {})
+        self.commit_change(1, first)
+        self.model.refresh()
+        self.assertEqual(self.known(), [second])
+
+    def test_rebuild_starts_with_the_missing_ids_as_gaps(self):
+        first, second, third = self.artists
+        self.commit_change(2, second)
+        self.commit_change(5, third)
+        self.model.rebuild()
+        self.assertEqual(self.model.last_id, self.base + 5)
+        self.assertEqual(sorted(self.model.gaps), [self.base + 1, self.base + 3, self.base + 4])
+        self.commit_change(3, first)
+        self.model.refresh()
+        self.assertEqual(sorted(self.model.gaps), [self.base + 1, self.base + 4])
+
+    def test_many_gaps_are_capped_to_the_newest(self):
+        self.commit_change(5, self.artists[0])
+        original = read_model.GAP_WINDOW
+        read_model.GAP_WINDOW = 2
+        self.addCleanup(setattr, read_model, 'GAP_WINDOW', original)
+        self.model.refresh()
+        self.assertEqual(sorted(self.model.gaps), [self.base + 3, self.base + 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
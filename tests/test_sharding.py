@@ -0,0 +1,121 @@
+import threading
+import unittest
+from unittest import mock
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from models import ChangeLog, Venue, VenueShard  # noqa: E402
+from sharding import current_shard, scatter, shard_for_state, shard_names, using_shard  # noqa: E402
+from venue_shards import allocate_venue_id, place_venue, release_venue_id, venue_shard, venue_shards  # noqa: E402
+
+
+class RoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def test_states_map_to_shards(self):
+        self.assertEqual(shard_names(), [None, 'west'])
+        self.assertEqual(shard_for_state('CA'), 'west')
+        self.assertEqual(shard_for_state('OR'), 'west')
+        self.assertIsNone(shard_for_state('NY'))
+
+    def test_unknown_shard_in_the_map_is_an_error(self):
+        with mock.patch.dict(app.config['SHARD_MAP'], {'WA': 'northwest'}):
+            with self.assertRaises(ValueError):
+                shard_for_state('WA')
+
+    def test_using_shard_binds_all_but_the_global_tables(self):
+        west, default = db.engines['west'], db.engines[None]
+        with using_shard('west'):
+            self.assertIs(db.session.get_bind(Venue), west)
+            self.assertIs(db.session.get_bind(VenueShard), default)
+            self.assertIs(db.session.get_bind(ChangeLog), default)
+            self.assertIs(db.session.get_bind(clause=db.select(Venue.id)), west)
+            self.assertIs(db.session.get_bind(clause=db.select(VenueShard.id)), default)
+            with using_shard(None):
+                self.assertIs(db.session.get_bind(Venue), default)
+            self.assertEqual(current_shard.get(), 'west')
+        self.assertIs(db.session.get_bind(Venue), default)
+
+    def test_directory_lookups(self):
+        venue_id, shard = allocate_venue_id('CA')
+        self.addCleanup(release_venue_id, venue_id)
+        self.assertEqual(shard, 'west')
+        self.assertEqual(venue_shard(venue_id), 'west')
+        # Venues missing from the directory are on the default database.
+        self.assertIsNone(venue_shard(venue_id + 1000))
+        self.assertEqual(venue_shards([venue_id, venue_id + 1000]), {'west': [venue_id], None: [venue_id + 1000]})
+
+    def test_release_and_place(self):
+        venue_id, shard = allocate_venue_id('OR')
+        release_venue_id(venue_id)
+        self.assertIsNone(db.session.get(VenueShard, venue_id))
+        place_venue(venue_id, shard)
+        self.addCleanup(release_venue_id, venue_id)
+        self.assertEqual(venue_shard(venue_id), 'west')
+        # Placing again is harmless.
+        place_venue(venue_id, shard)
+        self.assertEqual(venue_shard(venue_id), 'west')
+
+
+class ScatterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def database(self, conn):
+        return conn.engine.url.database.rsplit('/', 1)[-1]
+
+    def test_results_come_back_in_shard_order(self):
+        self.assertEqual(scatter(self.database), [(None, 'test.db'), ('west', 'west.db')])
+        self.assertEqual(scatter(self.database, ['west']), [('west', 'west.db')])
+        self.assertEqual(scatter(self.database, ['west', None]), [('west', 'west.db'), (None, 'test.db')])
+
+    def test_shards_run_concurrently_in_the_callers_context(self):
+        # Each shard waits for the other, which only returns if they run
+        # at the same time.
+        barrier = threading.Barrier(2, timeout=5)
+        with using_shard('west'):
+            results = scatter(lambda conn: (barrier.wait(), current_shard.get())[1])
+        self.assertEqual(results, [(None, 'west'), ('west', 'west')])
+
+    def test_errors_reach_the_caller(self):
+        def fail(conn):
+            raise RuntimeError('shard down')
+        with self.assertRaises(RuntimeError):
+            scatter(fail)
+
+
+class CreateVenueTest(unittest.TestCase):
+    # The directory row is committed first to reserve the id; if the venue
+    # cannot be written to its shard the reservation is dropped.
+
+    form = {'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+            'phone': '123-123-1234', 'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/TheMusicalHop'}
+
+    def venues(self):
+        with app.app_context():
+            directory = db.session.execute(db.select(VenueShard.id, VenueShard.shard)).all()
+            with using_shard('west'):
+                return directory, db.session.execute(db.select(Venue.id)).scalars().all()
+
+    def test_failed_write_releases_the_id(self):
+        before = self.venues()
+        with mock.patch('app.log_change', side_effect=ValueError('no')) as log_change:
+            app.test_client().post('/venues/create', data=self.form)
+        self.assertTrue(log_change.called)
+        self.assertEqual(self.venues(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from support import load_app
+import thumbnails
+from thumbnails import FetchError, ThumbnailCache, fetch, is_public, render
+
+
+def make_image(width=800, height=600, color=(200, 40, 40)):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+IMAGE = make_image()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # /red.png and friends serve a PNG, /page an HTML page, /to-file and
+    # /to-image redirect.
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        if self.path.endswith('.png'):
+            self.reply(200, 'image/png', self.server.images.get(self.path, IMAGE))
+        elif self.path == '/page':
+            self.reply(200, 'text/html', b'<html></html>')
+        elif self.path == '/to-file':
+            self.send_response(302)
+            self.send_header('Location', 'file:///etc/passwd')
+            self.end_headers()
+        elif self.path == '/to-image':
+            self.send_response(302)
+            self.send_header('Location', '/red.png')
+            self.end_headers()
+        else:
+            self.reply(404, 'text/plain', b'missing')
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageServerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        cls.server.hits = []
+        cls.server.images = {}
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.hits.clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+
+class FetchTest(ImageServerTestCase):
+
+    def test_fetch_refuses_loopback_by_default(self):
+        with self.assertRaises(FetchError):
+            fetch(self.base + '/red.png')
+        self.assertEqual(self.server.hits, [])
+
+    def test_fetch_refuses_private_and_link_local_literals(self):
+        for url in ('http://169.254.169.254/latest/meta-data/', 'http://10.0.0.1/a.png',
+                    'http://[::1]/a.png', 'http://0.0.0.0/a.png'):
+            with self.subTest(url=url), self.assertRaisesRegex(FetchError, 'Refusing'):
+                fetch(url)
+
+    def test_is_public(self):
+        for address in ('127.0.0.1', '10.1.2.3', '172.16.0.1', '192.168.1.1', '169.254.169.254',
+                        '100.64.0.1', '0.0.0.0', '224.0.0.1', '::1', 'fe80::1', 'fc00::1',
+                        '::ffff:127.0.0.1'):
+            with self.subTest(address=address):
+                self.assertFalse(is_public(address))
+        for address in ('93.184.216.34', '2606:2800:220:1:248:1893:25c8:1946'):
+            with self.subTest(address=address):
+                self.assertTrue(is_public(address))
+
+    def test_fetch_returns_image_bytes(self):
+        self.assertEqual(fetch(self.base + '/red.png', allow_private=True), IMAGE)
+
+    def test_fetch_follows_http_redirects(self):
+        self.assertEqual(fetch(self.base + '/to-image', allow_private=True), IMAGE)
+
+    def test_fetch_rejects_other_schemes(self):
+        with self.assertRaises(FetchError):
+            fetch('file:///etc/passwd')
+        with self.assertRaises(FetchError):
+            fetch(self.base + '/to-file', allow_private=True)
+
+    def test_fetch_rejects_non_images(self):
+        with self.assertRaisesRegex(FetchError, 'Not an image'):
+            fetch(self.base + '/page', allow_private=True)
+
+    def test_fetch_rejects_errors(self):
+        with self.assertRaises(FetchError):
+            fetch(self.base + '/missing', allow_private=True)
+
+    def test_fetch_rejects_large_sources(self):
+        limit = thumbnails.MAX_SOURCE_BYTES
+        thumbnails.MAX_SOURCE_BYTES = len(IMAGE) - 1
+        self.addCleanup(setattr, thumbnails, 'MAX_SOURCE_BYTES', limit)
+        with self.assertRaisesRegex(FetchError, 'too large'):
+            fetch(self.base + '/red.png', allow_private=True)
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_render_resizes_to_width(self):
+        for fmt, pil_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+            with self.subTest(fmt=fmt):
+                image = Image.open(io.BytesIO(render(IMAGE, 160, fmt)))
+                self.assertEqual(image.format, pil_format)
+                self.assertEqual(image.size, (160, 120))
+
+    def test_render_keeps_small_images(self):
+        image = Image.open(io.BytesIO(render(make_image(100, 50), 320, 'jpeg')))
+        self.assertEqual(image.size, (100, 50))
+
+    def test_render_rejects_garbage(self):
+        with self.assertRaises(FetchError):
+            render(b'not an image', 160, 'jpeg')
+
+
+class ThumbnailCacheTest(ImageServerTestCase):
+
+    def cache(self, budget=512 * 1024 * 1024):
+        return ThumbnailCache(self.root, budget, {'sm': 160, 'md': 320}, allow_private=True)
+
+    def objects(self):
+        found = {}
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, 'objects')):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                found[path] = os.path.getsize(path)
+        return found
+
+    def test_get_caches_source_and_thumbnail(self):
+        cache = self.cache()
+        path = cache.get(self.base + '/red.png', 'sm', 'webp')
+        self.assertEqual(cache.get(self.base + '/red.png', 'sm', 'webp'), path)
+        cache.get(self.base + '/red.png', 'md', 'jpeg')
+        self.assertEqual(self.server.hits, ['/red.png'])
+        with Image.open(path) as image:
+            self.assertEqual(image.size, (160, 120))
+
+    def test_same_bytes_are_stored_once(self):
+        cache = self.cache()
+        first = cache.get(self.base + '/red.png', 'sm', 'jpeg')
+        second = cache.get(self.base + '/to-image', 'sm', 'jpeg')
+        self.assertEqual(first, second)
+        self.assertEqual(len([p for p in self.objects() if p.endswith('.src')]), 1)
+
+    def test_eviction_keeps_cache_under_budget(self):
+        colors = [(i * 40, 255 - i * 40, 90) for i in range(6)]
+        for i, color in enumerate(colors):
+            self.server.images['/{}.png'.format(i)] = make_image(color=color)
+        probe = self.cache()
+        probe.warm(self.base + '/0.png')
+        first = list(self.objects())
+        per_url = sum(self.objects().values())
+        shutil.rmtree(os.path.join(self.root, 'objects'))
+
+        budget = per_url * 3
+        cache = self.cache(budget)
+        for i in range(len(colors)):
+            cache.warm(self.base + '/{}.png'.format(i))
+        self.assertLessEqual(sum(self.objects().values()), budget)
+        self.assertEqual(cache.used, sum(self.objects().values()))
+        # The latest url survives whole; the first is gone.
+        last = cache.get(self.base + '/{}.png'.format(len(colors) - 1), 'md', 'webp')
+        self.assertEqual(self.server.hits.count('/{}.png'.format(len(colors) - 1)), 1)
+        self.assertTrue(os.path.exists(last))
+        self.assertFalse(any(os.path.exists(path) for path in first))
+
+    def test_eviction_is_least_recently_used(self):
+        cache = self.cache()
+        old = cache.get(self.base + '/red.png', 'sm', 'jpeg')
+        self.server.images['/blue.png'] = make_image(color=(0, 0, 255))
+        recent = cache.get(self.base + '/blue.png', 'sm', 'jpeg')
+        for path in self.objects():
+            os.utime(path, (1000, 1000))
+        os.utime(recent)
+        # Evicts down to 90% of the budget.
+        cache.budget = int(os.path.getsize(recent) / 0.9) + 1
+        cache.evict()
+        self.assertTrue(os.path.exists(recent))
+        self.assertFalse(os.path.exists(old))
+
+
+class ThumbnailRouteTest(ImageServerTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.app = load_app()
+        from app import db, url_digest
+        from models import Venue, VenueShard
+        cls.image_link = cls.base + '/red.png'
+        cls.version = url_digest(cls.image_link)[:10]
+        with cls.app.app_context():
+            db.session.add(VenueShard(id=1, shard=None))
+            db.session.add(Venue(id=1, name='The Musical Hop', city='San Francisco', state='CA',
+                                 address='1015 Folsom Street', phone='123-123-1234', genres='{Jazz}',
+                                 image_link=cls.image_link))
+            db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        from app import db
+        from models import Venue, VenueShard
+        with cls.app.app_context():
+            db.session.execute(db.delete(Venue).where(Venue.id == 1))
+            db.session.execute(db.delete(VenueShard).where(VenueShard.id == 1))
+            db.session.commit()
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def test_versioned_thumbnail_is_immutable(self):
+        response = self.client.get('/images/venue/1/sm?v=' + self.version, headers={'Accept': 'image/webp'})
+        self.addCleanup(response.close)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/webp')
+        self.assertTrue(response.cache_control.public)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, self.app.config['THUMBNAIL_MAX_AGE'])
+        self.assertIn('Accept', response.vary)
+        self.assertEqual(Image.open(io.BytesIO(response.data)).size, (160, 120))
+
+    def test_unversioned_thumbnail_is_short_lived(self):
+        response = self.client.get('/images/venue/1/md', headers={'Accept': 'image/jpeg'})
+        self.addCleanup(response.close)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        self.assertEqual(response.cache_control.max_age, 300)
+        self.assertFalse(response.cache_control.immutable)
+
+    def test_thumbnail_is_conditional(self):
+        first = self.client.get('/images/venue/1/sm?v=' + self.version)
+        first.close()
+        again = self.client.get('/images/venue/1/sm?v=' + self.version,
+                                headers={'If-None-Match': first.headers['ETag']})
+        self.addCleanup(again.close)
+        self.assertEqual(again.status_code, 304)
+
+    def test_unknown_size_or_entity_is_404(self):
+        self.assertEqual(self.client.get('/images/venue/1/xl').status_code, 404)
+        self.assertEqual(self.client.get('/images/venue/2/sm').status_code, 404)
+        self.assertEqual(self.client.get('/images/show/1/sm').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
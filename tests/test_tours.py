@@ -0,0 +1,126 @@
+import unittest
+from datetime import datetime, timedelta
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from models import Artist, Show, Venue, VenueShard  # noqa: E402
+from sharding import shard_names, using_shard  # noqa: E402
+from tours import book_tour, check_tour, parse_items, parse_lines  # noqa: E402
+from venue_shards import copy_artist  # noqa: E402
+
+WINDOW = timedelta(hours=4)
+NIGHT = datetime(2031, 5, 1, 20, 0)
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_lines(self):
+        rows = parse_lines('# venue, time\n\n3, 2031-05-01 20:00\nfour, 2031-05-02 20:00\n5, someday\n')
+        self.assertEqual([row["line"] for row in rows], [3, 4, 5])
+        self.assertEqual((rows[0]["venue_id"], rows[0]["start_time"], rows[0]["errors"]), (3, NIGHT, []))
+        self.assertEqual(rows[1]["errors"], ['"four" is not a venue id'])
+        self.assertEqual(rows[2]["errors"], ['"someday" is not a date and time'])
+
+    def test_items(self):
+        rows = parse_items([{"venue_id": 3, "start_time": "2031-05-01T20:00"}, 'x'])
+        self.assertEqual((rows[0]["venue_id"], rows[0]["start_time"]), (3, NIGHT))
+        self.assertEqual(rows[1]["errors"], ['Expected an object with venue_id and start_time'])
+
+
+class ConflictTest(unittest.TestCase):
+    # The touring artist plays the east venue at NIGHT; another artist
+    # plays the west venue, on the 'west' shard, a day later.
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.addCleanup(self.forget)
+        artist = Artist(name='Guns N Petals', city='San Francisco', state='CA', phone='326-123-5000')
+        other = Artist(name='Matt Quevedo', city='New York', state='NY', phone='300-400-5000')
+        east, west = VenueShard(shard=None), VenueShard(shard='west')
+        db.session.add_all([artist, other, east, west])
+        db.session.commit()
+        self.artist_id, self.other_id = artist.id, other.id
+        self.east, self.west = east.id, west.id
+        db.session.add(Venue(id=self.east, name='Park Square', city='New York', state='NY',
+                             address='34 Whiskey Moore Ave', phone='415-000-1234'))
+        db.session.add(Show(artist_id=self.artist_id, venue_id=self.east, start_time=NIGHT))
+        db.session.commit()
+        copy_artist(self.other_id, 'west')
+        with using_shard('west'):
+            db.session.add(Venue(id=self.west, name='The Musical Hop', city='San Francisco', state='CA',
+                                 address='1015 Folsom Street', phone='123-123-1234'))
+            db.session.add(Show(artist_id=self.other_id, venue_id=self.west, start_time=NIGHT + timedelta(days=1)))
+            db.session.commit()
+
+    def forget(self):
+        db.session.rollback()
+        for shard in shard_names():
+            with using_shard(shard):
+                db.session.execute(db.delete(Show).where(Show.venue_id.in_([self.east, self.west])))
+                db.session.execute(db.delete(Venue).where(Venue.id.in_([self.east, self.west])))
+                db.session.execute(db.delete(Artist).where(Artist.id.in_([self.artist_id, self.other_id])))
+                db.session.commit()
+        db.session.execute(db.delete(VenueShard).where(VenueShard.id.in_([self.east, self.west])))
+        db.session.commit()
+
+    def rows(self, *shows):
+        text = '\n'.join('{}, {:%Y-%m-%d %H:%M}'.format(venue_id, start_time) for venue_id, start_time in shows)
+        return parse_lines(text)
+
+    def errors(self, *shows):
+        rows = self.rows(*shows)
+        check_tour(self.artist_id, rows, WINDOW)
+        return [row["errors"] for row in rows]
+
+    def shows(self):
+        found = []
+        for shard in shard_names():
+            with using_shard(shard):
+                found += db.session.execute(db.select(Show.artist_id, Show.venue_id, Show.start_time).where(
+                    Show.artist_id == self.artist_id).order_by(Show.start_time)).all()
+        return sorted(found, key=lambda show: show.start_time)
+
+    def test_artist_already_playing_elsewhere(self):
+        self.assertEqual(self.errors((self.west, NIGHT + timedelta(hours=3))),
+                         [['The artist already plays venue {} at {}'.format(self.east, NIGHT)]])
+
+    def test_venue_already_booked_on_its_shard(self):
+        self.assertEqual(self.errors((self.west, NIGHT + timedelta(days=1, hours=-2))),
+                         [['Venue {} already has a show at {}'.format(self.west, NIGHT + timedelta(days=1))]])
+
+    def test_a_full_window_apart_is_fine(self):
+        self.assertEqual(self.errors((self.west, NIGHT + WINDOW), (self.west, NIGHT + timedelta(days=1) - WINDOW)),
+                         [[], []])
+
+    def test_rows_of_the_tour_too_close_together(self):
+        errors = self.errors((self.east, NIGHT + timedelta(days=3)), (self.west, NIGHT + timedelta(days=3, hours=1)))
+        self.assertEqual(errors, [[], ['Too close to line 1']])
+
+    def test_unknown_venue(self):
+        self.assertEqual(self.errors((self.west + 1000, NIGHT + timedelta(days=5))),
+                         [['Venue {} does not exist'.format(self.west + 1000)]])
+
+    def test_nothing_is_booked_when_a_row_clashes(self):
+        rows = self.rows((self.east, NIGHT + timedelta(days=2)), (self.west, NIGHT + timedelta(days=1)))
+        self.assertEqual(book_tour(self.artist_id, rows), 0)
+        self.assertEqual(len(self.shows()), 1)
+
+    def test_booking_spans_shards_and_cannot_be_repeated(self):
+        tour = ((self.east, NIGHT + timedelta(days=2)), (self.west, NIGHT + timedelta(days=3)))
+        self.assertEqual(book_tour(self.artist_id, self.rows(*tour)), 2)
+        self.assertEqual([(show.venue_id, show.start_time) for show in self.shows()[1:]], list(tour))
+        with using_shard('west'):
+            self.assertEqual(db.session.execute(db.select(db.func.count(Show.id)).where(
+                Show.artist_id == self.artist_id)).scalar(), 1)
+        rows = self.rows(*tour)
+        self.assertEqual(book_tour(self.artist_id, rows), 0)
+        self.assertTrue(all(row["errors"] for row in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
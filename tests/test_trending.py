@@ -0,0 +1,116 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from models import Artist, PageView, Trending, Venue, VenueShard  # noqa: E402
+from sharding import using_shard  # noqa: E402
+from trending import ViewCounter, compute_trending, trending_lists  # noqa: E402
+
+NOW = datetime(2031, 5, 1, 20, 0)
+CONFIG = {'TRENDING_HALF_LIFE_HOURS': 24, 'TRENDING_WINDOW_HOURS': 7 * 24, 'TRENDING_SIZE': 2}
+
+
+class TrendingTest(unittest.TestCase):
+
+    def setUp(self):
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        patch = mock.patch.dict(app.config, CONFIG)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.forget)
+        self.artists = []
+        for name in ('Guns N Petals', 'Matt Quevedo', 'The Wild Sax Band'):
+            artist = Artist(name=name, city='San Francisco', state='CA', phone='326-123-5000')
+            db.session.add(artist)
+            db.session.commit()
+            self.artists.append(artist.id)
+        directory = VenueShard(shard='west')
+        db.session.add(directory)
+        db.session.commit()
+        self.venue_id = directory.id
+        with using_shard('west'):
+            db.session.add(Venue(id=self.venue_id, name='The Musical Hop', city='San Francisco', state='CA',
+                                 address='1015 Folsom Street', phone='123-123-1234'))
+            db.session.commit()
+
+    def forget(self):
+        db.session.rollback()
+        db.session.execute(db.delete(PageView))
+        db.session.execute(db.delete(Trending))
+        db.session.execute(db.delete(Artist).where(Artist.id.in_(self.artists)))
+        db.session.execute(db.delete(VenueShard).where(VenueShard.id == self.venue_id))
+        db.session.commit()
+        with using_shard('west'):
+            db.session.execute(db.delete(Venue).where(Venue.id == self.venue_id))
+            db.session.commit()
+
+    def views(self, kind, entity_id, hours_ago, views):
+        db.session.add(PageView(kind=kind, entity_id=entity_id, bucket=NOW - timedelta(hours=hours_ago),
+                                views=views))
+        db.session.commit()
+
+    def ranking(self, kind):
+        return db.session.execute(db.select(Trending.entity_id, Trending.score).where(
+            Trending.kind == kind).order_by(Trending.rank)).all()
+
+    def test_a_view_loses_half_its_weight_every_half_life(self):
+        old, recent, _ = self.artists
+        self.views('artist', old, 48, 8)
+        self.views('artist', recent, 0, 3)
+        self.views('artist', recent, 24, 2)
+        compute_trending(NOW)
+        self.assertEqual(self.ranking('artist'), [(recent, 4.0), (old, 2.0)])
+
+    def test_partial_hours_decay_too(self):
+        first, _, _ = self.artists
+        self.views('artist', first, 0, 16)
+        compute_trending(NOW + timedelta(hours=12))
+        self.assertAlmostEqual(self.ranking('artist')[0].score, 16 * 0.5 ** 0.5)
+
+    def test_only_the_top_entries_are_kept(self):
+        first, second, third = self.artists
+        for artist_id, views in ((first, 1), (second, 5), (third, 3)):
+            self.views('artist', artist_id, 1, views)
+        self.assertEqual(compute_trending(NOW), {'venue': 0, 'artist': 2})
+        self.assertEqual([row.entity_id for row in self.ranking('artist')], [second, third])
+        self.assertEqual([row.id for row in trending_lists(1)['artist']], [second])
+
+    def test_old_views_are_ignored_and_pruned(self):
+        first, second, _ = self.artists
+        self.views('artist', first, 7 * 24 + 1, 1000)
+        self.views('artist', second, 2, 1)
+        compute_trending(NOW)
+        self.assertEqual([row.entity_id for row in self.ranking('artist')], [second])
+        self.assertEqual(db.session.execute(db.select(db.func.count()).select_from(PageView)).scalar(), 1)
+
+    def test_deleted_entities_are_skipped_and_venues_are_named_from_their_shard(self):
+        self.views('venue', self.venue_id + 1000, 0, 50)
+        self.views('venue', self.venue_id, 0, 5)
+        compute_trending(NOW)
+        self.assertEqual([(row.id, row.name) for row in trending_lists(10)['venue']],
+                         [(self.venue_id, 'The Musical Hop')])
+
+    def test_flush_adds_to_the_hours_bucket(self):
+        first, second, _ = self.artists
+        counter = ViewCounter(app)
+        # Counted in this process without starting the flushing thread.
+        counter.pid = os.getpid()
+        for artist_id in (first, first, first, second):
+            counter.record('artist', artist_id)
+        self.assertEqual(counter.flush(), 2)
+        counter.record('artist', first)
+        counter.record('artist', first)
+        counter.flush()
+        self.assertEqual(dict(db.session.execute(db.select(PageView.entity_id, db.func.sum(PageView.views))
+                                                 .group_by(PageView.entity_id)).all()), {first: 5, second: 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import html
+import json
+import unittest
+
+from support import load_app
+
+app = load_app()
+
+from app import db  # noqa: E402
+from models import Artist, Venue, VenueShard  # noqa: E402
+from sharding import using_shard  # noqa: E402
+from updates import (ARTIST_FIELDS, VENUE_FIELDS, NotFound, VersionConflict, apply_patch,  # noqa: E402
+                     dump_original, entity_values)
+
+
+class ApplyPatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        artist = Artist(name='Guns N Petals', city='San Francisco', state='CA', phone='326-123-5000',
+                        genres='Rock n Roll')
+        db.session.add(artist)
+        db.session.commit()
+        self.artist_id = artist.id
+        db.session.close()
+
+    def tearDown(self):
+        db.session.execute(db.delete(Artist).where(Artist.id == self.artist_id))
+        db.session.commit()
+        self.context.pop()
+
+    def row(self):
+        return db.session.execute(
+            db.select(Artist.name, Artist.phone, Artist.version).where(Artist.id == self.artist_id)
+        ).one()
+
+    def test_current_version_writes_and_bumps_it(self):
+        self.assertEqual(apply_patch(Artist, self.artist_id, 1, {'name': 'Petals'}), 2)
+        db.session.commit()
+        self.assertEqual(tuple(self.row()), ('Petals', '326-123-5000', 2))
+
+    def test_stale_version_conflicts_and_leaves_row_unchanged(self):
+        apply_patch(Artist, self.artist_id, 1, {'phone': '326-123-9999'})
+        db.session.commit()
+        with self.assertRaises(VersionConflict) as raised:
+            apply_patch(Artist, self.artist_id, 1, {'name': 'Petals'})
+        self.assertEqual(raised.exception.current_version, 2)
+        self.assertEqual(tuple(self.row()), ('Guns N Petals', '326-123-9999', 2))
+
+    def test_stale_version_without_changes_still_conflicts(self):
+        apply_patch(Artist, self.artist_id, 1, {'phone': '326-123-9999'})
+        db.session.commit()
+        with self.assertRaises(VersionConflict):
+            apply_patch(Artist, self.artist_id, 1, {})
+
+    def test_missing_row_is_not_found(self):
+        with self.assertRaises(NotFound):
+            apply_patch(Artist, self.artist_id + 1000, 1, {'name': 'Petals'})
+
+
+class EditConflictTest(unittest.TestCase):
+    # A stale form gets a 409 with what was typed, and the version and
+    # original of the row as it is now, so saving again applies it.
+
+    def setUp(self):
+        self.client = app.test_client()
+        with app.app_context():
+            artist = Artist(name='Matt Quevedo', city='New York', state='NY', phone='300-400-5000',
+                            genres='Jazz')
+            db.session.add(artist)
+            directory = VenueShard(shard='west')
+            db.session.add(directory)
+            db.session.commit()
+            self.artist_id, self.venue_id = artist.id, directory.id
+            with using_shard('west'):
+                db.session.add(Venue(id=self.venue_id, name='The Dueling Pianos Bar', city='San Francisco',
+                                     state='CA', address='335 Delancey Street', phone='914-003-1132',
+                                     genres='Jazz'))
+                db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            with using_shard('west'):
+                db.session.execute(db.delete(Venue).where(Venue.id == self.venue_id))
+                db.session.commit()
+            db.session.execute(db.delete(VenueShard).where(VenueShard.id == self.venue_id))
+            db.session.execute(db.delete(Artist).where(Artist.id == self.artist_id))
+            db.session.commit()
+
+    def original(self, model, entity_id, fields, shard=None):
+        with app.app_context(), using_shard(shard):
+            return dump_original(entity_values(db.session.get(model, entity_id), fields))
+
+    def row(self, model, entity_id, shard=None):
+        with app.app_context(), using_shard(shard):
+            return db.session.execute(
+                db.select(model.name, model.phone, model.version).where(model.id == entity_id)
+            ).one()
+
+    def hidden(self, page, name):
+        marker = 'name="{}" value="'.format(name)
+        start = page.index(marker) + len(marker)
+        return html.unescape(page[start:page.index('"', start)])
+
+    def test_stale_artist_edit_is_409_and_keeps_input(self):
+        original = self.original(Artist, self.artist_id, ARTIST_FIELDS)
+        with app.app_context():
+            apply_patch(Artist, self.artist_id, 1, {'phone': '300-400-9999'})
+            db.session.commit()
+        response = self.client.post('/artists/{}/edit'.format(self.artist_id), data={
+            'name': 'Matt Quevedo Trio', 'city': 'New York', 'state': 'NY', 'phone': '300-400-5000',
+            'genres': ['Jazz'], 'version': '1', 'original': original,
+        })
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(tuple(self.row(Artist, self.artist_id)), ('Matt Quevedo', '300-400-9999', 2))
+        page = response.get_data(as_text=True)
+        self.assertIn('value="Matt Quevedo Trio"', page)
+        self.assertEqual(self.hidden(page, 'version'), '2')
+        current = json.loads(self.hidden(page, 'original'))
+        self.assertEqual(current['phone'], '300-400-9999')
+
+    def test_stale_venue_edit_is_409_on_its_shard(self):
+        original = self.original(Venue, self.venue_id, VENUE_FIELDS, 'west')
+        with app.app_context(), using_shard('west'):
+            apply_patch(Venue, self.venue_id, 1, {'phone': '914-003-9999'})
+            db.session.commit()
+        response = self.client.post('/venues/{}/edit'.format(self.venue_id), data={
+            'name': 'Dueling Pianos', 'address': '335 Delancey Street', 'city': 'San Francisco',
+            'state': 'CA', 'phone': '914-003-1132', 'genres': ['Jazz'], 'version': '1', 'original': original,
+        })
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(tuple(self.row(Venue, self.venue_id, 'west')), ('The Dueling Pianos Bar', '914-003-9999', 2))
+        page = response.get_data(as_text=True)
+        self.assertIn('value="Dueling Pianos"', page)
+        self.assertEqual(self.hidden(page, 'version'), '2')
+
+
+if __name__ == '__main__':
+    unittest.main()
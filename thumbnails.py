@@ -0,0 +1,265 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+
+from PIL import Image, ImageOps
+
+# ----------------------------------------------------------------------------#
+# On-disk thumbnail cache.
+# ----------------------------------------------------------------------------#
+
+FETCH_TIMEOUT = 10
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+class FetchError(Exception):
+    pass
+
+
+def url_digest(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+# Image links are user input, so the fetcher only connects to public
+# addresses. The check runs on the address actually connected to, after
+# DNS, for every redirect too; proxies from the environment are not used.
+
+def is_public(address):
+    address = ipaddress.ip_address(address.split('%', 1)[0])
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    # socket.create_connection, refusing private, loopback, link-local and
+    # other non-global addresses.
+    host, port = address
+    infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    for *_, sockaddr in infos:
+        if not is_public(sockaddr[0]):
+            raise FetchError('Refusing to fetch from {} ({})'.format(host, sockaddr[0]))
+    error = None
+    for family, type_, proto, _, sockaddr in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            sock.close()
+    raise error or OSError('No address for ' + host)
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = public_connection
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = public_connection
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req, context=self._context)
+
+
+def build_opener(allow_private=False):
+    # http and https only, redirects included: no file:, ftp: or data:.
+    opener = urllib.request.OpenerDirector()
+    if allow_private:
+        handlers = [urllib.request.HTTPHandler(), urllib.request.HTTPSHandler()]
+    else:
+        handlers = [PublicHTTPHandler(), PublicHTTPSHandler()]
+    handlers += [urllib.request.HTTPDefaultErrorHandler(), urllib.request.HTTPRedirectHandler(),
+                 urllib.request.HTTPErrorProcessor(), urllib.request.UnknownHandler()]
+    for handler in handlers:
+        opener.add_handler(handler)
+    return opener
+
+
+def fetch(url, allow_private=False):
+    if not url.startswith(('http://', 'https://')):
+        raise FetchError('Unsupported image url ' + url)
+    req = urllib.request.Request(url, headers={'User-Agent': 'Fyyur thumbnailer'})
+    try:
+        with build_opener(allow_private).open(req, timeout=FETCH_TIMEOUT) as response:
+            content_type = response.headers.get('Content-Type', '')
+            if content_type and not content_type.startswith('image/'):
+                raise FetchError('Not an image: ' + content_type)
+            data = response.read(MAX_SOURCE_BYTES + 1)
+    except (OSError, ValueError) as e:
+        raise FetchError(str(e))
+    if len(data) > MAX_SOURCE_BYTES:
+        raise FetchError('Image too large')
+    return data
+
+
+def render(data, width, fmt):
+    pil_format, _, options = FORMATS[fmt]
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise FetchError(str(e))
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    image.thumbnail((width, width * 4), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, pil_format, **options)
+    return out.getvalue()
+
+
+class ThumbnailCache:
+    # Sources are stored once under the sha256 of their bytes; `refs/` maps an
+    # image url to that digest and thumbnails sit next to the source. Access
+    # times are bumped on every hit so eviction is least-recently-used.
+
+    def __init__(self, root, budget_bytes, sizes, allow_private=False):
+        self.root = root
+        self.budget = budget_bytes
+        self.sizes = sizes
+        self.allow_private = allow_private
+        self.lock = threading.Lock()
+        self.used = None
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def _object_path(self, digest, suffix):
+        return self._path('objects', digest[:2], digest + suffix)
+
+    def _write(self, path, data, account=True):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        if account:
+            self._account(len(data))
+
+    def _read_ref(self, url):
+        try:
+            with open(self._path('refs', url_digest(url))) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _source(self, url):
+        digest = self._read_ref(url)
+        if digest is not None:
+            path = self._object_path(digest, '.src')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return digest, f.read()
+        data = fetch(url, self.allow_private)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest, '.src')
+        if not os.path.exists(path):
+            self._write(path, data)
+        self._write(self._path('refs', url_digest(url)), digest.encode('ascii'), account=False)
+        return digest, data
+
+    def get(self, url, size, fmt):
+        # Returns the path of a cached thumbnail, creating it on a miss.
+        width = self.sizes[size]
+        digest = self._read_ref(url)
+        if digest is not None:
+            path = self._object_path(digest, '_{}.{}'.format(size, fmt))
+            try:
+                # atime only: the mtime is the thumbnail's Last-Modified
+                # and part of its ETag.
+                os.utime(path, (time.time(), os.stat(path).st_mtime))
+                return path
+            except FileNotFoundError:
+                pass
+        digest, data = self._source(url)
+        path = self._object_path(digest, '_{}.{}'.format(size, fmt))
+        if not os.path.exists(path):
+            self._write(path, render(data, width, fmt))
+        return path
+
+    def warm(self, url):
+        for size in self.sizes:
+            for fmt in FORMATS:
+                self.get(url, size, fmt)
+
+    # LRU eviction
+    # ----------------------------------------------------------------
+
+    def _scan(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self._path('objects')):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+        return entries
+
+    def _account(self, added):
+        with self.lock:
+            if self.used is None:
+                self.used = sum(size for _, size, _ in self._scan())
+            else:
+                self.used += added
+            if self.used > self.budget:
+                self.evict()
+
+    def evict(self):
+        # Other workers write to the same directory, so work from a fresh
+        # scan rather than the running total, and stop at 90% of the budget
+        # to avoid evicting on every write.
+        entries = sorted(self._scan())
+        used = sum(size for _, size, _ in entries)
+        target = self.budget * 0.9
+        for _, size, path in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+        self.used = used
+
+
+def cache_from_config(config):
+    return ThumbnailCache(
+        config['THUMBNAIL_CACHE_DIR'],
+        config['THUMBNAIL_CACHE_BUDGET'],
+        config['THUMBNAIL_SIZES'],
+        config['THUMBNAIL_ALLOW_PRIVATE_HOSTS']
+    )
@@ -0,0 +1,175 @@
+from datetime import timedelta
+
+import dateutil.parser
+from flask import current_app
+
+from events import publish
+from models import db, Venue, Artist, Show
+from read_model import log_change
+from sharding import scatter, shard_names, using_shard
+from venue_shards import copy_artist, venue_shards
+
+# ----------------------------------------------------------------------------#
+# Tour booking.
+# ----------------------------------------------------------------------------#
+#
+# A tour is one artist and a list of (venue_id, start_time) rows. Every row
+# is checked before anything is written: the venues are resolved with one
+# IN query, existing shows that could clash with any row are read with one
+# range query per shard, and nothing is inserted if any row has an error.
+#
+# The shows are then inserted with one INSERT per shard. Each shard's shows
+# commit together, but there is no transaction across databases: the
+# session commits them one after another, so a failure part way through
+# leaves the shows on the shards that were already committed. They are on
+# the artist's page, and booking the tour again reports them as conflicts.
+
+
+def tour_row(line, text=None):
+    return {"line": line, "text": text, "venue_id": None, "start_time": None,
+            "venue_name": None, "errors": []}
+
+
+def fill_row(row, venue_id, start_time):
+    try:
+        row["venue_id"] = int(venue_id)
+    except (TypeError, ValueError):
+        row["errors"].append('"{}" is not a venue id'.format(str(venue_id).strip()))
+    try:
+        start_time = dateutil.parser.parse(str(start_time))
+        if start_time.tzinfo is not None:
+            # Show times are stored as naive local time.
+            start_time = start_time.astimezone().replace(tzinfo=None)
+        row["start_time"] = start_time
+    except (ValueError, OverflowError):
+        row["errors"].append('"{}" is not a date and time'.format(str(start_time).strip()))
+    return row
+
+
+def parse_lines(text):
+    # One show per line: "venue_id, start time". Blank lines and lines
+    # starting with # are skipped.
+    rows = []
+    for number, line in enumerate((text or '').splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        venue_id, _, start_time = line.partition(',')
+        rows.append(fill_row(tour_row(number, line), venue_id, start_time))
+    return rows
+
+
+def parse_items(items):
+    # The JSON form: [{"venue_id": 1, "start_time": "2026-11-01T20:00"}, ...]
+    rows = []
+    for number, item in enumerate(items, 1):
+        if not isinstance(item, dict):
+            row = tour_row(number)
+            row["errors"].append('Expected an object with venue_id and start_time')
+            rows.append(row)
+            continue
+        rows.append(fill_row(tour_row(number), item.get('venue_id'), item.get('start_time', '')))
+    return rows
+
+
+def check_tour(artist_id, rows, window):
+    valid = [row for row in rows if not row["errors"]]
+    if not valid:
+        return
+    venue_ids = sorted({row["venue_id"] for row in valid})
+    placement = venue_shards(venue_ids)
+
+    names = {}
+    query = db.select(Venue.id, Venue.name).where(Venue.id.in_(venue_ids))
+    for _, result in scatter(lambda conn: conn.execute(query).all(), placement):
+        names.update(result)
+
+    # Anything the artist or one of the venues has within the window of
+    # the tour's first and last date, from every shard.
+    times = [row["start_time"] for row in valid]
+    existing = db.select(Show.venue_id, Show.artist_id, Show.start_time).where(
+        Show.start_time > min(times) - window).where(
+        Show.start_time < max(times) + window).where(
+        db.or_(Show.artist_id == artist_id, Show.venue_id.in_(venue_ids)))
+    booked = [show for _, result in scatter(lambda conn: conn.execute(existing).all()) for show in result]
+
+    for row in valid:
+        row["venue_name"] = names.get(row["venue_id"])
+        if row["venue_name"] is None:
+            row["errors"].append('Venue {} does not exist'.format(row["venue_id"]))
+            continue
+        for show in booked:
+            if abs(show.start_time - row["start_time"]) >= window:
+                continue
+            if show.artist_id == artist_id:
+                row["errors"].append('The artist already plays venue {} at {}'.format(show.venue_id, show.start_time))
+            elif show.venue_id == row["venue_id"]:
+                row["errors"].append('Venue {} already has a show at {}'.format(show.venue_id, show.start_time))
+
+    # Rows of the same tour are all for one artist, so any two that are too
+    # close together clash; after sorting only neighbours need comparing.
+    ordered = sorted(valid, key=lambda row: row["start_time"])
+    for previous, row in zip(ordered, ordered[1:]):
+        if row["start_time"] - previous["start_time"] < window:
+            row["errors"].append('Too close to line {}'.format(previous["line"]))
+
+
+def book_tour(artist_id, rows):
+    # Returns the number of shows created; with any row in error nothing is
+    # written. The artist row is locked first so two tours for the same
+    # artist cannot both pass the conflict check. Atomic per shard only; see
+    # above.
+    window = timedelta(hours=current_app.config['TOUR_CONFLICT_WINDOW_HOURS'])
+    if not rows:
+        return 0
+    locked = db.session.execute(
+        db.select(Artist.name).where(Artist.id == artist_id).with_for_update()
+    ).first()
+    if locked is None:
+        raise ValueError('Artist {} does not exist.'.format(artist_id))
+    check_tour(artist_id, rows, window)
+    if any(row["errors"] for row in rows):
+        db.session.rollback()
+        return 0
+
+    by_shard = {}
+    placement = venue_shards(sorted({row["venue_id"] for row in rows}))
+    shard_of = {venue_id: shard for shard, ids in placement.items() for venue_id in ids}
+    for row in rows:
+        row["artist_name"] = locked.name
+        by_shard.setdefault(shard_of[row["venue_id"]], []).append(row)
+    for shard in shard_names():
+        if shard not in by_shard:
+            continue
+        copy_artist(artist_id, shard)
+        with using_shard(shard):
+            # One executemany INSERT per shard; the new ids are kept for
+            # the events published once the tour is committed.
+            ids = db.session.execute(db.insert(Show).returning(Show.id, sort_by_parameter_order=True), [
+                {"artist_id": artist_id, "venue_id": row["venue_id"], "start_time": row["start_time"]}
+                for row in by_shard[shard]]).scalars().all()
+            for row, show_id in zip(by_shard[shard], ids):
+                row["show_id"] = show_id
+    for venue_id in sorted(shard_of):
+        log_change('venue', venue_id)
+    log_change('artist', artist_id)
+    db.session.commit()
+    return len(rows)
+
+
+def record_tour(artist_id, rows):
+    # Keeps the in-process indexes in step after a tour is committed, and
+    # announces the new shows.
+    matcher = current_app.extensions['matcher']
+    search_cache = current_app.extensions['search_cache']
+    feed_cache = current_app.extensions['feed_cache']
+    for row in rows:
+        matcher.record_show(artist_id, row["venue_id"])
+    for venue_id in {row["venue_id"] for row in rows}:
+        search_cache.invalidate('venues', venue_id)
+        feed_cache.invalidate('venue', venue_id)
+    search_cache.invalidate('artists', artist_id)
+    feed_cache.invalidate('artist', artist_id)
+    for row in rows:
+        publish('show', id=row["show_id"], venue_id=row["venue_id"], artist_id=artist_id,
+                venue_name=row["venue_name"], artist_name=row["artist_name"], start_time=row["start_time"])
@@ -0,0 +1,199 @@
+import atexit
+import heapq
+import os
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Venue, Artist, PageView, Trending
+from sharding import scatter
+from venue_shards import venue_shards
+
+# ----------------------------------------------------------------------------#
+# Page views and trending.
+# ----------------------------------------------------------------------------#
+#
+# Venue and artist page views are counted in memory and written every
+# VIEW_FLUSH_INTERVAL seconds as one batch of increments to hourly buckets
+# in page_views. The compute_trending job scores each entity by its views,
+# halving a bucket's weight every TRENDING_HALF_LIFE_HOURS, and stores the
+# top TRENDING_SIZE per kind in trending for the home page to read. Pages
+# served from the static snapshot never reach the app and are not counted.
+
+KINDS = ('venue', 'artist')
+
+
+def hour_of(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def insert_for(dialect):
+    if dialect.name == 'postgresql':
+        return postgresql.insert
+    if dialect.name == 'sqlite':
+        return sqlite.insert
+    raise NotImplementedError('No upsert for ' + dialect.name)
+
+
+class ViewCounter:
+
+    def __init__(self, app, interval=10, max_keys=10000):
+        self.app = app
+        self.interval = interval
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.counts = {}
+        self.pid = None
+
+    def record(self, kind, entity_id):
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            key = (kind, entity_id)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            full = len(self.counts) >= self.max_keys
+        if full:
+            self.wake.set()
+
+    def start(self):
+        # Per process: views counted before a fork belong to the parent.
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.counts = {}
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, name='view-counter', daemon=True).start()
+        atexit.register(self.flush_quietly)
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush_quietly()
+
+    def flush_quietly(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            self.app.logger.exception('Could not write page views')
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if not counts:
+            return 0
+        bucket = hour_of(datetime.now())
+        rows = [{"kind": kind, "entity_id": entity_id, "bucket": bucket, "views": views}
+                for (kind, entity_id), views in sorted(counts.items())]
+        insert = insert_for(db.session.get_bind(PageView.__mapper__).dialect)(PageView)
+        try:
+            db.session.execute(insert.on_conflict_do_update(
+                index_elements=['kind', 'entity_id', 'bucket'],
+                set_={"views": PageView.views + insert.excluded.views}), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Keep the counts for the next flush rather than lose them.
+            with self.lock:
+                for key, views in counts.items():
+                    self.counts[key] = self.counts.get(key, 0) + views
+            raise
+        return len(rows)
+
+
+# Ranking
+# ----------------------------------------------------------------
+
+def entity_names(kind, ids):
+    if not ids:
+        return {}
+    if kind == 'artist':
+        return dict(db.session.execute(db.select(Artist.id, Artist.name).where(Artist.id.in_(ids))).all())
+    query = db.select(Venue.id, Venue.name).where(Venue.id.in_(ids))
+    names = {}
+    for _, rows in scatter(lambda conn: conn.execute(query).all(), venue_shards(ids)):
+        names.update(rows)
+    return names
+
+
+def compute_trending(now=None):
+    config = current_app.config
+    now = now or datetime.now()
+    half_life = config['TRENDING_HALF_LIFE_HOURS']
+    window_start = hour_of(now) - timedelta(hours=config['TRENDING_WINDOW_HOURS'])
+    size = config['TRENDING_SIZE']
+
+    scores = {kind: {} for kind in KINDS}
+    rows = db.session.execute(
+        db.select(PageView.kind, PageView.entity_id, PageView.bucket, PageView.views)
+        .where(PageView.bucket >= window_start)
+        .execution_options(yield_per=5000))
+    for kind, entity_id, bucket, views in rows:
+        if kind not in scores:
+            continue
+        age = max((now - bucket).total_seconds() / 3600, 0)
+        score = scores[kind]
+        score[entity_id] = score.get(entity_id, 0.0) + views * 0.5 ** (age / half_life)
+
+    rankings = {}
+    for kind, score in scores.items():
+        # A few spare candidates in case some were deleted since.
+        top = heapq.nlargest(size * 2, score.items(), key=lambda item: item[1])
+        names = entity_names(kind, [entity_id for entity_id, _ in top])
+        rankings[kind] = [(entity_id, names[entity_id], value) for entity_id, value in top
+                          if entity_id in names][:size]
+
+    # Replaced in one transaction, so readers see the old list or the new.
+    db.session.execute(db.delete(Trending))
+    rows = [{"kind": kind, "rank": rank, "entity_id": entity_id, "name": name, "score": value, "computed_at": now}
+            for kind, ranking in rankings.items()
+            for rank, (entity_id, name, value) in enumerate(ranking, 1)]
+    if rows:
+        db.session.execute(db.insert(Trending), rows)
+    db.session.execute(db.delete(PageView).where(PageView.bucket < window_start))
+    db.session.commit()
+    return {kind: len(ranking) for kind, ranking in rankings.items()}
+
+
+def trending_lists(limit):
+    # {'venue': [row, ...], 'artist': [...]}; rows have id and name.
+    lists = {kind: [] for kind in KINDS}
+    rows = db.session.execute(
+        db.select(Trending.kind, Trending.entity_id.label('id'), Trending.name)
+        .where(Trending.rank <= limit).order_by(Trending.kind, Trending.rank)).all()
+    for row in rows:
+        lists.setdefault(row.kind, []).append(row)
+    return lists
+
+
+def init_view_counter(app):
+    if not app.config['VIEW_COUNTS_ENABLED']:
+        return None
+    counter = ViewCounter(app, app.config['VIEW_FLUSH_INTERVAL'], app.config['VIEW_BUFFER_MAX_KEYS'])
+    app.extensions['view_counter'] = counter
+    return counter
+
+
+# ----------------------------------------------------------------------------#
+# CLI.
+# ----------------------------------------------------------------------------#
+
+trending_cli = AppGroup('trending', help='Rank trending venues and artists.')
+
+
+@trending_cli.command('compute')
+@click.option('--schedule', is_flag=True, help='Queue the recurring trending job instead of running now.')
+def compute_command(schedule):
+    if schedule:
+        from tasks import schedule_trending
+        job = schedule_trending(delay=0)
+        click.echo('Queued trending job {}'.format(job.id))
+        return
+    counts = compute_trending()
+    click.echo('Ranked {} venues and {} artists.'.format(counts['venue'], counts['artist']))
@@ -0,0 +1,112 @@
+import json
+
+from models import db
+from matching import split_genres
+
+# ----------------------------------------------------------------------------#
+# Partial updates with optimistic concurrency.
+# ----------------------------------------------------------------------------#
+
+VENUE_FIELDS = ('name', 'genres', 'address', 'city', 'state', 'phone', 'website_link',
+                'facebook_link', 'seeking_talent', 'seeking_description', 'image_link')
+ARTIST_FIELDS = ('name', 'genres', 'city', 'state', 'phone', 'website_link',
+                 'facebook_link', 'seeking_venue', 'seeking_description', 'image_link')
+LOCATION_FIELDS = ('address', 'city', 'state')
+
+
+class VersionConflict(Exception):
+
+    def __init__(self, current_version):
+        super().__init__('Stale version')
+        self.current_version = current_version
+
+
+class NotFound(Exception):
+    pass
+
+
+BOOLEAN_FIELDS = ('seeking_talent', 'seeking_venue')
+
+
+def check_attribute(field, value):
+    # JSON input only: form values are strings and go through form_values.
+    if field in BOOLEAN_FIELDS:
+        if not isinstance(value, bool):
+            raise ValueError('{} must be true or false'.format(field))
+    elif field == 'genres':
+        if value is not None and not isinstance(value, str) and not (
+                isinstance(value, list) and all(isinstance(g, str) for g in value)):
+            raise ValueError('genres must be a string or a list of strings')
+    elif value is not None and not isinstance(value, str):
+        raise ValueError('{} must be a string or null'.format(field))
+
+
+def normalize(field, value):
+    if field in BOOLEAN_FIELDS:
+        return bool(value)
+    if field == 'genres':
+        return ','.join(sorted(split_genres(value)))
+    return value if value is not None else ''
+
+
+def form_values(form, fields):
+    values = {}
+    for field in fields:
+        if field in BOOLEAN_FIELDS:
+            value = form.get(field, 'n') == 'y'
+        elif field == 'genres':
+            value = form.getlist('genres')
+        else:
+            value = form.get(field, '')
+        values[field] = normalize(field, value)
+    return values
+
+
+def entity_values(entity, fields):
+    return {field: normalize(field, getattr(entity, field)) for field in fields}
+
+
+def dump_original(values):
+    return json.dumps(values, sort_keys=True)
+
+
+def load_original(raw):
+    try:
+        original = json.loads(raw or '{}')
+    except ValueError:
+        return {}
+    return original if isinstance(original, dict) else {}
+
+
+def changed_values(submitted, original):
+    return {k: v for k, v in submitted.items() if k not in original or original[k] != v}
+
+
+def apply_patch(model, entity_id, version, changes):
+    # One UPDATE guarded by the version the client read; zero matched rows
+    # means the row is gone or somebody else saved first. Returns the new
+    # version.
+    if not changes:
+        # Nothing to write, but a stale version is still a conflict.
+        current = db.session.execute(db.select(model.version).where(model.id == entity_id)).scalar()
+        if current is None:
+            raise NotFound()
+        if current != version:
+            raise VersionConflict(current)
+        return version
+    result = db.session.execute(
+        db.update(model)
+        .where(model.id == entity_id)
+        .where(model.version == version)
+        .values(version=model.version + 1, **changes)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 1:
+        return version + 1
+    db.session.rollback()
+    current = db.session.execute(
+        db.select(model.version).where(model.id == entity_id)
+    ).scalar()
+    if current is None:
+        raise NotFound()
+    raise VersionConflict(current)
@@ -0,0 +1,182 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Venue, Artist, Show, VenueShard
+from sharding import GLOBAL_TABLES, scatter, shard_for_state, shard_names, using_shard
+from queries import ARTIST_UPCOMING_COUNTS, VENUE_SEARCH, VENUE_SHARD, VENUE_SUMMARIES, contains
+
+# ----------------------------------------------------------------------------#
+# Venue directory.
+# ----------------------------------------------------------------------------#
+
+
+def venue_shard(venue_id):
+    # Venues missing from the directory predate sharding and are on the
+    # default database, which is also what None means.
+    return db.session.execute(VENUE_SHARD, {"venue_id": venue_id}).scalar()
+
+
+def venue_shards(ids):
+    # {shard: [venue ids]} for a batch of ids.
+    placement = dict(db.session.execute(
+        db.select(VenueShard.id, VenueShard.shard).where(VenueShard.id.in_(ids))
+    ).all())
+    groups = {}
+    for venue_id in ids:
+        groups.setdefault(placement.get(venue_id), []).append(venue_id)
+    return groups
+
+
+def allocate_venue_id(state):
+    # There is no transaction across databases, so a venue is created in
+    # steps: this commits its directory row on the default database, which
+    # reserves the id; the caller commits the venue on the shard and then
+    # calls place_venue(). If the venue cannot be written the caller drops
+    # the row with release_venue_id(); a row left by a crash points at no
+    # venue (ids are never reused) and `flask shards prune` removes it.
+    entry = VenueShard(shard=shard_for_state(state))
+    db.session.add(entry)
+    db.session.flush()
+    venue_id, shard = entry.id, entry.shard
+    db.session.commit()
+    return venue_id, shard
+
+
+def place_venue(venue_id, shard):
+    # Idempotent: puts the directory row back if a prune removed it while
+    # the venue was being written.
+    db.session.merge(VenueShard(id=venue_id, shard=shard))
+    db.session.commit()
+
+
+def release_venue_id(venue_id):
+    db.session.rollback()
+    db.session.execute(db.delete(VenueShard).where(VenueShard.id == venue_id))
+    db.session.commit()
+
+
+# Artist copies
+# ----------------------------------------------------------------
+#
+# Artists live on the default database. A show is stored with its venue, so
+# the venue's shard keeps a copy of every artist booked there; that keeps the
+# foreign key and lets venue pages join artist names locally.
+
+def artist_row(artist_id):
+    return db.session.execute(
+        db.select(Artist.__table__).where(Artist.id == artist_id)
+    ).mappings().first()
+
+
+def copy_artist(artist_id, shard):
+    if shard is None:
+        return
+    row = artist_row(artist_id)
+    if row is None:
+        raise ValueError('Artist {} does not exist.'.format(artist_id))
+    with using_shard(shard):
+        table = Artist.__table__
+        exists = db.session.execute(db.select(table.c.id).where(table.c.id == artist_id)).scalar()
+        if exists is None:
+            db.session.execute(db.insert(table).values(**row))
+        else:
+            db.session.execute(db.update(table).where(table.c.id == artist_id).values(**row))
+
+
+def sync_artist(artist_id):
+    # Push the current artist row to every shard holding a copy.
+    row = artist_row(artist_id)
+    if row is None:
+        return 0
+    table = Artist.__table__
+    updated = 0
+    for shard in shard_names()[1:]:
+        with using_shard(shard):
+            updated += db.session.execute(
+                db.update(table).where(table.c.id == artist_id).values(**row)
+            ).rowcount
+            db.session.commit()
+    return updated
+
+
+# Scatter-gather reads
+# ----------------------------------------------------------------
+
+def venue_summaries(now, search=None):
+    # Venue tiles with their upcoming show counts, one grouped query per
+    # shard; search limits them to names containing it.
+    if search is None:
+        query, params = VENUE_SUMMARIES, {"now": now}
+    else:
+        query, params = VENUE_SEARCH, {"now": now, "pattern": contains(search)}
+    rows = []
+    for _, result in scatter(lambda conn: conn.execute(query, params).all()):
+        rows.extend(result)
+    return rows
+
+
+def recent_venues(limit):
+    query = db.select(Venue.id, Venue.name).order_by(Venue.id.desc()).limit(limit)
+    rows = []
+    for _, result in scatter(lambda conn: conn.execute(query).all()):
+        rows.extend(result)
+    return sorted(rows, key=lambda row: row.id, reverse=True)[:limit]
+
+
+def artist_upcoming_counts(ids, now):
+    counts = dict.fromkeys(ids, 0)
+    if not ids:
+        return counts
+    params = {"ids": list(ids), "now": now}
+    for _, result in scatter(lambda conn: conn.execute(ARTIST_UPCOMING_COUNTS, params).all()):
+        for artist_id, count in result:
+            counts[artist_id] += count
+    return counts
+
+
+# ----------------------------------------------------------------------------#
+# CLI.
+# ----------------------------------------------------------------------------#
+
+shards_cli = AppGroup('shards', help='Set up and inspect venue shards.')
+
+
+@shards_cli.command('init')
+def init_shards_command():
+    # Shards get every table except the global ones.
+    tables = [t for t in db.metadata.sorted_tables if t.name not in GLOBAL_TABLES]
+    for shard in shard_names()[1:]:
+        db.metadata.create_all(db.engines[shard], tables=tables)
+        click.echo('Created tables on shard {}'.format(shard))
+
+
+@shards_cli.command('prune')
+def prune_directory_command():
+    # Directory rows whose venue is not on their shard: reservations of
+    # creates that failed or crashed before the venue was committed.
+    pruned = 0
+    for shard in shard_names():
+        placed = VenueShard.shard.is_(None) if shard is None else VenueShard.shard == shard
+        ids = db.session.execute(db.select(VenueShard.id).where(placed)).scalars().all()
+        with using_shard(shard):
+            existing = set(db.session.execute(db.select(Venue.id)).scalars())
+        orphans = [venue_id for venue_id in ids if venue_id not in existing]
+        if orphans:
+            db.session.execute(db.delete(VenueShard).where(VenueShard.id.in_(orphans)))
+            db.session.commit()
+        pruned += len(orphans)
+    click.echo('Removed {} directory rows without a venue.'.format(pruned))
+
+
+@shards_cli.command('status')
+def shard_status_command():
+    counts = scatter(lambda conn: (
+        conn.execute(db.select(db.func.count()).select_from(Venue)).scalar(),
+        conn.execute(db.select(db.func.count()).select_from(Show)).scalar()
+    ))
+    for shard, (venues, shows) in counts:
+        click.echo('{:<16} {:>8} venues {:>10} shows'.format(shard or 'default', venues, shows))
+    states = current_app.config['SHARD_MAP']
+    for shard in shard_names()[1:]:
+        click.echo('{}: {}'.format(shard, ', '.join(sorted(s for s, name in states.items() if name == shard))))